@@ -0,0 +1,81 @@
+﻿"""
+bench_contention.py - Throughput of WebVendingMachine under growing thread counts
+
+Each thread plays one customer buying from its own slot. Every command runs
+under the machine lock, so added threads queue on it rather than add
+throughput; the numbers show how much that queueing costs as threads grow.
+
+    python -m benchmarks.bench_contention [--seconds 1.0] [--threads 1,2,4,8,16]
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main_web import WebVendingMachine
+
+
+def make_machine():
+    vm = WebVendingMachine(max_sessions=100000)
+    for product in vm.products.values():
+        product.quantity = 10 ** 9
+    return vm
+
+
+def run(machine, codes, threads, seconds):
+    stop = threading.Event()
+    counts = [0] * threads
+
+    def customer(index):
+        session_id = f"customer-{index}"
+        code = codes[index % len(codes)]
+        done = 0
+        while not stop.is_set():
+            machine.insert_cash(5.0, session_id)
+            machine.purchase_product(code, session_id)
+            done += 2
+        counts[index] = done
+
+    workers = [threading.Thread(target=customer, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    time.sleep(seconds)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return sum(counts) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=1.0)
+    parser.add_argument('--threads', default='1,2,4,8,16')
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    for threads in [int(n) for n in args.threads.split(',')]:
+        machine = make_machine()
+        results.append({
+            'threads': threads,
+            'ops_per_sec': round(run(machine, list(machine.products), threads, args.seconds)),
+        })
+        machine.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'threads':>8} {'ops/s':>12}")
+    for row in results:
+        print(f"{row['threads']:>8} {row['ops_per_sec']:>12,}")
+
+
+if __name__ == '__main__':
+    main()
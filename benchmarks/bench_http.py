@@ -0,0 +1,235 @@
+﻿"""
+bench_http.py - Latency and throughput of every main_web route under mixed workloads
+
+Each workload is a weighted mix of requests replayed by concurrent client
+threads, every thread with its own session. It runs through Flask's test
+client (application cost only) and against a real threaded HTTP server on
+localhost (adds sockets and HTTP parsing), or against --url for a deployed
+server such as gunicorn. Rate limiting and admission control are lifted
+for in-process runs unless --keep-limits is given, otherwise the limits,
+not the routes, would be measured. /api/events only runs through the test
+client: over HTTP the server keeps a stream (and its slot under
+VENDING_MAX_EVENT_STREAMS) until its next keepalive fails, long after the
+client hung up, so later streams would be refused.
+
+    python -m benchmarks.bench_http [--workloads browse,purchase,admin] [--modes test-client,server]
+                                    [--requests 2000] [--concurrency 8] [--url URL] [--json]
+"""
+
+import argparse
+from http.cookiejar import CookieJar
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ADMIN_TOKEN = 'bench-admin-token'
+os.environ.setdefault('VENDING_ADMIN_TOKEN', ADMIN_TOKEN)
+
+import main_web
+from src.ratelimit import AdmissionController, TokenBucketLimiter
+
+
+# (weight, method, path, JSON body); /api/events is timed to its first message
+# and left out over HTTP (see the module docstring)
+BROWSE = [
+    (50, 'GET', '/', None),
+    (20, 'GET', '/api/state', None),
+    (10, 'GET', '/api/events', None),
+    (10, 'POST', '/api/add-money', {'amount': 1.0}),
+    (10, 'POST', '/api/purchase', {'product_code': 'A1'}),
+]
+PURCHASE = [
+    (30, 'POST', '/api/add-money', {'amount': 5.0}),
+    (35, 'POST', '/api/purchase', {'product_code': 'B2'}),
+    (10, 'POST', '/api/credit-card', {'amount': 3.0}),
+    (10, 'POST', '/api/batch', {'operations': [
+        {'op': 'add-money', 'amount': 2.0},
+        {'op': 'purchase', 'product_code': 'A2'},
+    ]}),
+    (10, 'POST', '/api/cancel', None),
+    (5, 'GET', '/api/state', None),
+]
+ADMIN = [
+    (40, 'GET', '/api/admin', None),
+    (30, 'GET', '/metrics', None),
+    (20, 'GET', '/api/state', None),
+    (8, 'GET', '/', None),
+    (2, 'POST', '/api/admin/profile?seconds=0', None),
+]
+WORKLOADS = {'browse': BROWSE, 'purchase': PURCHASE, 'admin': ADMIN}
+
+
+def without_event_streams(mix):
+    return [entry for entry in mix if entry[2] != '/api/events']
+
+
+def lift_limits():
+    """Let every request through so the routes themselves are measured"""
+    for priority in list(main_web.rate_limiters):
+        main_web.rate_limiters[priority] = TokenBucketLimiter(rate=1e12, burst=1e12)
+    main_web.admission = AdmissionController(max_in_flight=10 ** 9)
+
+
+def restock():
+    for product in main_web.vm.products.values():
+        product.quantity = 10 ** 9
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class TestClientSession:
+    """One customer talking to the app in-process"""
+
+    def __init__(self):
+        self.client = main_web.app.test_client()
+
+    def request(self, method, path, body):
+        headers = {'X-Admin-Token': ADMIN_TOKEN}
+        if path == '/api/events':
+            response = self.client.get(path, buffered=False)
+            next(response.response)
+            response.close()
+            return response.status_code
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        response.get_data()
+        return response.status_code
+
+
+class HttpSession:
+    """One customer talking to a server over HTTP, keeping its session cookie"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+
+    def request(self, method, path, body):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json',
+                                                  'X-Admin-Token': ADMIN_TOKEN})
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+
+def run_workload(mix, session_factory, requests, concurrency, seed=0):
+    weights = [entry[0] for entry in mix]
+    per_worker = max(1, requests // concurrency)
+    timings = [[] for _ in range(concurrency)]   # (path, seconds, status) per worker
+
+    def customer(index):
+        rng = random.Random(seed + index)
+        session = session_factory()
+        plan = rng.choices(mix, weights=weights, k=per_worker)
+        results = timings[index]
+        for _, method, path, body in plan:
+            started = time.perf_counter()
+            status = session.request(method, path, body)
+            results.append((path, time.perf_counter() - started, status))
+
+    workers = [threading.Thread(target=customer, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return summarize([timing for results in timings for timing in results], elapsed)
+
+
+def summarize(timings, elapsed):
+    def stats(latencies, errors):
+        ordered = sorted(latencies)
+        return {
+            'requests': len(ordered),
+            'errors': errors,
+            'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+            'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+            'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+        }
+
+    by_route = {}
+    for path, seconds, status in timings:
+        by_route.setdefault(path.split('?')[0], []).append((seconds, status))
+    summary = stats([seconds for _, seconds, _ in timings],
+                    sum(1 for _, _, status in timings if status >= 400))
+    summary['requests_per_sec'] = round(len(timings) / elapsed, 1)
+    summary['routes'] = {route: stats([seconds for seconds, _ in samples],
+                                      sum(1 for _, status in samples if status >= 400))
+                         for route, samples in sorted(by_route.items())}
+    return summary
+
+
+def start_server():
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)   # no access log per request
+    server = make_server('127.0.0.1', 0, main_web.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workloads', default='browse,purchase,admin')
+    parser.add_argument('--modes', default='test-client,server')
+    parser.add_argument('--requests', type=int, default=2000, help="requests per workload and mode")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--url', help="benchmark this running server instead of starting one")
+    parser.add_argument('--keep-limits', action='store_true', help="leave rate limits and shedding on")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    if not args.keep_limits:
+        lift_limits()
+    restock()
+    modes = ['url'] if args.url else args.modes.split(',')
+
+    results = []
+    for mode in modes:
+        server = None
+        if mode == 'test-client':
+            factory = TestClientSession
+        elif mode == 'server':
+            server, base_url = start_server()
+            factory = lambda: HttpSession(base_url)
+        else:
+            factory = lambda: HttpSession(args.url)
+        try:
+            for name in args.workloads.split(','):
+                mix = WORKLOADS[name] if mode == 'test-client' else without_event_streams(WORKLOADS[name])
+                summary = run_workload(mix, factory, args.requests, args.concurrency)
+                results.append({'mode': mode, 'workload': name, 'concurrency': args.concurrency,
+                                **summary})
+        finally:
+            if server is not None:
+                server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'mode':<12} {'workload':<10} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for row in results:
+        print(f"{row['mode']:<12} {row['workload']:<10} {row['requests_per_sec']:>10,.1f} "
+              f"{row['p50_ms']:>9.3f} {row['p95_ms']:>9.3f} {row['p99_ms']:>9.3f} {row['errors']:>7}")
+        for route, stats in row['routes'].items():
+            print(f"{'':<12} {route:<22} {stats['p50_ms']:>9.3f} {stats['p95_ms']:>9.3f} "
+                  f"{stats['p99_ms']:>9.3f} {stats['errors']:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+﻿"""
+bench_models.py - Microbenchmarks for the VendingMachine hot paths in src/models.py
+
+Every case runs on a fresh machine with the given number of slots (the 24
+default products plus generated fillers) and a transaction history of the
+given length, stored in a temporary directory. Each case is timed first,
+then run again under tracemalloc to count the memory blocks and bytes it
+leaves allocated per operation and the peak memory it needs on top of the
+machine itself.
+
+    python -m benchmarks.bench_models [--cases purchase_product,insert_cash,...]
+                                      [--slots 24,1000,10000,100000] [--history 0,100000]
+                                      [--min-time 0.2] [--json]
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.history import TransactionType
+from src.models import Product, VendingMachine
+from src.money import Money
+
+
+def make_machine(slots, history, state_file):
+    vm = VendingMachine(state_file=state_file)
+    for n in range(len(vm.products), slots):
+        code = f"X{n}"
+        vm.products[code] = Product(code, f"Filler {n}", 1.00 + (n % 400) / 100)
+    for product in vm.products.values():
+        product.quantity = 10 ** 9
+    start_ns = time.time_ns() - history * 1_000_000_000
+    for n in range(history):
+        vm.transactions.append(TransactionType.CASH, (n % 20) * 100,
+                               timestamp_ns=start_ns + n * 1_000_000_000)
+    return vm
+
+
+# Each case takes a prepared machine and returns the operation to time
+def case_purchase_product(vm):
+    codes = itertools.cycle(list(vm.products))
+
+    def op():
+        vm.balance = Money(10000)    # purchase_product hands all change back
+        vm.purchase_product(next(codes))
+    return op
+
+
+def case_insert_cash(vm):
+    return lambda: vm.insert_cash(1.0)
+
+
+def case_get_product_grid(vm):
+    vm.balance = Money(200)
+    return vm.get_product_grid
+
+
+def case_grid_after_coin(vm):
+    # The desktop UI redraws the grid after every coin and purchase
+    def op():
+        if vm.balance > 5:
+            vm.cancel_transaction()
+        vm.insert_cash(0.25)
+        vm.get_product_grid()
+    return op
+
+
+def case_log_transaction(vm):
+    return lambda: vm.log_transaction(TransactionType.CASH, 1.0)
+
+
+def case_save_state(vm):
+    return vm.save_state
+
+
+def case_load_state(vm):
+    vm.save_state()
+    return vm.load_state
+
+
+CASES = {
+    'purchase_product': case_purchase_product,
+    'insert_cash': case_insert_cash,
+    'get_product_grid': case_get_product_grid,
+    'grid_after_coin': case_grid_after_coin,
+    'log_transaction': case_log_transaction,
+    'save_state': case_save_state,
+    'load_state': case_load_state,
+}
+
+
+def time_op(op, min_time, max_ops=1000000):
+    """Run op in growing batches until min_time has passed; return (ops, seconds)"""
+    ops, elapsed, batch = 0, 0.0, 1
+    while elapsed < min_time and ops < max_ops:
+        start = time.perf_counter()
+        for _ in range(batch):
+            op()
+        elapsed += time.perf_counter() - start
+        ops += batch
+        batch *= 2
+    return ops, elapsed
+
+
+def trace_op(op, ops):
+    """Net blocks and bytes left allocated per op, and peak bytes while running"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for _ in range(ops):
+        op()
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    diff = after.compare_to(before, 'filename')
+    blocks = sum(stat.count_diff for stat in diff)
+    size = sum(stat.size_diff for stat in diff)
+    return blocks / ops, size / ops, peak
+
+
+def run_case(name, slots, history, min_time, directory):
+    state_file = os.path.join(directory, f"{name}-{slots}-{history}.json")
+    vm = make_machine(slots, history, state_file)
+    op = CASES[name](vm)
+    op()    # warm up
+    gc.collect()
+    ops, elapsed = time_op(op, min_time)
+
+    vm = make_machine(slots, history, state_file)
+    op = CASES[name](vm)
+    op()
+    blocks, size, peak = trace_op(op, min(ops, 1000))
+    return {
+        'case': name,
+        'slots': slots,
+        'history': history,
+        'ops': ops,
+        'ops_per_sec': round(ops / elapsed, 1),
+        'blocks_per_op': round(blocks, 2),
+        'bytes_per_op': round(size, 1),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cases', default=','.join(CASES))
+    parser.add_argument('--slots', default='24,1000,10000,100000')
+    parser.add_argument('--history', default='0,100000')
+    parser.add_argument('--min-time', type=float, default=0.2, help="seconds to time each case for")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.cases.split(','):
+            for slots in [int(n) for n in args.slots.split(',')]:
+                for history in [int(n) for n in args.history.split(',')]:
+                    results.append(run_case(name, slots, history, args.min_time, directory))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'case':<18} {'slots':>7} {'history':>8} {'ops/s':>12} {'blocks/op':>10} "
+          f"{'bytes/op':>10} {'peak KiB':>10}")
+    for row in results:
+        print(f"{row['case']:<18} {row['slots']:>7} {row['history']:>8} {row['ops_per_sec']:>12,.1f} "
+              f"{row['blocks_per_op']:>10.2f} {row['bytes_per_op']:>10.1f} {row['peak_kib']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
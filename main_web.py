@@ -2,699 +2,878 @@
 main_web.py - Web version for Render deployment (FIXED VERSION)
 """
 
-from flask import Flask, render_template_string, request, jsonify, session
-import json
+from flask import Flask, Response, g, request, jsonify, make_response, session
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.middleware.proxy_fix import ProxyFix
+import gzip
+import hashlib
+import hmac
+import math
 import os
-from datetime import datetime
+import signal
+import threading
+import time
+import uuid
+from collections import deque
+from functools import wraps
+
+from src.cache import TTLCache
+from src.events import Broadcaster
+from src.metrics import MetricsRegistry
+from src.machine_events import ProductDispensed
+from src.models import BALANCE_KEEP, DEFAULT_PRODUCTS, MemoryStorage, VendingMachine
+from src.money import Money
+from src import profiler
+from src.ratelimit import (AdmissionController, TokenBucketLimiter,
+                           PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_LOW)
+from src.shared_state import SharedInventory, SharedMemoryStorage, SharedReplyCache
+
+
+
+class MoneyJSONProvider(DefaultJSONProvider):
+    """JSON responses carry money as plain dollar numbers"""
+    
+    @staticmethod
+    def default(o):
+        if isinstance(o, Money):
+            return float(o)
+        return DefaultJSONProvider.default(o)
+
 
 app = Flask(__name__)
+app.json = MoneyJSONProvider(app)
 app.secret_key = 'vendor-pro-2026-cinematic-secret'
 
-# Simple in-memory vending machine for web
-class WebVendingMachine:
-    def __init__(self):
-        self.balance = 0.0
-        self.total_sales = 0.0
-        self.transactions = []
-        self.products = {}
-        self.load_products()
-    
-    def load_products(self):
-        """Load products for web version"""
-        products_data = [
-            ("A1", "Coke", 1.75, 9),
-            ("A2", "Pepsi", 1.75, 9),
-            ("A3", "Dr Pepper", 1.75, 9),
-            ("A4", "Powerade", 2.25, 10),
-            ("B1", "Water", 1.25, 9),
-            ("B2", "Sparkling", 2.00, 10),
-            ("B3", "Iced Coffee", 3.50, 10),
-            ("B4", "Energy Drk", 3.00, 10),
-            ("C1", "Classic Chips", 1.50, 9),
-            ("C2", "BBQ Chips", 1.50, 10),
-            ("C3", "Sour Cream", 1.50, 10),
-            ("C4", "Pretzels", 1.25, 10),
-            ("D1", "Mixed Nuts", 2.50, 10),
-            ("D2", "Protein Bar", 3.00, 10),
-            ("D3", "Beef Jerky", 4.50, 10),
-            ("D4", "Popcorn", 2.00, 10),
-            ("E1", "PB Cookie", 2.00, 10),
-            ("E2", "Dark Choco", 2.50, 10),
-            ("E3", "Milk Choco", 2.25, 10),
-            ("E4", "Gummy Bears", 1.75, 10),
-            ("F1", "Skittles", 1.75, 10),
-            ("F2", "Brownie", 2.50, 10),
-            ("F3", "Fruit Snacks", 1.50, 10),
-            ("F4", "Mint Gum", 0.75, 10),
-        ]
-        
-        for code, name, price, quantity in products_data:
-            self.products[code] = {
-                'code': code,
-                'name': name,
-                'price': price,
-                'quantity': quantity,
-                'available': quantity > 0
-            }
-    
-    def insert_cash(self, amount):
-        """Insert cash"""
-        if amount <= 0:
-            return False, "Invalid amount"
-        
-        self.balance += amount
-        self.log_transaction(f"Cash inserted: ${amount:.2f}")
-        return True, f"Added ${amount:.2f}"
+# Reverse proxies in front of the app (VENDING_TRUSTED_PROXIES). Only the
+# X-Forwarded-For hops they append are believed, so remote_addr is the real
+# client and a forged header cannot pick another client's rate limit bucket.
+TRUSTED_PROXIES = int(os.environ.get('VENDING_TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+# Balance key used by callers that have no web session (scripts, tests)
+DEFAULT_SESSION = 'default'
+
+# Largest number of operations accepted by /api/batch
+MAX_BATCH_OPERATIONS = 100
+
+# Most one request may add to a credit, so repeated top-ups stay far from
+# the int64 cents the history and the shared balance table hold
+MAX_AMOUNT = Money(1_000_000 * 100)
+
+# Idempotency-Key replay cache: entry count and lifetime bound its memory,
+# and over-long keys are refused so one entry has a fixed size ceiling
+IDEMPOTENCY_CACHE_SIZE = 10000
+IDEMPOTENCY_TTL_SECONDS = 3600
+MAX_IDEMPOTENCY_KEY_LENGTH = 64
+# In shared mode replies live in fixed-size shared entries, so fewer of them
+IDEMPOTENCY_SHARED_ENTRIES = 1024
+# Number of locks keyed requests are striped over
+IDEMPOTENCY_LOCK_STRIPES = 64
+
+# Counter bumped for each reason a purchase is refused
+REFUSAL_METRICS = {
+    'out_of_stock': 'vending_stockouts_total',
+    'insufficient_funds': 'vending_insufficient_funds_total',
+}
+
+# Recent transactions kept for /api/state delta polling
+CHANGE_LOG_SIZE = 256
+
+# Transactions kept in memory; with a history directory (VENDING_HISTORY_DIR)
+# older ones are spilled to compressed segment files there, otherwise dropped
+HISTORY_CAPACITY = 10000
+
+# An event stream is closed after this long and the browser reconnects, so
+# a stream never pins a worker thread indefinitely
+EVENT_STREAM_SECONDS = 60
+EVENT_KEEPALIVE_SECONDS = 15
+
+# Requests a worker runs at once: gunicorn's gthread --threads, which
+# render.yaml passes from VENDING_THREADS. Admission control sheds against it
+WORKER_THREADS = int(os.environ.get('VENDING_THREADS', 8))
+
+# Each open stream holds a worker thread, so a worker serves at most this
+# many at once and leaves its other threads for requests; past the cap the
+# page is told to poll /api/state instead
+MAX_EVENT_STREAMS = int(os.environ.get('VENDING_MAX_EVENT_STREAMS', 4))
+EVENT_POLL_SECONDS = 2
+
+# Admin-only endpoints are refused unless VENDING_ADMIN_TOKEN is set and the
+# request sends it in the X-Admin-Token header
+ADMIN_TOKEN = os.environ.get('VENDING_ADMIN_TOKEN')
+
+# On-demand profiling: longest run and finest sampling interval allowed
+MAX_PROFILE_SECONDS = 30
+MIN_PROFILE_INTERVAL = 0.005
+
+
+def synced(method):
+    """Run a WebVendingMachine command under the machine lock
     
-    def purchase(self, product_code):
-        """Purchase a product - Subtracts cost but keeps remaining balance!"""
-        if product_code not in self.products:
-            return False, "Invalid product code"
+    Without a shared inventory that is the machine's own re-entrant lock.
+    With one it is the shared lock, held for the whole call, and other
+    workers' sales are pulled in first; what the call changes is written
+    back to the block as it happens, by SharedMemoryStorage and
+    log_transaction(). Nested calls (a batch running single operations)
+    only pull once, around the outermost call.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.shared is None:
+            with self._command_lock:
+                return method(self, *args, **kwargs)
+        with self.shared.lock():
+            if self._sync_depth == 0:
+                self._pull()
+            self._sync_depth += 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._sync_depth -= 1
+    return wrapper
+
+
+def product_json(product):
+    """A product as the JSON API shows it"""
+    quantity = product.quantity
+    return {
+        'code': product.code,
+        'name': product.name,
+        'price': product.price,
+        'quantity': quantity,
+        'available': quantity > 0
+    }
+
+
+def parse_amount(value):
+    """Money for a requested amount, or None unless it is a finite number from a cent to MAX_AMOUNT"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(value) or value > float(MAX_AMOUNT):
+        return None
+    amount = Money.of(value)
+    return amount if amount.cents > 0 else None
+
+
+class WebVendingMachine(VendingMachine):
+    """The shared engine (src/models.py) serving many web customers at once
+    
+    Every session has its own credit: credit() and set_credit() keep it in
+    a TTL cache, or in the shared block's balance table in shared mode.
+    Commands run one at a time under the machine lock (see synced): every
+    sale changes the totals and the history, so finer locks would only be
+    taken on the way to that one. A short totals lock numbers the logged
+    lines, and that number is the state version /api/state deltas are
+    taken against, so readers copy them without waiting for a command.
+    """
+    
+    def __init__(self, shared_name=None, max_sessions=4096, session_ttl=1800, metrics=None,
+                 history_dir=None, balance_policy=BALANCE_KEEP, catalog=DEFAULT_PRODUCTS, bus=None):
+        self.reclaimed_credit = Money()
+        self.version = 0              # state version, bumped by every logged change
+        self.inventory_version = 0    # state version of the last stock change
+        self.change_log = deque(maxlen=CHANGE_LOG_SIZE)   # (version, transaction line)
+        # Held by every command; re-entrant so a batch can run single commands
+        self._command_lock = threading.RLock()
+        # Guards applying events, versions and change_log; re-entrant because
+        # a balance write can evict an idle session, whose credit is logged
+        self._totals_lock = threading.RLock()
+        self.product_versions = {code: 0 for code, _, _, _ in catalog}
         
-        product = self.products[product_code]
+        # Shared mode: stock, prices, balances and ledger live in a shared memory
+        # block so every gunicorn worker sells from the same machine
+        self.shared = None
+        self._sync_depth = 0
+        if shared_name:
+            self.shared = SharedInventory(shared_name,
+                                          [Money.of(price).cents for _, _, price, _ in catalog],
+                                          [quantity for _, _, _, quantity in catalog],
+                                          session_capacity=max_sessions, session_ttl=session_ttl)
+            storage = SharedMemoryStorage(self.shared)
+            self.balances = self.shared.balances
+        else:
+            storage = MemoryStorage()
+            self.balances = TTLCache(max_entries=max_sessions, ttl=session_ttl)
+        # Credit left by sessions that went idle or were evicted is kept by the machine
+        self.balances.on_evict = self._reclaim_credit
         
-        if product['quantity'] <= 0:
-            return False, f"Sorry, {product['name']} is out of stock!"
+        # In shared mode the shared ledger is the history and each refresh reloads it
+        super().__init__(storage=storage, history_capacity=HISTORY_CAPACITY,
+                         history_dir=None if shared_name else history_dir,
+                         balance_policy=balance_policy, catalog=catalog, bus=bus)
+        self.refresh()
         
-        if self.balance < product['price']:
-            return False, f"Insufficient funds! Need: ${product['price']:.2f}"
+        # Live subscribers (the /api/events streams) get small change deltas
+        self.events = Broadcaster()
+        # Sales and rejected purchases, exported by /metrics
+        self.metrics = metrics or MetricsRegistry()
+        # Pushing to the event streams and counting sales subscribe to the
+        # engine's events. Both are cheap and non-blocking, so they run
+        # synchronously after the locks are released.
+        self.bus.subscribe(self._push_to_streams, name="event-streams")
+        self.bus.subscribe(self._count_metrics, name="metrics")
+    
+    def _push_to_streams(self, event):
+        if isinstance(event, ProductDispensed):
+            self.events.publish({'type': 'stock', 'code': event.code, 'quantity': event.remaining})
+        # Reading the balance back costs a lookup, so only when someone listens
+        if event.session is not None and self.events:
+            self.events.publish({'type': 'balance', 'balance': self.get_balance(event.session)},
+                                event.session)
+    
+    def _count_metrics(self, event):
+        if isinstance(event, ProductDispensed):
+            self.metrics.inc('vending_sales_total')
+    
+    def _pull(self):
+        """Copy shared stock, totals and versions into this worker's machine; caller holds the shared lock"""
+        self.storage.pull(self)
+        for slot, code in enumerate(self.products.codes):
+            self.product_versions[code] = self.shared.get_slot_version(slot)
+        self.inventory_version = self.shared.version
+        self.version = self.shared.ledger_count
+    
+    def refresh(self, ledger=True):
+        """Bring the local view up to date with the shared inventory"""
+        if self.shared is None:
+            return
+        with self.shared.lock():
+            self._pull()
+            if ledger:
+                lines = self.shared.ledger()
+                first = self.version - len(lines) + 1
+                with self._totals_lock:
+                    self.transactions.reset(lines)
+                    self.change_log = deque(enumerate(lines, first), maxlen=CHANGE_LOG_SIZE)
+    
+    def current_version(self):
+        """State version, read without pulling the rest of the shared block"""
+        if self.shared is None:
+            return self.version
+        return self.shared.ledger_count
+    
+    def credit(self, session=None):
+        """Credit of one customer session (stored as integer cents)"""
+        return Money(self.balances.get(DEFAULT_SESSION if session is None else session, 0))
+    
+    def set_credit(self, session, amount):
+        session = DEFAULT_SESSION if session is None else session
+        if amount.cents:
+            self.balances.set(session, amount.cents)
+        else:
+            self.balances.pop(session, None)
+    
+    def get_balance(self, session_id=DEFAULT_SESSION):
+        """Credit available to one customer session"""
+        if self.shared is None:
+            return self.credit(session_id)
+        with self.shared.lock():
+            return self.credit(session_id)
+    
+    def _reclaim_credit(self, session_id, cents):
+        amount = Money(cents)
+        with self._totals_lock:
+            self.reclaimed_credit += amount
+        self.log_transaction(f"Unclaimed credit reclaimed: ${amount:.2f}")
+    
+    @synced
+    def insert_cash(self, amount, session=DEFAULT_SESSION):
+        """Insert cash for one customer"""
+        return super().insert_cash(amount, session)
+    
+    @synced
+    def process_credit_card(self, amount, card_info=None, session=DEFAULT_SESSION):
+        """Add a card payment to one customer's credit"""
+        return super().process_credit_card(amount, card_info, session)
+    
+    @synced
+    def purchase_product(self, product_code, session=DEFAULT_SESSION):
+        """Purchase for one customer; what happens to the rest of the credit follows balance_policy
         
-        # Process purchase
-        product['quantity'] -= 1
-        # LOGIC FIX: Do NOT reset balance to 0. Just subtract the price.
-        self.balance -= product['price']
-        self.total_sales += product['price']
+        The result also holds the slot's 'quantity' and the customer's
+        'balance' right after the sale.
+        """
+        if product_code not in self.products:
+            return super().purchase_product(product_code, session)
         
-        self.log_transaction(f"Purchased {product['name']} for ${product['price']:.2f}")
-        return True, {
-            'product': product['name'],
-            'price': product['price'],
-            'new_balance': self.balance,
-            'message': f"Dispensed {product['name']}!"
-        }
+        result = super().purchase_product(product_code, session)
+        result['quantity'] = self.products[product_code].quantity
+        result['balance'] = self.credit(session)
+        if result['reason'] in REFUSAL_METRICS:
+            self.metrics.inc(REFUSAL_METRICS[result['reason']])
+        return result
+    
+    @synced
+    def cancel_transaction(self, session=DEFAULT_SESSION):
+        """Cancel and return one customer's credit"""
+        return super().cancel_transaction(session)
+    
+    @synced
+    def restock(self, product_code, count):
+        """Add stock under the machine lock, so no sale in flight writes over it"""
+        return super().restock(product_code, count)
+    
+    @synced
+    def run_batch(self, operations, session_id=DEFAULT_SESSION):
+        """Apply an ordered list of operations with no other command interleaving
+        
+        The machine lock is taken once for the whole batch. Each operation
+        still succeeds or fails on its own.
+        """
+        return [self._run_operation(op, session_id) for op in operations]
     
-    def cancel_transaction(self):
-        """Cancel and return balance"""
-        change = self.balance
-        self.balance = 0.0
-        if change > 0:
-            self.log_transaction(f"Change dispensed: ${change:.2f}")
-        return change
+    def _run_operation(self, op, session_id):
+        kind = op.get('op')
+        if kind in ('add-money', 'credit-card'):
+            amount = parse_amount(op.get('amount', 0))
+            if amount is None:
+                result = {'success': False, 'message': "Invalid amount"}
+            elif kind == 'add-money':
+                result = {'success': True, 'message': self.insert_cash(amount, session_id)}
+            else:
+                result = {'success': True, 'message': self.process_credit_card(amount, session=session_id)}
+        elif kind == 'purchase':
+            outcome = self.purchase_product(op.get('product_code', ''), session_id)
+            result = {'success': outcome['success'], 'message': outcome['message']}
+            if outcome['success']:
+                result['product_name'] = outcome['product'].name
+                result['quantity'] = outcome['quantity']
+        elif kind == 'cancel':
+            result = {'success': True, 'change': self.cancel_transaction(session_id)}
+        else:
+            result = {'success': False, 'message': f"Unknown operation: {kind}"}
+        result['op'] = kind
+        result['balance'] = self.get_balance(session_id)
+        return result
     
-    def log_transaction(self, message):
-        """Log transaction"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.transactions.append(f"{timestamp}: {message}")
+    def emit(self, event):
+        """Apply and store an event under the totals lock, stamping the versions it changed, then publish it"""
+        with self._totals_lock:
+            event.apply(self)
+            self.storage.record(self, event)
+            code = getattr(event, 'code', None)
+            if code is not None:
+                self.product_versions[code] = self.inventory_version = self.version
+                if self.shared is not None:
+                    self.shared.set_slot_version(self.products[code].slot, self.version)
+                    self.shared.set_version(self.version)
+        self.bus.publish(event)
     
-    def get_state(self):
+    def log_transaction(self, kind, amount=Money(), product=None, timestamp=None):
+        """Add an entry to the history and the change log; each one is a new state version"""
+        with self._totals_lock:
+            timestamp = super().log_transaction(kind, amount, product, timestamp)
+            line = self.transactions[-1]
+            if self.shared is not None:
+                self.shared.append_ledger(line)
+                self.version = self.shared.ledger_count
+            else:
+                self.version += 1
+            self.change_log.append((self.version, line))
+        return timestamp
+    
+    def get_state(self, session_id=DEFAULT_SESSION):
         """Get current machine state"""
+        self.refresh()
         return {
-            'balance': self.balance,
+            'balance': self.get_balance(session_id),
             'total_sales': self.total_sales,
-            'products': self.products,
+            'products': {code: product_json(product) for code, product in self.products.items()},
             'transactions': self.transactions[-10:]  # Last 10
         }
-
-# Initialize vending machine
-vm = WebVendingMachine()
-
-# HTML template for web interface - CYBERPUNK GOLD EDITION
-HTML_TEMPLATE = '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Vendor Pro 2026 | Premium Access</title>
-    <style>
-        :root {
-            --gold: #FFD700;
-            --gold-dim: #b39700;
-            --gold-glow: rgba(255, 215, 0, 0.4);
-            --bg: #050510;
-            --glass: rgba(255, 255, 255, 0.03);
-            --text-main: #ffffff;
-            --success: #00ff88;
-            --error: #ff4444;
-        }
-
-        * {
-            box-sizing: border-box;
-            transition: all 0.2s ease;
-        }
-
-        body { 
-            background: radial-gradient(circle at center, #101025 0%, var(--bg) 100%);
-            color: var(--text-main); 
-            font-family: 'Segoe UI', system-ui, sans-serif; 
-            margin: 0; 
-            padding: 20px; 
-            min-height: 100vh;
-            display: flex; 
-            flex-direction: column; 
-            align-items: center;
-        }
-
-        /* Animated Header */
-        h1 { 
-            font-size: 2.5rem; 
-            letter-spacing: 5px; 
-            margin-bottom: 30px;
-            background: linear-gradient(to right, #fff, var(--gold), #fff);
-            -webkit-background-clip: text; 
-            -webkit-text-fill-color: transparent;
-            text-transform: uppercase; 
-            text-shadow: 0 0 20px var(--gold-glow);
-            text-align: center;
-        }
-
-        /* Main Glass Dashboard */
-        .dashboard {
-            display: flex;
-            gap: 30px;
-            background: var(--glass);
-            backdrop-filter: blur(15px);
-            border: 1px solid rgba(255,215,0,0.2);
-            border-radius: 24px;
-            padding: 40px;
-            width: 100%; 
-            max-width: 1400px;
-            box-shadow: 0 20px 50px rgba(0,0,0,0.5);
-        }
-
-        .panel-left {
-            flex: 1;
-            max-width: 350px;
-            display: flex;
-            flex-direction: column;
-            gap: 20px;
-        }
-
-        .panel-right {
-            flex: 3;
-        }
-
-        /* Credit Display */
-        .credit-box {
-            background: rgba(0,0,0,0.4);
-            border: 2px solid var(--gold);
-            border-radius: 16px;
-            padding: 20px;
-            text-align: center;
-            box-shadow: 0 0 20px rgba(255, 215, 0, 0.1);
-        }
-        
-        .credit-label { font-size: 0.8rem; text-transform: uppercase; color: #aaa; letter-spacing: 2px; }
-        .credit-amount { 
-            font-size: 3rem; 
-            font-weight: 800; 
-            color: var(--gold); 
-            margin: 10px 0; 
-            font-family: 'Consolas', monospace;
-            text-shadow: 0 0 10px var(--gold-glow);
-        }
-
-        /* Control Buttons */
-        .btn-group {
-            display: grid;
-            grid-template-columns: repeat(2, 1fr);
-            gap: 10px;
-        }
-
-        .btn { 
-            background: rgba(255, 215, 0, 0.1); 
-            border: 1px solid var(--gold); 
-            color: var(--gold);
-            padding: 15px; 
-            border-radius: 12px; 
-            font-weight: bold; 
-            cursor: pointer;
-            text-transform: uppercase; 
-            font-size: 0.9rem; 
-            letter-spacing: 1px;
-            position: relative;
-            overflow: hidden;
-        }
-        
-        .btn:hover { 
-            background: var(--gold); 
-            color: black; 
-            box-shadow: 0 0 20px var(--gold-glow); 
-            transform: translateY(-2px); 
-        }
-
-        .btn:active {
-            transform: scale(0.98);
-        }
-
-        .btn:disabled {
-            opacity: 0.5;
-            cursor: not-allowed;
-        }
-
-        .btn-full { grid-column: span 2; }
-        
-        .btn-refund { 
-            border-color: #ff4444; 
-            color: #ff4444; 
-            background: rgba(255, 68, 68, 0.1); 
-        }
-        .btn-refund:hover { 
-            background: #ff4444; 
-            color: white; 
-            box-shadow: 0 0 20px rgba(255,68,68,0.4); 
-        }
-
-        .btn-card {
-            border-color: #70a1ff;
-            color: #70a1ff;
-            background: rgba(112, 161, 255, 0.1);
-        }
-        .btn-card:hover {
-            background: #70a1ff;
-            color: black;
-            box-shadow: 0 0 20px rgba(112, 161, 255, 0.4);
-        }
-
-        /* Product Grid */
-        .grid { 
-            display: grid; 
-            grid-template-columns: repeat(auto-fill, minmax(160px, 1fr)); 
-            gap: 20px;
-        }
-
-        .item-card {
-            background: rgba(255,255,255,0.03);
-            border: 1px solid rgba(255,255,255,0.1);
-            border-radius: 16px;
-            padding: 20px;
-            display: flex; 
-            flex-direction: column; 
-            align-items: center;
-            cursor: pointer;
-            position: relative;
-        }
-
-        .item-card:hover:not(.disabled) {
-            border-color: var(--gold);
-            background: rgba(255, 215, 0, 0.05);
-            transform: scale(1.05);
-            box-shadow: 0 0 25px rgba(255,215,0,0.15);
-        }
-
-        .item-card.disabled {
-            opacity: 0.5;
-            cursor: not-allowed;
-            pointer-events: none;
-        }
-
-        .item-code {
-            position: absolute;
-            top: 10px;
-            left: 10px;
-            font-size: 0.7rem;
-            color: #666;
-            font-weight: bold;
-        }
-
-        .item-name { 
-            font-weight: 700; 
-            font-size: 1rem; 
-            margin: 15px 0 10px 0; 
-            text-align: center; 
-            height: 48px;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-        }
-        
-        .item-price { 
-            color: var(--gold); 
-            font-weight: bold; 
-            font-size: 1.2rem; 
-        }
-        
-        .item-stock { 
-            font-size: 0.7rem; 
-            color: #888; 
-            margin-top: 10px; 
-            text-transform: uppercase; 
-            letter-spacing: 1px; 
-        }
-
-        /* Toast Notifications */
-        .messages {
-            position: fixed;
-            top: 20px;
-            right: 20px;
-            z-index: 1000;
-            display: flex;
-            flex-direction: column;
-            gap: 10px;
-        }
-        
-        .message {
-            background: rgba(0,0,0,0.9);
-            color: white;
-            padding: 15px 25px;
-            border-radius: 10px;
-            border-left: 5px solid var(--gold);
-            animation: slideIn 0.4s cubic-bezier(0.175, 0.885, 0.32, 1.275);
-            box-shadow: 0 10px 30px rgba(0,0,0,0.5);
-            min-width: 300px;
-        }
-        
-        .message.success { border-left-color: var(--success); }
-        .message.error { border-left-color: var(--error); }
-
-        @keyframes slideIn {
-            from { transform: translateX(120%); opacity: 0; }
-            to { transform: translateX(0); opacity: 1; }
-        }
-
-        @media (max-width: 900px) {
-            .dashboard { flex-direction: column; }
-            .panel-left { max-width: 100%; }
-        }
+    
+    def get_changes(self, since=None, session_id=DEFAULT_SESSION):
+        """State changed after version `since`, or None if nothing changed
         
-        /* Terminal/Console Output for Status */
-        .status-terminal {
-            margin-top: 20px;
-            background: #000;
-            border: 1px solid #333;
-            border-radius: 8px;
-            padding: 10px;
-            font-family: 'Consolas', monospace;
-            color: var(--success);
-            font-size: 0.9rem;
-            height: 40px;
-            display: flex;
-            align-items: center;
-            overflow: hidden;
-            white-space: nowrap;
-        }
-    </style>
-</head>
-<body>
-    <h1>Vendor Pro 2026</h1>
-
-    <div class="dashboard">
-        <!-- LEFT CONTROL PANEL -->
-        <div class="panel-left">
-            <div class="credit-box">
-                <div class="credit-label">Available Credit</div>
-                <div class="credit-amount" id="creditAmount">${{ "%.2f"|format(vm.balance) }}</div>
-            </div>
-            
-            <div class="btn-group">
-                <button class="btn" id="btn-1">+ $1.00</button>
-                <button class="btn" id="btn-5">+ $5.00</button>
-                <button class="btn" id="btn-quarter">+ $0.25</button>
-                <button class="btn" id="btn-10">+ $10.00</button>
-                
-                <button class="btn btn-card btn-full" id="btn-card">
-                    💳 Swipe Card
-                </button>
-                
-                <button class="btn btn-refund btn-full" id="btn-refund">
-                    ↩ Eject Change
-                </button>
-            </div>
-            
-            <div class="status-terminal" id="statusBar">
-                > System Ready...
-            </div>
-        </div>
-
-        <!-- RIGHT PRODUCT PANEL -->
-        <div class="panel-right">
-            <div class="grid" id="productGrid">
-                {% for code, product in vm.products.items() %}
-                <div class="item-card {% if product.quantity <= 0 %}disabled{% endif %}" 
-                     data-code="{{ code }}"
-                     data-stock="{{ product.quantity }}">
-                    <span class="item-code">{{ code }}</span>
-                    <span class="item-name">{{ product.name }}</span>
-                    <span class="item-price">${{ "%.2f"|format(product.price) }}</span>
-                    <span class="item-stock">
-                        {% if product.quantity > 0 %}
-                            {{ product.quantity }} In Stock
-                        {% else %}
-                            SOLD OUT
-                        {% endif %}
-                    </span>
-                </div>
-                {% endfor %}
-            </div>
-        </div>
-    </div>
-    
-    <div class="messages" id="messages"></div>
-
-    <script>
-        // Wait for DOM to be fully loaded
-        document.addEventListener('DOMContentLoaded', function() {
-            console.log('Vendor Pro 2026 - Initializing...');
-            
-            // Attach event listeners to buttons
-            document.getElementById('btn-1').addEventListener('click', function() { addMoney(1.00); });
-            document.getElementById('btn-5').addEventListener('click', function() { addMoney(5.00); });
-            document.getElementById('btn-quarter').addEventListener('click', function() { addMoney(0.25); });
-            document.getElementById('btn-10').addEventListener('click', function() { addMoney(10.00); });
-            document.getElementById('btn-card').addEventListener('click', showCreditCard);
-            document.getElementById('btn-refund').addEventListener('click', ejectChange);
-            
-            // Attach click handlers to product cards
-            const productCards = document.querySelectorAll('.item-card');
-            productCards.forEach(card => {
-                card.addEventListener('click', function() {
-                    const code = this.getAttribute('data-code');
-                    const stock = parseInt(this.getAttribute('data-stock'));
-                    
-                    if (stock > 0) {
-                        purchaseProduct(code);
-                    }
-                });
-            });
-            
-            console.log('System ready!');
-        });
+        Products come from their last-change versions; transactions from the
+        bounded change log. Without `since`, or if it is older than the log
+        reaches back, 'full' is set and the client should replace rather
+        than merge. A `since` ahead of the machine (a version from before a
+        restart) gets a full answer too.
+        """
+        if since is not None:
+            current = self.current_version()
+            if since == current:
+                return None
+            if since > current:
+                since = None
+        self.refresh()
+        # log_transaction appends under _totals_lock from other threads
+        with self._totals_lock:
+            version = self.version
+            change_log = list(self.change_log)
+            product_versions = dict(self.product_versions)
+        oldest = change_log[0][0] if change_log else version + 1
+        full = since is None or since < oldest - 1
+        since = since or 0
+        return {
+            'version': version,
+            'full': full,
+            'balance': self.get_balance(session_id),
+            'total_sales': self.total_sales,
+            'products': {code: product_json(product) for code, product in self.products.items()
+                         if full or product_versions[code] > since},
+            'transactions': [line for line_version, line in change_log if line_version > since]
+        }
+
+# Request latency and machine counters for /metrics (per worker process)
+metrics = MetricsRegistry()
+METRIC_HELP = {
+    'vending_sales_total': 'Products sold.',
+    'vending_stockouts_total': 'Purchases refused because the slot was empty.',
+    'vending_insufficient_funds_total': 'Purchases refused because the balance was too low.',
+    'vending_total_sales_dollars': 'Revenue since the machine started.',
+    'vending_requests_in_flight': 'Requests currently being handled by this worker.',
+    'vending_requests_shed': 'Requests refused by admission control.',
+    'vending_event_subscribers': 'Open /api/events streams.',
+}
+
+# Initialize vending machine (set VENDING_SHARED_STATE to a shared memory
+# name to share one machine between all gunicorn workers)
+vm = WebVendingMachine(shared_name=os.environ.get('VENDING_SHARED_STATE'), metrics=metrics,
+                       history_dir=os.environ.get('VENDING_HISTORY_DIR'),
+                       balance_policy=os.environ.get('VENDING_BALANCE_POLICY', BALANCE_KEEP))
+
+
+def current_session_id():
+    """Id of the customer session behind this request, assigned on first visit"""
+    session_id = session.get('sid')
+    if session_id is None:
+        session_id = session['sid'] = uuid.uuid4().hex
+    return session_id
+
+
+# Page template (templates/index.html - CYBERPUNK GOLD EDITION), compiled
+# once at import instead of on every request
+INDEX_TEMPLATE = app.jinja_env.get_template('index.html')
+
+# Rendered pages keyed on (inventory version, balance). Each entry holds the
+# HTML, a precompressed gzip copy and its ETag, so a repeat page load is a
+# dictionary lookup.
+page_cache = TTLCache(max_entries=64)
+
+
+def render_index(balance):
+    """Return (html, gzipped_html, etag) for the main page"""
+    key = (vm.inventory_version, balance.cents)
+    page = page_cache.get(key)
+    if page is None:
+        html = INDEX_TEMPLATE.render(vm=vm, balance=balance).encode('utf-8')
+        page = (html, gzip.compress(html), f"{key[0]}-{key[1]:.2f}")
+        page_cache.set(key, page)
+    return page
+
+
+# "session path key" -> (request fingerprint, response body, status); in
+# shared mode every worker answers retries from the same shared entries
+if vm.shared is not None:
+    idempotency_cache = SharedReplyCache(vm.shared, capacity=IDEMPOTENCY_SHARED_ENTRIES,
+                                         ttl=IDEMPOTENCY_TTL_SECONDS)
+else:
+    idempotency_cache = TTLCache(max_entries=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL_SECONDS,
+                                 touch_on_get=False)
+# Striped so two copies of the same request in flight cannot both run
+idempotency_locks = [threading.Lock() for _ in range(IDEMPOTENCY_LOCK_STRIPES)]
+
+
+def idempotency_lock(cache_key):
+    """Lock held while a keyed request runs; the shared lock when workers share the machine"""
+    if vm.shared is not None:
+        return vm.shared.lock()
+    return idempotency_locks[hash(cache_key) % len(idempotency_locks)]
+
+
+def idempotent(view):
+    """Answer a retried request carrying the same Idempotency-Key from cache"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+            return jsonify({
+                'success': False,
+                'message': f'Idempotency-Key must be at most {MAX_IDEMPOTENCY_KEY_LENGTH} characters'
+            }), 400
         
-        function showMessage(text, type = 'info') {
-            const container = document.getElementById('messages');
-            const msg = document.createElement('div');
-            msg.className = 'message ' + type;
-            msg.textContent = text;
-            container.appendChild(msg);
+        cache_key = f"{current_session_id()} {request.path} {key}"
+        fingerprint = hashlib.blake2b(request.get_data(), digest_size=16).digest()
+        with idempotency_lock(cache_key):
+            cached = idempotency_cache.get(cache_key)
+            if cached is not None:
+                cached_fingerprint, body, status = cached
+                if cached_fingerprint != fingerprint:
+                    return jsonify({
+                        'success': False,
+                        'message': 'Idempotency-Key was already used for a different request'
+                    }), 422
+                response = app.response_class(body, status=status, mimetype='application/json')
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
             
-            setTimeout(() => {
-                msg.style.opacity = '0';
-                msg.style.transform = 'translateY(-20px)';
-                setTimeout(() => msg.remove(), 300);
-            }, 3000);
-        }
-        
-        function updateDisplay(balance) {
-            document.getElementById('creditAmount').textContent = '$' + balance.toFixed(2);
-        }
-        
-        function setStatus(text) {
-            document.getElementById('statusBar').textContent = '> ' + text;
-        }
+            response = make_response(view(*args, **kwargs))
+            idempotency_cache.set(cache_key, (fingerprint, response.get_data(), response.status_code))
+            return response
+    return wrapper
 
-        function addMoney(amount) {
-            console.log('Adding money:', amount);
-            
-            fetch('/api/add-money', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({ amount: amount })
-            })
-            .then(res => {
-                if (!res.ok) throw new Error('Network error');
-                return res.json();
-            })
-            .then(data => {
-                if (data.success) {
-                    updateDisplay(data.balance);
-                    showMessage('Accepted: $' + amount.toFixed(2), 'success');
-                    setStatus('Credit added. Balance: $' + data.balance.toFixed(2));
-                } else {
-                    showMessage(data.message, 'error');
-                }
-            })
-            .catch(error => {
-                console.error('Error:', error);
-                showMessage('Connection error. Please try again.', 'error');
-            });
-        }
-        
-        function purchaseProduct(code) {
-            console.log('Purchasing product:', code);
-            
-            fetch('/api/purchase', {
-                method: 'POST',
-                headers: {'Content-Type': 'application/json'},
-                body: JSON.stringify({ product_code: code })
-            })
-            .then(res => {
-                if (!res.ok) throw new Error('Network error');
-                return res.json();
-            })
-            .then(data => {
-                if (data.success) {
-                    updateDisplay(data.balance);
-                    showMessage('Dispensing ' + data.product_name + '...', 'success');
-                    setStatus('Dispensed ' + data.product_name + '. Remaining: $' + data.balance.toFixed(2));
-                    setTimeout(() => location.reload(), 1500);
-                } else {
-                    showMessage(data.message, 'error');
-                    setStatus('Error: ' + data.message);
-                }
-            })
-            .catch(error => {
-                console.error('Error:', error);
-                showMessage('Connection error. Please try again.', 'error');
-            });
-        }
-        
-        function ejectChange() {
-            console.log('Ejecting change...');
-            
-            fetch('/api/cancel', { method: 'POST' })
-            .then(res => {
-                if (!res.ok) throw new Error('Network error');
-                return res.json();
-            })
-            .then(data => {
-                updateDisplay(data.balance);
-                if (data.change > 0) {
-                    showMessage('Change dispensed: $' + data.change.toFixed(2), 'success');
-                    setStatus('Refunded $' + data.change.toFixed(2) + '. Thank you!');
-                } else {
-                    showMessage('No credit to refund.', 'info');
-                }
-            })
-            .catch(error => {
-                console.error('Error:', error);
-                showMessage('Connection error. Please try again.', 'error');
-            });
-        }
-        
-        function showCreditCard() {
-            const amount = prompt('💳 SWIPE CARD - Enter amount to authorize ($):', '10.00');
-            if (amount && !isNaN(amount) && parseFloat(amount) > 0) {
-                console.log('Processing card payment:', amount);
-                
-                fetch('/api/credit-card', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({ amount: parseFloat(amount) })
-                })
-                .then(res => {
-                    if (!res.ok) throw new Error('Network error');
-                    return res.json();
-                })
-                .then(data => {
-                    if (data.success) {
-                        updateDisplay(data.balance);
-                        showMessage('Card Authorized!', 'success');
-                        setStatus('Card accepted. Balance: $' + data.balance.toFixed(2));
-                    }
-                })
-                .catch(error => {
-                    console.error('Error:', error);
-                    showMessage('Card processing failed. Please try again.', 'error');
-                });
-            }
-        }
-    </script>
-</body>
-</html>
-'''
 
 @app.route('/')
 def index():
     """Main page"""
-    return render_template_string(HTML_TEMPLATE, vm=vm)
+    vm.refresh(ledger=False)
+    html, gzipped, etag = render_index(vm.get_balance(current_session_id()))
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif request.accept_encodings.quality('gzip') > 0:
+        response = Response(gzipped, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(html, mimetype='text/html')
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
 
 @app.route('/api/add-money', methods=['POST'])
 def api_add_money():
     """API to add money"""
     data = request.json
-    amount = float(data.get('amount', 0))
+    amount = parse_amount(data.get('amount', 0))
+    session_id = current_session_id()
     
-    success, message = vm.insert_cash(amount)
+    if amount is None:
+        success, message = False, "Invalid amount"
+    else:
+        success, message = True, vm.insert_cash(amount, session_id)
     
     return jsonify({
         'success': success,
         'message': message,
-        'balance': vm.balance
+        'balance': vm.get_balance(session_id)
     })
 
 @app.route('/api/purchase', methods=['POST'])
+@idempotent
 def api_purchase():
     """API to purchase product"""
     data = request.json
     product_code = data.get('product_code', '')
+    session_id = current_session_id()
     
-    success, result = vm.purchase(product_code)
+    result = vm.purchase_product(product_code, session_id)
     
-    if success:
+    if result['success']:
         return jsonify({
             'success': True,
             'message': result['message'],
-            'product_name': result['product'],
-            'balance': result['new_balance']
+            'product_name': result['product'].name,
+            'product_code': product_code,
+            'quantity': result['quantity'],
+            'balance': result['balance'],
+            'change': result['change']
         })
     else:
         return jsonify({
             'success': False,
-            'message': result,
-            'balance': vm.balance
+            'message': result['message'],
+            'balance': vm.get_balance(session_id)
         })
 
 @app.route('/api/cancel', methods=['POST'])
 def api_cancel():
     """API to cancel transaction"""
-    change = vm.cancel_transaction()
+    session_id = current_session_id()
+    change = vm.cancel_transaction(session_id)
     
     return jsonify({
         'success': True,
         'change': change,
-        'balance': vm.balance
+        'balance': vm.get_balance(session_id)
     })
 
 @app.route('/api/credit-card', methods=['POST'])
+@idempotent
 def api_credit_card():
     """API for credit card payment"""
     data = request.json
-    amount = float(data.get('amount', 0))
+    amount = parse_amount(data.get('amount', 0))
+    session_id = current_session_id()
     
-    if amount <= 0:
+    if amount is None:
         return jsonify({
             'success': False,
-            'message': 'Invalid amount'
+            'message': "Invalid amount"
         })
     
-    vm.balance += amount
-    vm.log_transaction(f"Credit card payment: ${amount:.2f}")
-    
+    message = vm.process_credit_card(amount, session=session_id)
     return jsonify({
         'success': True,
-        'message': f'Card payment of ${amount:.2f} processed',
-        'balance': vm.balance
+        'message': message,
+        'balance': vm.get_balance(session_id)
+    })
+
+
+# Admission control: purchase/cancel traffic is always let in, everything
+# else is shed as the worker fills up, and every client is rate limited
+# per priority class with its own token bucket
+ROUTE_PRIORITIES = {
+    'api_purchase': PRIORITY_CRITICAL,
+    'api_cancel': PRIORITY_CRITICAL,
+    'api_credit_card': PRIORITY_CRITICAL,
+    'api_batch': PRIORITY_CRITICAL,
+    'api_admin': PRIORITY_LOW,
+    'metrics_endpoint': PRIORITY_LOW,
+    'api_admin_profile': PRIORITY_LOW,
+}
+admission = AdmissionController(max_in_flight=WORKER_THREADS)
+rate_limiters = {
+    PRIORITY_CRITICAL: TokenBucketLimiter(rate=10, burst=20),
+    PRIORITY_NORMAL: TokenBucketLimiter(rate=20, burst=40),
+    PRIORITY_LOW: TokenBucketLimiter(rate=1, burst=5),
+}
+
+
+def too_many_requests(retry_after):
+    response = jsonify({
+        'success': False,
+        'message': 'Too many requests. Please slow down.'
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+@app.before_request
+def start_timer():
+    # Registered first so shed and rate limited requests are timed too
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    started = g.get('started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_request(route, response.status_code, time.perf_counter() - started)
+    return response
+
+
+@app.before_request
+def admit_request():
+    """Shed or rate limit the request before it reaches a route"""
+    priority = ROUTE_PRIORITIES.get(request.endpoint, PRIORITY_NORMAL)
+    if not admission.try_enter(priority):
+        return too_many_requests(1)
+    g.admitted = True
+    wait = rate_limiters[priority].acquire(request.remote_addr or 'unknown')
+    if wait:
+        return too_many_requests(wait)
+
+
+@app.teardown_request
+def release_request(exc):
+    if g.pop('admitted', False):
+        admission.leave()
+
+
+def format_event(event):
+    """Encode an event dict as one Server-Sent Events message"""
+    return f"event: {event['type']}\ndata: {app.json.dumps(event)}\n\n"
+
+
+# Open /api/events streams in this worker
+event_streams = 0
+event_streams_lock = threading.Lock()
+
+
+def release_event_stream():
+    global event_streams
+    with event_streams_lock:
+        event_streams -= 1
+
+
+@app.route('/api/events')
+def api_events():
+    """Server-Sent Events stream of stock and balance changes"""
+    global event_streams
+    with event_streams_lock:
+        full = event_streams >= MAX_EVENT_STREAMS
+        if not full:
+            event_streams += 1
+    if full:
+        # EventSource gives up on a non-200 answer; the page then polls
+        response = jsonify({'success': False, 'message': 'Too many event streams',
+                            'poll': '/api/state', 'poll_seconds': EVENT_POLL_SECONDS})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(EVENT_STREAM_SECONDS)
+        return response
+    session_id = current_session_id()
+    subscription = vm.events.subscribe(session_id)
+    
+    def stream():
+        yield "retry: 1000\n\n"
+        # Other workers' sales only show up in the shared block, so in
+        # shared mode poll its version every second and send what moved
+        poll = 1.0 if vm.shared is not None else EVENT_KEEPALIVE_SECONDS
+        known = dict(zip(vm.products.codes, vm.products.quantities))
+        version = vm.inventory_version
+        deadline = time.monotonic() + EVENT_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            event = subscription.get(timeout=min(poll, max(deadline - time.monotonic(), 0)))
+            if subscription.overflowed:
+                yield format_event({'type': 'resync'})
+                return
+            if event is not None:
+                if event['type'] == 'stock':
+                    known[event['code']] = event['quantity']
+                yield format_event(event)
+                continue
+            if vm.shared is not None:
+                vm.refresh(ledger=False)
+                if vm.inventory_version != version:
+                    version = vm.inventory_version
+                    for code, quantity in zip(vm.products.codes, vm.products.quantities):
+                        if known[code] != quantity:
+                            known[code] = quantity
+                            yield format_event({'type': 'stock', 'code': code,
+                                                'quantity': quantity})
+                    continue
+            yield ": keepalive\n\n"
+    
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    
+    def close():
+        vm.events.unsubscribe(subscription)
+        release_event_stream()
+    
+    # Runs even if the stream is closed before it was ever iterated (HEAD
+    # requests, clients gone before the first byte)
+    response.call_on_close(close)
+    return response
+
+@app.route('/api/state', methods=['GET'])
+def api_state():
+    """Delta sync for polling clients: only what changed since ?since=<version>"""
+    since = request.args.get('since', type=int)
+    changes = vm.get_changes(since, current_session_id())
+    if changes is None:
+        return Response(status=304)
+    return jsonify(changes)
+
+def batch_operation_error(op):
+    """Why a batch operation cannot be run, or None if it is well formed"""
+    if not isinstance(op, dict):
+        return "must be an object"
+    kind = op.get('op')
+    if kind in ('add-money', 'credit-card'):
+        amount = op.get('amount', 0)
+        if isinstance(amount, bool) or not isinstance(amount, (int, float, str)):
+            return "amount must be a number"
+        try:
+            amount = float(amount)
+        except ValueError:
+            return "amount must be a number"
+        if not math.isfinite(amount):
+            return "amount must be a finite number"
+        if amount > float(MAX_AMOUNT):
+            return f"amount must be at most ${MAX_AMOUNT:.2f}"
+    elif kind == 'purchase' and not isinstance(op.get('product_code', ''), str):
+        return "product_code must be a string"
+    return None
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    """API to apply several add-money/purchase/cancel/credit-card operations at once"""
+    data = request.json or {}
+    # A body that is not a JSON object has no operations list to run
+    operations = data.get('operations', []) if isinstance(data, dict) else None
+    if not isinstance(operations, list) or len(operations) > MAX_BATCH_OPERATIONS:
+        return jsonify({
+            'success': False,
+            'message': f'Send a list of at most {MAX_BATCH_OPERATIONS} operations'
+        }), 400
+    # Reject a malformed batch before any of it is applied
+    for index, op in enumerate(operations):
+        problem = batch_operation_error(op)
+        if problem:
+            return jsonify({
+                'success': False,
+                'message': f'Operation {index}: {problem}'
+            }), 400
+    session_id = current_session_id()
+    
+    results = vm.run_batch(operations, session_id)
+    
+    return jsonify({
+        'success': all(result['success'] for result in results),
+        'results': results,
+        'balance': vm.get_balance(session_id)
     })
 
 @app.route('/api/admin', methods=['GET'])
 def api_admin():
     """API for admin info"""
+    vm.refresh()
     return jsonify({
         'total_sales': vm.total_sales,
+        'reclaimed_credit': vm.reclaimed_credit,
         'total_products': len(vm.products),
         'transactions': vm.transactions[-5:]
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    body = metrics.render({
+        'vending_total_sales_dollars': float(vm.total_sales),
+        'vending_requests_in_flight': admission.in_flight,
+        'vending_requests_shed': admission.shed,
+        'vending_event_subscribers': len(vm.events),
+    }, METRIC_HELP)
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+def require_admin(view):
+    """Refuse the request unless it carries the configured admin token"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({'success': False, 'message': 'Admin token required'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/api/admin/profile', methods=['POST'])
+@require_admin
+def api_admin_profile():
+    """Sample every thread's stack for ?seconds=N and return collapsed stacks for a flamegraph"""
+    seconds = request.args.get('seconds', 5, type=float)
+    interval = request.args.get('interval', 0.01, type=float)
+    # nan slips through min/max clamping and inf never finishes; either would
+    # hold the profile lock for good
+    if not (math.isfinite(seconds) and math.isfinite(interval)):
+        return jsonify({'success': False, 'message': 'seconds and interval must be finite numbers'}), 400
+    seconds = min(max(seconds, 0), MAX_PROFILE_SECONDS)
+    interval = max(interval, MIN_PROFILE_INTERVAL)
+    sampler = profiler.profile(seconds, interval)
+    if sampler is None:
+        return jsonify({'success': False, 'message': 'A profile is already running'}), 409
+    return Response(sampler.collapsed(), mimetype='text/plain',
+                    headers={'X-Profile-Samples': str(sampler.samples)})
+
+# kill -USR2 <worker pid> profiles that worker for VENDING_PROFILE_SIGNAL
+# seconds and writes the collapsed stacks to the temp directory. Off unless
+# the variable is set; the handler only starts the sampling thread.
+PROFILE_SIGNAL_SECONDS = float(os.environ.get('VENDING_PROFILE_SIGNAL', 0))
+if math.isfinite(PROFILE_SIGNAL_SECONDS) and PROFILE_SIGNAL_SECONDS > 0 and hasattr(signal, 'SIGUSR2'):
+    try:
+        signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.profile_to_file(
+            min(PROFILE_SIGNAL_SECONDS, MAX_PROFILE_SECONDS)))
+    except ValueError:   # not imported on the main thread
+        print("Profiler signal handler not installed: not on the main thread")
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
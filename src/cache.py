@@ -0,0 +1,92 @@
+﻿"""
+cache.py - Bounded in-memory key/value store with LRU eviction and TTL expiry
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """Mapping capped at max_entries that drops the least recently used entry when full
+
+    Entries also expire ttl seconds after they were last touched. Because
+    every touch moves an entry to the back, the front of the ordering is
+    always the stalest entry, so expiry and eviction are both O(1) per
+    removed entry. With touch_on_get=False reads do not extend an entry's
+    life, which gives a fixed lifetime from the last write.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = None, on_evict=None,
+                 touch_on_get: bool = True, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.touch_on_get = touch_on_get
+        self.clock = clock
+        self._data = OrderedDict()    # key -> (value, touched_at)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        evicted = []
+        with self._lock:
+            now = self.clock()
+            self._expire(now, evicted)
+            entry = self._data.get(key)
+            if entry is None:
+                value = default
+            else:
+                value = entry[0]
+                if self.touch_on_get:
+                    self._data[key] = (value, now)
+                    self._data.move_to_end(key)
+        self._notify(evicted)
+        return value
+
+    def set(self, key, value):
+        evicted = []
+        with self._lock:
+            now = self.clock()
+            self._expire(now, evicted)
+            self._data[key] = (value, now)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                old_key, (old_value, _) = self._data.popitem(last=False)
+                evicted.append((old_key, old_value))
+        self._notify(evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def purge_expired(self):
+        """Drop every expired entry now instead of waiting for the next access"""
+        evicted = []
+        with self._lock:
+            self._expire(self.clock(), evicted)
+        self._notify(evicted)
+        return len(evicted)
+
+    def _expire(self, now, evicted):
+        if self.ttl is None:
+            return
+        while self._data:
+            key, (value, touched_at) = next(iter(self._data.items()))
+            if now - touched_at < self.ttl:
+                break
+            del self._data[key]
+            evicted.append((key, value))
+
+    def _notify(self, evicted):
+        # Callbacks run outside the lock so they may use the cache themselves
+        if self.on_evict is not None:
+            for key, value in evicted:
+                self.on_evict(key, value)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
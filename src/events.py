@@ -0,0 +1,203 @@
+﻿"""
+events.py - Fan-out of machine change events to live subscribers
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import inspect
+import queue
+import threading
+
+# How an EventBus subscriber is called
+DELIVERY_SYNC = "sync"          # in the publishing thread, before publish() returns
+DELIVERY_THREAD = "thread"      # on the bus's worker pool, in publish order per subscriber
+DELIVERY_ASYNCIO = "asyncio"    # on the subscriber's event loop; coroutine handlers are awaited
+DELIVERY_MODES = (DELIVERY_SYNC, DELIVERY_THREAD, DELIVERY_ASYNCIO)
+
+
+class Subscription:
+    """One subscriber's bounded queue of pending events"""
+
+    def __init__(self, session_id=None, max_queue: int = 256):
+        self.session_id = session_id
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.overflowed = False   # events were dropped; the subscriber must resync
+
+    def put(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout: float = None):
+        """Next event, or None if nothing arrived within timeout"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broadcaster:
+    """Publishes small event dicts to every subscriber, or only to one session's
+
+    Publishing never blocks: a subscriber that falls max_queue events behind
+    is flagged as overflowed instead of slowing the publisher down.
+    """
+
+    def __init__(self, max_queue: int = 256):
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, session_id=None):
+        subscription = Subscription(session_id, self.max_queue)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event: dict, session_id=None):
+        if not self._subscribers:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            if session_id is None or subscription.session_id == session_id:
+                subscription.put(event)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+
+class BusSubscription:
+    """One EventBus subscriber and its bounded queue of events not yet delivered"""
+
+    def __init__(self, bus, handler, mode: str, max_queue: int, loop=None, name: str = None):
+        self.bus = bus
+        self.handler = handler
+        self.mode = mode
+        self.max_queue = max_queue
+        self.loop = loop
+        self.name = name or getattr(handler, '__qualname__', repr(handler))
+        self.delivered = 0
+        self.dropped = 0      # events refused because the queue was full
+        self.failed = 0       # events the handler raised on
+        self._pending = deque()
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def offer(self, event):
+        if self.mode == DELIVERY_SYNC:
+            self._call(event)
+            return
+        with self._lock:
+            if len(self._pending) >= self.max_queue:
+                self.dropped += 1
+                return
+            self._pending.append(event)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        if self.mode == DELIVERY_THREAD:
+            self.bus._executor().submit(self._drain)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.create_task, self._drain_async())
+
+    def _next(self):
+        with self._lock:
+            if not self._pending:
+                self._scheduled = False
+                return None
+            return self._pending.popleft()
+
+    def _drain(self):
+        # Only one drain per subscription runs at a time, which keeps its events in order
+        event = self._next()
+        while event is not None:
+            self._call(event)
+            event = self._next()
+
+    async def _drain_async(self):
+        event = self._next()
+        while event is not None:
+            try:
+                result = self.handler(event)
+                if inspect.isawaitable(result):
+                    await result
+                self.delivered += 1
+            except Exception as e:
+                self._failed(event, e)
+            event = self._next()
+
+    def _call(self, event):
+        try:
+            self.handler(event)
+            self.delivered += 1
+        except Exception as e:
+            self._failed(event, e)
+
+    def _failed(self, event, error):
+        self.failed += 1
+        print(f"Event subscriber {self.name} failed on {type(event).__name__}: {error}")
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class EventBus:
+    """In-process publish/subscribe for machine events
+
+    Side effects (persistence, metrics, UI refresh, alerts) subscribe here
+    instead of running inline where the event happens. Subscribers choose
+    how they are called (DELIVERY_MODES). Thread and asyncio subscribers
+    each get a queue of at most max_queue events: publishing only appends
+    to it, and when it is full the event is dropped for that subscriber
+    and counted, so a slow subscriber never holds up the publisher. A
+    handler that raises is reported and counted without affecting the
+    others.
+    """
+
+    def __init__(self, max_queue: int = 1024, workers: int = 4):
+        self.max_queue = max_queue
+        self.workers = workers
+        self._subscriptions = ()    # replaced, never mutated, so publish() needs no lock
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def subscribe(self, handler, mode: str = DELIVERY_SYNC, max_queue: int = None, loop=None,
+                  name: str = None):
+        if mode not in DELIVERY_MODES:
+            raise ValueError(f"Unknown delivery mode: {mode}")
+        if mode == DELIVERY_ASYNCIO and loop is None:
+            raise ValueError("asyncio delivery needs the subscriber's event loop")
+        subscription = BusSubscription(self, handler, mode, max_queue or self.max_queue, loop, name)
+        with self._lock:
+            self._subscriptions += (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription: BusSubscription):
+        with self._lock:
+            self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+
+    def publish(self, event):
+        for subscription in self._subscriptions:
+            subscription.offer(event)
+
+    def _executor(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="event-bus")
+        return self._pool
+
+    def close(self):
+        """Wait for queued thread deliveries to finish and stop the worker pool"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def __len__(self):
+        return len(self._subscriptions)
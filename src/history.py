@@ -0,0 +1,351 @@
+﻿"""
+history.py - Compact, queryable transaction history with lazy formatting
+"""
+
+from array import array
+from datetime import datetime
+from enum import IntEnum
+from functools import lru_cache
+import gzip
+import json
+import os
+from pathlib import Path
+import threading
+import time
+
+try:
+    from .money import Money
+except ImportError:  # imported as a top-level module from inside src/
+    from money import Money
+
+
+class TransactionType(IntEnum):
+    CASH = 1
+    CARD = 2
+    PURCHASE = 3
+    CANCEL = 4
+    NOTE = 5    # free-form message, e.g. a history line loaded from an old snapshot
+
+
+MESSAGES = {
+    TransactionType.CASH: "Cash inserted: ${amount:.2f}",
+    TransactionType.CARD: "Credit card payment: ${amount:.2f}",
+    TransactionType.PURCHASE: "Purchased {name} for ${amount:.2f}",
+    TransactionType.CANCEL: "Cancelled. Returned: ${amount:.2f}",
+}
+
+NO_SLOT = -1
+
+
+def format_timestamp(timestamp_ns: int):
+    return _format_seconds(timestamp_ns // 1_000_000_000)
+
+
+@lru_cache(maxsize=4096)
+def _format_seconds(seconds: int):
+    # Neighbouring entries mostly share a second, so displaying a page of
+    # history formats each distinct second once
+    return datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+
+@lru_cache(maxsize=4096)
+def parse_timestamp(text: str):
+    """Epoch nanoseconds of a 'YYYY-MM-DD HH:MM:SS' local time"""
+    return int(datetime.fromisoformat(text).timestamp()) * 1_000_000_000
+
+
+class TransactionRecord:
+    """One history entry; message and line are only formatted when asked for"""
+
+    __slots__ = ('timestamp_ns', 'kind', 'code', 'name', 'cents', 'note')
+
+    def __init__(self, timestamp_ns, kind, code, name, cents, note=None):
+        self.timestamp_ns = timestamp_ns
+        self.kind = kind
+        self.code = code
+        self.name = name
+        self.cents = cents
+        self.note = note
+
+    @property
+    def amount(self):
+        return Money(self.cents)
+
+    @property
+    def message(self):
+        if self.kind == TransactionType.NOTE:
+            return self.note
+        return MESSAGES[self.kind].format(name=self.name, amount=self.cents / 100)
+
+    @property
+    def line(self):
+        return f"{format_timestamp(self.timestamp_ns)}: {self.message}"
+
+    def __repr__(self):
+        return f"TransactionRecord({self.line!r})"
+
+
+class TransactionLog:
+    """Transaction history kept as parallel typed arrays
+
+    Each entry costs about 21 bytes (timestamp, type, slot, amount) instead
+    of a formatted string. Products are stored as an index into a slot table
+    that the log fills as it meets new codes. Indexing and slicing still
+    return the familiar 'timestamp: message' lines, so existing callers and
+    snapshots keep working; records() gives structured access for queries.
+
+    With a capacity the log is a bounded ring: once it holds more than
+    capacity entries the oldest segment_entries are dropped from memory,
+    after being written to a gzip-compressed segment file in spill_dir if
+    one is set (the raw array columns, so in this machine's byte order).
+    Memory stays constant while the segment files keep the full history,
+    which records() streams one segment at a time.
+
+    Entries are numbered from 0 for the life of the log; indexes below
+    first have left memory and are only reachable through records().
+    """
+
+    SEGMENT_PATTERN = "transactions-{first:020d}-{last:020d}.seg.gz"
+    COLUMNS = ('q', 'b', 'i', 'q')    # typecodes of timestamps, kinds, slots, cents
+
+    def __init__(self, lines=(), capacity: int = None, spill_dir: str = None,
+                 segment_entries: int = None):
+        self.capacity = capacity
+        self.spill_dir = spill_dir
+        self.segment_entries = segment_entries or max(1, (capacity or 0) // 4)
+        self.timestamps = array('q')    # epoch nanoseconds
+        self.kinds = array('b')
+        self.slots = array('i')         # index into codes/names, NO_SLOT if none
+        self.cents = array('q')
+        self.codes = []
+        self.names = []
+        self._slot_index = {}
+        self._notes = {}                # entry index -> message of NOTE entries
+        self.first = 0                  # index of the oldest entry still in memory
+        self.persisted = 0              # entries below this are already on disk
+        self._newest_on_disk = None     # last timestamp in the segment files when (re)loaded
+        self._lock = threading.RLock()
+        self.reset(lines)
+
+    def reset(self, lines=()):
+        """Replace what is in memory with preformatted lines, e.g. from a snapshot
+
+        Lines the segment files already hold are not spilled again when the
+        ring drops them (see mark_persisted).
+        """
+        with self._lock:
+            self.first += len(self.kinds)
+            self.persisted = self.first
+            del self.timestamps[:], self.kinds[:], self.slots[:], self.cents[:]
+            self._notes.clear()
+            self.mark_persisted()
+            for line in lines:
+                self.append_line(line)
+
+    def mark_persisted(self):
+        """After reloading state, skip entries the segment files on disk already hold
+
+        Whatever is no newer than the newest segment was written by an
+        earlier run (flush() on close), including entries a journal replay
+        appends again; anything after it is spilled as usual.
+        """
+        segments = self.segments()
+        with self._lock:
+            self._newest_on_disk = max(last for _, last, _ in segments) if segments else None
+            self._skip_persisted()
+
+    def _skip_persisted(self):
+        """Move persisted past in-memory entries no newer than the segment files"""
+        if self._newest_on_disk is None:
+            return
+        index = max(self.persisted, self.first) - self.first
+        while index < len(self.kinds) and self.timestamps[index] <= self._newest_on_disk:
+            index += 1
+        self.persisted = max(self.persisted, self.first + index)
+
+    def slot(self, code: str, name: str):
+        index = self._slot_index.get(code)
+        if index is None:
+            with self._lock:
+                index = self._slot_index[code] = len(self.codes)
+                self.codes.append(code)
+                self.names.append(name)
+        return index
+
+    def append(self, kind: TransactionType, cents: int, slot: int = NO_SLOT, timestamp_ns: int = None,
+               note: str = None):
+        with self._lock:
+            count = len(self.kinds)
+            try:
+                self.timestamps.append(time.time_ns() if timestamp_ns is None else timestamp_ns)
+                self.kinds.append(kind)
+                self.slots.append(slot)
+                self.cents.append(cents)
+            except (OverflowError, TypeError):
+                # A value the column cannot hold: take back the columns already
+                # appended so they stay aligned
+                del self.timestamps[count:], self.kinds[count:], self.slots[count:], self.cents[count:]
+                raise
+            if note is not None:
+                self._notes[self.first + count] = note
+            if self.capacity is not None and len(self.kinds) > self.capacity:
+                self._evict(min(self.segment_entries, len(self.kinds)))
+
+    def append_note(self, message: str, timestamp_ns: int = None):
+        self.append(TransactionType.NOTE, 0, NO_SLOT, timestamp_ns, message)
+
+    def append_line(self, line: str):
+        """Add a preformatted 'YYYY-MM-DD HH:MM:SS: message' line"""
+        timestamp, _, message = line.partition(': ')
+        try:
+            timestamp_ns = parse_timestamp(timestamp)
+        except ValueError:
+            timestamp_ns, message = 0, line
+        self.append_note(message, timestamp_ns)
+
+    def _evict(self, count: int):
+        """Drop the oldest count entries from memory, spilling the unpersisted ones"""
+        end = self.first + count
+        self._skip_persisted()
+        if self.spill_dir is not None and self.persisted < end:
+            self._write_segment(max(self.persisted, self.first), end)
+            self.persisted = end
+        del self.timestamps[:count], self.kinds[:count], self.slots[:count], self.cents[:count]
+        for index in [index for index in self._notes if index < end]:
+            del self._notes[index]
+        self.first = end
+
+    def flush(self):
+        """Write every in-memory entry not on disk yet to a segment (they also stay in memory)"""
+        with self._lock:
+            end = self.first + len(self.kinds)
+            self._skip_persisted()
+            if self.spill_dir is not None and self.persisted < end:
+                self._write_segment(max(self.persisted, self.first), end)
+                self.persisted = end
+
+    def _write_segment(self, start: int, end: int):
+        """Write entries start..end as a JSON header line followed by the raw array columns"""
+        low, high = start - self.first, end - self.first
+        header = {
+            'count': end - start,
+            'codes': self.codes,
+            'names': self.names,
+            'notes': {index - start: note for index, note in self._notes.items() if start <= index < end},
+        }
+        Path(self.spill_dir).mkdir(parents=True, exist_ok=True)
+        path = os.path.join(self.spill_dir, self.SEGMENT_PATTERN.format(
+            first=self.timestamps[low], last=self.timestamps[high - 1]))
+        if os.path.exists(path):
+            # Same time range as an earlier segment (e.g. a replay): keep both
+            path = f"{path[:-len('.seg.gz')]}-{start}.seg.gz"
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, 'wb', compresslevel=1) as f:
+            f.write(json.dumps(header, separators=(',', ':')).encode('utf-8') + b'\n')
+            for column in (self.timestamps, self.kinds, self.slots, self.cents):
+                f.write(column[low:high].tobytes())
+        os.replace(tmp_path, path)
+
+    def segments(self):
+        """Segment files on disk as (first timestamp, last timestamp, path), oldest first"""
+        if self.spill_dir is None or not os.path.isdir(self.spill_dir):
+            return []
+        found = []
+        for name in os.listdir(self.spill_dir):
+            if name.startswith("transactions-") and name.endswith(".seg.gz"):
+                first, last = name[len("transactions-"):-len(".seg.gz")].split('-')[:2]
+                found.append((int(first), int(last), os.path.join(self.spill_dir, name)))
+        return sorted(found)
+
+    @classmethod
+    def _read_columns(cls, path: str):
+        with gzip.open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            columns = []
+            for typecode in cls.COLUMNS:
+                column = array(typecode)
+                column.frombytes(f.read(header['count'] * column.itemsize))
+                columns.append(column)
+        return header, columns
+
+    @classmethod
+    def read_segment(cls, path: str):
+        """Stream the TransactionRecords of one segment file"""
+        header, columns = cls._read_columns(path)
+        codes, names, notes = header['codes'], header['names'], header['notes']
+        for index, (timestamp_ns, kind, slot, cents) in enumerate(zip(*columns)):
+            yield TransactionRecord(timestamp_ns, TransactionType(kind),
+                                    codes[slot] if slot != NO_SLOT else None,
+                                    names[slot] if slot != NO_SLOT else None,
+                                    cents, notes.get(str(index)))
+
+    def record(self, index: int):
+        """Record at a position in memory (0 is the oldest entry still held)"""
+        if index < 0:
+            index += len(self.kinds)
+        slot = self.slots[index]
+        return TransactionRecord(self.timestamps[index], TransactionType(self.kinds[index]),
+                                 self.codes[slot] if slot != NO_SLOT else None,
+                                 self.names[slot] if slot != NO_SLOT else None,
+                                 self.cents[index], self._notes.get(self.first + index))
+
+    def records(self, kind: TransactionType = None, code: str = None,
+                since_ns: int = None, until_ns: int = None):
+        """Iterate matching entries as TransactionRecords, oldest first, segments included"""
+        def matches(record):
+            return ((kind is None or record.kind == kind)
+                    and (code is None or record.code == code)
+                    and (since_ns is None or record.timestamp_ns >= since_ns)
+                    and (until_ns is None or record.timestamp_ns < until_ns))
+
+        for first, last, path in self.segments():
+            if (since_ns is not None and last < since_ns) or (until_ns is not None and first >= until_ns):
+                continue
+            for record in self.read_segment(path):
+                if matches(record):
+                    yield record
+        with self._lock:
+            # With a spill_dir, entries below persisted were read from segments above
+            start = max(self.persisted, self.first) - self.first if self.spill_dir else 0
+            memory = [self.record(index) for index in range(start, len(self.kinds))]
+        for record in memory:
+            if matches(record):
+                yield record
+
+    def total(self, kind: TransactionType = TransactionType.PURCHASE):
+        """Exact sum of the amounts of every entry of one type, segments included
+
+        Runs over the integer cents columns directly, without building
+        records, so it stays cheap across millions of entries.
+        """
+        cents = 0
+        for _, _, path in self.segments():
+            _, (_, kinds, _, amounts) = self._read_columns(path)
+            cents += sum(amount for entry_kind, amount in zip(kinds, amounts) if entry_kind == kind)
+        with self._lock:
+            start = max(self.persisted, self.first) - self.first if self.spill_dir else 0
+            cents += sum(amount for entry_kind, amount in zip(self.kinds[start:], self.cents[start:])
+                         if entry_kind == kind)
+        return Money(cents)
+
+    def __len__(self):
+        return self.first + len(self.kinds)
+
+    def __getitem__(self, index):
+        with self._lock:
+            total = self.first + len(self.kinds)
+            if isinstance(index, slice):
+                start, stop, step = index.indices(total)
+                if step > 0:
+                    start = max(start, self.first)
+                return [self.record(i - self.first).line for i in range(start, stop, step)
+                        if i >= self.first]
+            if index < 0:
+                index += total
+            if not self.first <= index < total:
+                raise IndexError("transaction index out of range or no longer in memory")
+            return self.record(index - self.first).line
+
+    def __iter__(self):
+        """Lines still in memory, oldest first"""
+        return iter(self[:])
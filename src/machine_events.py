@@ -0,0 +1,216 @@
+﻿"""
+machine_events.py - The events a vending machine's state is folded from
+"""
+
+try:
+    from .history import TransactionType, parse_timestamp
+    from .money import Money
+except ImportError:  # imported as a top-level module from inside src/
+    from history import TransactionType, parse_timestamp
+    from money import Money
+
+
+# What happens to the customer's credit after a purchase
+BALANCE_RETURN_CHANGE = "return-change"    # the rest is handed back as change (desktop)
+BALANCE_KEEP = "keep"                      # the rest stays as credit for the next purchase (web)
+BALANCE_POLICIES = (BALANCE_RETURN_CHANGE, BALANCE_KEEP)
+
+
+def settle_purchase(balance: Money, price: Money, policy: str = BALANCE_RETURN_CHANGE):
+    """(balance left, change handed back) after paying price out of balance"""
+    remaining = balance - price
+    if policy == BALANCE_KEEP:
+        return remaining, Money()
+    return Money(), remaining
+
+
+class MachineEvent:
+    """Something that happened to the machine
+
+    A machine's state is its last snapshot with every later event applied
+    in order. apply() is that fold step: it adds the history entry and
+    changes balances, stock and totals, with no checks and no storage I/O,
+    so replaying a journal does exactly what the live machine did. The
+    entry goes first, so one the history refuses leaves the machine as it
+    was.
+    Events are journaled as the same one-line records the journal has
+    always held, keyed by op.
+
+    session is the customer whose credit the event moves, for front-ends
+    that serve several at once; None is the machine's single balance.
+    """
+
+    __slots__ = ('ts', 'session')
+    op = None
+
+    def __init__(self, ts: int, session: str = None):
+        self.ts = ts    # epoch nanoseconds
+        self.session = session
+
+    def to_record(self):
+        return self._with_session({'op': self.op, 'ts': self.ts})
+
+    def _with_session(self, record: dict):
+        if self.session is not None:
+            record['session'] = self.session
+        return record
+
+    def apply(self, machine):
+        raise NotImplementedError
+
+    def __repr__(self):
+        fields = ', '.join(f"{name}={getattr(self, name)!r}" for name in self._fields())
+        return f"{type(self).__name__}({fields})"
+
+    @classmethod
+    def _fields(cls):
+        return [name for klass in reversed(cls.__mro__) for name in getattr(klass, '__slots__', ())]
+
+
+class CashInserted(MachineEvent):
+    __slots__ = ('amount',)
+    op = 'cash'
+    kind = TransactionType.CASH
+
+    def __init__(self, ts: int, amount: Money, session: str = None):
+        super().__init__(ts, session)
+        self.amount = amount
+
+    def to_record(self):
+        return self._with_session({'op': self.op, 'amount': float(self.amount), 'ts': self.ts})
+
+    @classmethod
+    def from_record(cls, record: dict, ts: int):
+        return cls(ts, Money.of(record['amount']), record.get('session'))
+
+    def apply(self, machine):
+        machine.log_transaction(self.kind, self.amount, timestamp=self.ts)
+        machine.set_credit(self.session, machine.credit(self.session) + self.amount)
+
+
+class CardAuthorized(CashInserted):
+    __slots__ = ()
+    op = 'card'
+    kind = TransactionType.CARD
+
+
+class ProductDispensed(MachineEvent):
+    """A sale: price moves from the balance to total sales, change goes back to the customer
+
+    remaining is the stock the storage backend reported after the sale.
+    Records journaled before sales carried price, change and remaining
+    leave them None: the product's current price, change by the machine's
+    balance policy, and one unit off the shelf.
+    """
+
+    __slots__ = ('code', 'price', 'change', 'remaining')
+    op = 'buy'
+
+    def __init__(self, ts: int, code: str, price: Money = None, change: Money = None,
+                 remaining: int = None, session: str = None):
+        super().__init__(ts, session)
+        self.code = code
+        self.price = price
+        self.change = change
+        self.remaining = remaining
+
+    def to_record(self):
+        return self._with_session({'op': self.op, 'code': self.code, 'price': float(self.price),
+                                   'change': float(self.change), 'remaining': self.remaining,
+                                   'ts': self.ts})
+
+    @classmethod
+    def from_record(cls, record: dict, ts: int):
+        price, change = record.get('price'), record.get('change')
+        return cls(ts, record['code'],
+                   None if price is None else Money.of(price),
+                   None if change is None else Money.of(change),
+                   record.get('remaining'), record.get('session'))
+
+    def apply(self, machine):
+        product = machine.products.get(self.code)
+        if product is None:
+            print(f"Skipping sale of unknown product {self.code}")
+            return
+        price = product.price if self.price is None else self.price
+        balance = machine.credit(self.session)
+        change = self.change
+        if change is None:
+            change = settle_purchase(balance, price, machine.balance_policy)[1]
+        machine.log_transaction(TransactionType.PURCHASE, price, product, self.ts)
+        if self.remaining is None:
+            product.purchase()
+        else:
+            product.quantity = self.remaining
+        machine.set_credit(self.session, Money(balance.cents - price.cents - change.cents))
+        machine.total_sales = Money(machine.total_sales.cents + price.cents)
+
+
+class ChangeReturned(MachineEvent):
+    """Credit handed back on cancel
+
+    Records journaled before cancels carried their amount leave it None:
+    the whole balance at that point was handed back.
+    """
+
+    __slots__ = ('amount',)
+    op = 'cancel'
+
+    def __init__(self, ts: int, amount: Money = None, session: str = None):
+        super().__init__(ts, session)
+        self.amount = amount
+
+    def to_record(self):
+        return self._with_session({'op': self.op, 'amount': float(self.amount), 'ts': self.ts})
+
+    @classmethod
+    def from_record(cls, record: dict, ts: int):
+        amount = record.get('amount')
+        return cls(ts, None if amount is None else Money.of(amount), record.get('session'))
+
+    def apply(self, machine):
+        balance = machine.credit(self.session)
+        amount = balance if self.amount is None else self.amount
+        machine.log_transaction(TransactionType.CANCEL, amount, timestamp=self.ts)
+        machine.set_credit(self.session, balance - amount)
+
+
+class Restocked(MachineEvent):
+    __slots__ = ('code', 'count')
+    op = 'restock'
+
+    def __init__(self, ts: int, code: str, count: int):
+        super().__init__(ts)
+        self.code = code
+        self.count = count
+
+    def to_record(self):
+        return {'op': self.op, 'code': self.code, 'count': self.count, 'ts': self.ts}
+
+    @classmethod
+    def from_record(cls, record: dict, ts: int):
+        return cls(ts, record['code'], record['count'])
+
+    def apply(self, machine):
+        product = machine.products.get(self.code)
+        if product is None:
+            print(f"Skipping restock of unknown product {self.code}")
+            return
+        machine.log_transaction(f"Restocked {product.name}: +{self.count}", timestamp=self.ts)
+        product.quantity += self.count
+
+
+EVENT_TYPES = {cls.op: cls for cls in (CashInserted, CardAuthorized, ProductDispensed,
+                                       ChangeReturned, Restocked)}
+
+
+def event_from_record(record: dict):
+    """The event a journal record holds, or None for an op this version does not know"""
+    event_type = EVENT_TYPES.get(record.get('op'))
+    if event_type is None:
+        return None
+    ts = record.get('ts')
+    # Journals written before timestamps were stored as integers hold text
+    if isinstance(ts, str):
+        ts = parse_timestamp(ts)
+    return event_type.from_record(record, ts)
@@ -0,0 +1,151 @@
+﻿"""
+metrics.py - Request and machine metrics in Prometheus text format
+"""
+
+from bisect import bisect_left
+import os
+import threading
+import weakref
+
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class _Shard:
+    """One thread's private counters; only its owner thread ever writes to it"""
+
+    __slots__ = ('requests', 'latency', 'counters')
+
+    def __init__(self):
+        self.requests = {}    # route -> {status: count}
+        self.latency = {}     # route -> [bucket counts..., +Inf count, sum]
+        self.counters = {}    # name -> value
+
+
+class _ShardOwner:
+    """Held only by its thread's local storage, so it is freed when the thread exits"""
+
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+def _fold(shard, requests, latency, counters):
+    """Add one shard's counts into the given totals"""
+    for route, statuses in list(shard.requests.items()):
+        merged = requests.setdefault(route, {})
+        for status, count in list(statuses.items()):
+            merged[status] = merged.get(status, 0) + count
+    for route, histogram in list(shard.latency.items()):
+        merged = latency.setdefault(route, [0] * len(histogram))
+        for i, value in enumerate(histogram):
+            merged[i] += value
+    for name, value in list(shard.counters.items()):
+        counters[name] = counters.get(name, 0) + value
+
+
+class MetricsRegistry:
+    """Per-route request counts and latency histograms plus named counters
+
+    Recording is lock-free: every thread writes to its own shard, so the hot
+    path is a thread-local lookup, a bisect and a few in-place increments,
+    and the only lock is taken once per thread and on scrape when the shards
+    are merged. When a thread exits its shard is folded into the retired
+    totals and dropped, so a server that keeps replacing worker threads
+    holds one shard per live thread, not one per thread ever seen.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()    # counts of threads that have exited
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        owner = getattr(self._local, 'owner', None)
+        if owner is None:
+            shard = _Shard()
+            owner = self._local.owner = _ShardOwner(shard)
+            weakref.finalize(owner, self._retire, shard)
+            with self._lock:
+                self._shards.append(shard)
+        return owner.shard
+
+    def _retire(self, shard):
+        """Fold an exited thread's shard into the retired totals"""
+        with self._lock:
+            self._shards.remove(shard)
+            retired = self._retired
+            _fold(shard, retired.requests, retired.latency, retired.counters)
+
+    def observe_request(self, route: str, status: int, seconds: float):
+        shard = self._shard()
+        statuses = shard.requests.get(route)
+        if statuses is None:
+            statuses = shard.requests[route] = {}
+            shard.latency[route] = [0] * (len(self.buckets) + 1) + [0.0]
+        statuses[status] = statuses.get(status, 0) + 1
+        histogram = shard.latency[route]
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def inc(self, name: str, amount=1):
+        counters = self._shard().counters
+        counters[name] = counters.get(name, 0) + amount
+
+    def _merge(self):
+        requests, latency, counters = {}, {}, {}
+        # The retired totals and the live shard list are read together, so a
+        # thread retiring mid-scrape is counted exactly once
+        with self._lock:
+            shards = list(self._shards)
+            _fold(self._retired, requests, latency, counters)
+        for shard in shards:
+            _fold(shard, requests, latency, counters)
+        return requests, latency, counters
+
+    def render(self, gauges: dict = None, help_text: dict = None):
+        """Prometheus text exposition of everything recorded, plus point-in-time gauges"""
+        requests, latency, counters = self._merge()
+        help_text = help_text or {}
+        # Each worker process keeps its own registry, so label series by pid
+        worker = f'worker="{os.getpid()}"'
+        lines = [
+            "# HELP http_requests_total Requests handled, by route and status.",
+            "# TYPE http_requests_total counter",
+        ]
+        for route in sorted(requests):
+            for status in sorted(requests[route]):
+                lines.append(f'http_requests_total{{{worker},route="{route}",status="{status}"}} '
+                             f'{requests[route][status]}')
+
+        lines.append("# HELP http_request_duration_seconds Request latency, by route.")
+        lines.append("# TYPE http_request_duration_seconds histogram")
+        for route in sorted(latency):
+            histogram = latency[route]
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram):
+                cumulative += count
+                lines.append(f'http_request_duration_seconds_bucket{{{worker},route="{route}",le="{bound}"}} '
+                             f'{cumulative}')
+            cumulative += histogram[len(self.buckets)]
+            lines.append(f'http_request_duration_seconds_bucket{{{worker},route="{route}",le="+Inf"}} '
+                         f'{cumulative}')
+            lines.append(f'http_request_duration_seconds_sum{{{worker},route="{route}"}} {histogram[-1]:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{{worker},route="{route}"}} {cumulative}')
+
+        for name in sorted(counters):
+            if name in help_text:
+                lines.append(f"# HELP {name} {help_text[name]}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{{{worker}}} {counters[name]}")
+
+        for name, value in sorted((gauges or {}).items()):
+            if name in help_text:
+                lines.append(f"# HELP {name} {help_text[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{{{worker}}} {value}")
+        return "\n".join(lines) + "\n"
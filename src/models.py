@@ -2,25 +2,148 @@
 models.py - Business logic for vending machine
 """
 
-from datetime import datetime
+from array import array
+from bisect import bisect_right
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from itertools import compress, repeat
 import json
+from operator import and_, ge, gt, mul
+import os
 from pathlib import Path
+import queue
+import sqlite3
+import threading
+import time
+
+try:
+    from .events import EventBus
+    from .history import NO_SLOT, TransactionLog, TransactionType, format_timestamp
+    from .machine_events import (BALANCE_KEEP, BALANCE_POLICIES, BALANCE_RETURN_CHANGE,
+                                 CardAuthorized, CashInserted, ChangeReturned, ProductDispensed,
+                                 Restocked, event_from_record, settle_purchase)
+    from .money import Money
+except ImportError:  # imported as a top-level module from inside src/
+    from events import EventBus
+    from history import NO_SLOT, TransactionLog, TransactionType, format_timestamp
+    from machine_events import (BALANCE_KEEP, BALANCE_POLICIES, BALANCE_RETURN_CHANGE,
+                                CardAuthorized, CashInserted, ChangeReturned, ProductDispensed,
+                                Restocked, event_from_record, settle_purchase)
+    from money import Money
+
+
+# The repository's data/ directory, wherever the process was started from
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+DEFAULT_STATE_FILE = os.path.join(DATA_DIR, "vending_state.json")
+
+# Transactions kept in memory; older ones are spilled to compressed segment files
+DEFAULT_HISTORY_CAPACITY = 10000
+
+# Journal durability policies
+DURABILITY_ALWAYS_FSYNC = "always-fsync"    # write + fsync on every operation
+DURABILITY_GROUP_COMMIT = "group-commit"    # background write + fsync every N ms / N ops
+DURABILITY_OS_BUFFERED = "os-buffered"      # write on every operation, let the OS flush
+DURABILITY_MODES = (DURABILITY_ALWAYS_FSYNC, DURABILITY_GROUP_COMMIT, DURABILITY_OS_BUFFERED)
+
+# The standard 6 x 4 layout: (code, name, price, quantity)
+DEFAULT_PRODUCTS = (
+    # Row 1
+    ("A1", "Coke", 1.75, 9),
+    ("A2", "Pepsi", 1.75, 9),
+    ("A3", "Dr Pepper", 1.75, 9),
+    ("A4", "Powerade", 2.25, 10),
+    # Row 2
+    ("B1", "Water", 1.25, 9),
+    ("B2", "Sparkling", 2.00, 10),
+    ("B3", "Iced Coffee", 3.50, 10),
+    ("B4", "Energy Drk", 3.00, 10),
+    # Row 3
+    ("C1", "Classic Chips", 1.50, 9),
+    ("C2", "BBQ Chips", 1.50, 10),
+    ("C3", "Sour Cream", 1.50, 10),
+    ("C4", "Pretzels", 1.25, 10),
+    # Row 4
+    ("D1", "Mixed Nuts", 2.50, 10),
+    ("D2", "Protein Bar", 3.00, 10),
+    ("D3", "Beef Jerky", 4.50, 10),
+    ("D4", "Popcorn", 2.00, 10),
+    # Row 5
+    ("E1", "PB Cookie", 2.00, 10),
+    ("E2", "Dark Choco", 2.50, 10),
+    ("E3", "Milk Choco", 2.25, 10),
+    ("E4", "Gummy Bears", 1.75, 10),
+    # Row 6
+    ("F1", "Skittles", 1.75, 10),
+    ("F2", "Brownie", 2.50, 10),
+    ("F3", "Fruit Snacks", 1.50, 10),
+    ("F4", "Mint Gum", 0.75, 10),
+)
+
+# The original three-slot machine (vending_machine.py), also what older
+# sales history such as data/transactions.csv was recorded against
+LEGACY_PRODUCTS = (
+    ("A1", "Cola", 1.25, 10),
+    ("A2", "Chips", 1.50, 7),
+    ("A3", "Water", 1.00, 12),
+)
 
 
 class Product:
-    """Represents a single product in the vending machine"""
+    """A single product in the vending machine: a view of one row of a ProductTable
+    
+    A product created on its own gets a one-row table of its own; storing it
+    in a machine's ProductTable rebinds it to that table's row.
+    """
+    
+    __slots__ = ('table', 'slot')
+    
+    def __init__(self, code: str, name: str, price, quantity: int = 10):
+        self.table = ProductTable()
+        self.slot = self.table.add(code, name, price, quantity)
+    
+    @classmethod
+    def view(cls, table, slot: int):
+        product = cls.__new__(cls)
+        product.table = table
+        product.slot = slot
+        return product
+    
+    @property
+    def code(self):
+        return self.table.codes[self.slot]
+    
+    @property
+    def name(self):
+        return self.table.names[self.slot]
+    
+    @name.setter
+    def name(self, name: str):
+        self.table.names[self.slot] = name
+        self.table.touch(self.slot)
+    
+    @property
+    def price(self):
+        return Money(self.table.prices[self.slot])
+    
+    @price.setter
+    def price(self, price):
+        self.table.prices[self.slot] = Money.of(price).cents
+        self.table.touch(self.slot, price_changed=True)
     
-    def __init__(self, code: str, name: str, price: float, quantity: int = 10):
-        self.code = code
-        self.name = name
-        self.price = price
-        self.quantity = quantity
+    @property
+    def quantity(self):
+        return self.table.quantities[self.slot]
+    
+    @quantity.setter
+    def quantity(self, quantity: int):
+        self.table.quantities[self.slot] = quantity
+        self.table.touch(self.slot)
     
     def to_dict(self):
         return {
             'code': self.code,
             'name': self.name,
-            'price': self.price,
+            'price': float(self.price),
             'quantity': self.quantity
         }
     
@@ -34,166 +157,826 @@ class Product:
         )
     
     def is_available(self):
-        return self.quantity > 0
+        return self.table.quantities[self.slot] > 0
     
-    def can_purchase(self, balance: float):
+    def can_purchase(self, balance):
         return self.is_available() and balance >= self.price
     
     def purchase(self):
-        if self.quantity > 0:
-            self.quantity -= 1
+        quantities = self.table.quantities
+        if quantities[self.slot] > 0:
+            quantities[self.slot] -= 1
+            self.table.touch(self.slot)
             return True
         return False
+    
+    def __repr__(self):
+        return f"Product({self.code!r}, {self.name!r}, {self.price}, {self.quantity})"
+
+
+def planogram_key(code: str):
+    """Sort key putting slot codes in row then column order (A1, A2, ..., A10, B1)"""
+    row = code.rstrip('0123456789')
+    column = code[len(row):]
+    return row, int(column) if column else -1, code
+
+
+class ProductTable(MutableMapping):
+    """The machine's products stored column-wise
+    
+    Codes map to dense slot indexes into plain lists of codes and names and
+    typed arrays of prices (cents) and quantities, so a slot costs a few
+    dozen bytes rather than a Product object, its attribute dict and a Money.
+    Indexing by code returns a Product view of the row, so code written
+    against the old dict of Products keeps working; whole-table queries
+    run over the columns without building any.
+    
+    Every change made through add() or a Product view bumps version and
+    records it against the slot, so caches can ask what changed since the
+    version they were built at; layout_version moves only when slots are
+    added or removed. Writing to the columns directly bypasses this.
+    
+    Deleting a code moves the slots after it down by one, so views taken
+    before a deletion should not be reused.
+    """
+    
+    def __init__(self, products=None):
+        self.codes = []
+        self.names = []
+        self.prices = array('q')        # cents
+        self.quantities = array('q')
+        self.slot_versions = array('q') # version of each slot's last change
+        self._index = {}                # code -> slot
+        self._order = None              # slots in planogram order, rebuilt after adds
+        self._price_index = None        # (sorted prices, their slots), rebuilt after price changes
+        self.version = 0
+        self.layout_version = 0
+        if products:
+            self.update(products)
+    
+    @classmethod
+    def from_rows(cls, rows):
+        """Table from (code, name, price, quantity) rows"""
+        table = cls()
+        for code, name, price, quantity in rows:
+            table.add(code, name, price, quantity)
+        return table
+    
+    def add(self, code: str, name: str, price, quantity: int = 10):
+        """Store a product's values in its slot, adding the slot if the code is new; returns the slot"""
+        cents = Money.of(price).cents
+        slot = self._index.get(code)
+        if slot is not None:
+            self.names[slot] = name
+            price_changed = self.prices[slot] != cents
+            self.prices[slot] = cents
+            self.quantities[slot] = quantity
+            self.touch(slot, price_changed)
+            return slot
+        slot = self._index[code] = len(self.codes)
+        self.codes.append(code)
+        self.names.append(name)
+        self.prices.append(cents)
+        self.quantities.append(quantity)
+        self.slot_versions.append(0)
+        self._layout_changed()
+        self.touch(slot)
+        return slot
+    
+    def touch(self, slot: int, price_changed: bool = False):
+        """Record that a slot changed"""
+        self.version += 1
+        self.slot_versions[slot] = self.version
+        if price_changed:
+            self._price_index = None
+    
+    def _layout_changed(self):
+        self.version += 1
+        self.layout_version = self.version
+        self._order = None
+        self._price_index = None
+    
+    def changed_since(self, version: int):
+        """Slots changed after version"""
+        return list(compress(range(len(self.codes)), map(gt, self.slot_versions, repeat(version))))
+    
+    def slot(self, code: str):
+        return self._index[code]
+    
+    def __getitem__(self, code: str):
+        return Product.view(self, self._index[code])
+    
+    def __setitem__(self, code: str, product: Product):
+        slot = self.add(code, product.name, product.price, product.quantity)
+        product.table, product.slot = self, slot
+    
+    def __delitem__(self, code: str):
+        slot = self._index.pop(code)
+        del self.codes[slot], self.names[slot], self.prices[slot], self.quantities[slot]
+        del self.slot_versions[slot]
+        for moved in self.codes[slot:]:
+            self._index[moved] -= 1
+        self._layout_changed()
+    
+    def __contains__(self, code):
+        return code in self._index
+    
+    def __iter__(self):
+        return iter(self.codes)
+    
+    def __len__(self):
+        return len(self.codes)
+    
+    def order(self):
+        """Slots sorted into planogram order"""
+        if self._order is None:
+            codes = self.codes
+            self._order = array('q', sorted(range(len(codes)), key=lambda slot: planogram_key(codes[slot])))
+        return self._order
+    
+    def price_index(self):
+        """(prices, slots): every slot's price in cents in ascending order, and the slot of each"""
+        if self._price_index is None:
+            prices = self.prices
+            slots = sorted(range(len(prices)), key=prices.__getitem__)
+            self._price_index = (array('q', [prices[slot] for slot in slots]), array('q', slots))
+        return self._price_index
+    
+    def total_stock(self):
+        return sum(self.quantities)
+    
+    def stock_value(self):
+        """Retail value of everything on the shelves"""
+        return Money(sum(map(mul, self.prices, self.quantities)))
+    
+    def in_stock(self):
+        """Codes with at least one unit left"""
+        return list(compress(self.codes, self.quantities))
+    
+    def affordable(self, balance):
+        """Codes in stock whose price the balance covers"""
+        cents = Money.of(balance).cents
+        covered = map(ge, repeat(cents), self.prices)
+        return list(compress(self.codes, map(and_, map(bool, self.quantities), covered)))
+
+
+class Journal:
+    """Append-only write-ahead log of machine operations, one compact JSON record per line"""
+    
+    def __init__(self, path: str, durability: str = DURABILITY_OS_BUFFERED,
+                 group_commit_ms: int = 10, group_commit_ops: int = 64):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.path = path
+        self.durability = durability
+        self.group_commit_ms = group_commit_ms
+        self.group_commit_ops = group_commit_ops
+        self.seq = 0          # sequence number of the last record written
+        self.pending = 0      # records written since the last snapshot
+        self._file = None
+        self._buffer = []     # group-commit lines not yet handed to the OS
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._io_lock = threading.Lock()
+        self._flusher = None
+        self._closing = False
+    
+    def append(self, record: dict):
+        if self.durability == DURABILITY_GROUP_COMMIT:
+            with self._lock:
+                self._buffer.append(self._encode(record))
+                if self._flusher is None:
+                    self._start_flusher()
+                if len(self._buffer) >= self.group_commit_ops:
+                    self._wakeup.notify()
+            return
+        # Lock order is always _io_lock then _lock so records hit the file in seq order
+        with self._io_lock:
+            with self._lock:
+                line = self._encode(record)
+            self._write([line], fsync=self.durability == DURABILITY_ALWAYS_FSYNC)
+    
+    def _encode(self, record: dict):
+        self.seq += 1
+        record['seq'] = self.seq
+        self.pending += 1
+        return json.dumps(record, separators=(',', ':')) + '\n'
+    
+    def flush(self):
+        """Force every appended record to disk (with fsync unless os-buffered)"""
+        with self._io_lock:
+            with self._lock:
+                lines, self._buffer = self._buffer, []
+            if lines:
+                self._write(lines, fsync=self.durability != DURABILITY_OS_BUFFERED)
+    
+    def _write(self, lines, fsync: bool):
+        """Write lines to the journal file; caller holds _io_lock"""
+        if self._file is None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(''.join(lines))
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+    
+    def _start_flusher(self):
+        self._closing = False
+        self._flusher = threading.Thread(target=self._flush_loop, name="journal-flusher", daemon=True)
+        self._flusher.start()
+    
+    def _flush_loop(self):
+        """Coalesce everything appended within one interval into a single write+fsync"""
+        while True:
+            with self._lock:
+                if not self._closing and len(self._buffer) < self.group_commit_ops:
+                    self._wakeup.wait(self.group_commit_ms / 1000)
+                closing = self._closing
+            self.flush()
+            if closing:
+                return
+    
+    def replay(self, after_seq: int = 0):
+        """Return records newer than after_seq, dropping a torn trailing record"""
+        self.close()
+        records = []
+        good_offset = 0
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    good_offset += len(line)
+                    if record['seq'] > after_seq:
+                        records.append(record)
+                    self.seq = max(self.seq, record['seq'])
+            # Cut off a partially written record so new appends start on a clean line
+            if good_offset < os.path.getsize(self.path):
+                print("Journal has a torn record at the end. Truncating it.")
+                with open(self.path, 'r+b') as f:
+                    f.truncate(good_offset)
+        except FileNotFoundError:
+            pass
+        self.seq = max(self.seq, after_seq)
+        self.pending = len(records)
+        return records
+    
+    def reset(self):
+        """Discard all records after they have been folded into a snapshot"""
+        with self._io_lock:
+            with self._lock:
+                self._buffer = []
+                self.pending = 0
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            with open(self.path, 'w', encoding='utf-8'):
+                pass
+    
+    def close(self):
+        """Stop the background flusher and flush what is left"""
+        with self._lock:
+            flusher, self._flusher = self._flusher, None
+            self._closing = True
+            self._wakeup.notify()
+        if flusher is not None:
+            flusher.join()
+        self.flush()
+        with self._io_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class JsonFileStorage:
+    """Storage backend keeping state in a JSON snapshot, optionally behind a write-ahead journal"""
+    
+    def __init__(self, path: str = DEFAULT_STATE_FILE, journal: bool = False,
+                 compact_every: int = 500, durability: str = DURABILITY_OS_BUFFERED,
+                 group_commit_ms: int = 10, group_commit_ops: int = 64):
+        self.path = path
+        self.compact_every = compact_every
+        self.journal = None
+        if journal:
+            self.journal = Journal(path + ".journal", durability,
+                                   group_commit_ms, group_commit_ops)
+    
+    def load(self, machine):
+        snapshot_seq = 0
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+            machine.products = ProductTable.from_rows(
+                (code, data['name'], data['price'], data['quantity'])
+                for code, data in state['products'].items())
+            machine.balance = Money.of(state.get('balance', 0.0))
+            machine.total_sales = Money.of(state['total_sales'])
+            machine.transactions.reset(state.get('transactions', []))
+            snapshot_seq = state.get('journal_seq', 0)
+        except FileNotFoundError:
+            print("No saved state found. Using defaults.")
+        except json.JSONDecodeError:
+            print("Error reading saved state. Using defaults.")
+        
+        if self.journal is not None:
+            # Only the tail after the snapshot is folded in, however long the history
+            for record in self.journal.replay(snapshot_seq):
+                machine.apply_record(record)
+        machine.transactions.mark_persisted()
+    
+    def save(self, machine):
+        if self.journal is None:
+            self.write_snapshot(machine)
+        elif not os.path.exists(self.path):
+            # Every operation is already in the journal; a snapshot is only
+            # needed when there is none yet to replay it against
+            self.compact(machine)
+        else:
+            self.journal.flush()
+    
+    def dispense(self, machine, product: Product, timestamp: int):
+        """Claim one unit of product: the quantity that will be left, or None if it is sold out"""
+        return product.quantity - 1 if product.quantity > 0 else None
+    
+    def record(self, machine, event):
+        """Append an event to the journal, compacting it into a snapshot when it grows"""
+        if self.journal is None:
+            return
+        self.journal.append(event.to_record())
+        if self.journal.pending >= self.compact_every:
+            self.compact(machine)
+    
+    def compact(self, machine):
+        """Fold the journal into a fresh snapshot"""
+        self.write_snapshot(machine)
+        self.journal.reset()
+    
+    def write_snapshot(self, machine):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        state = {
+            'products': {code: prod.to_dict() for code, prod in machine.products.items()},
+            'balance': float(machine.balance),
+            'total_sales': float(machine.total_sales),
+            'transactions': machine.transactions[-100:],
+            'journal_seq': self.journal.seq if self.journal is not None else 0
+        }
+        # Write to a temp file and rename over the old one so a crash
+        # mid-write leaves the previous snapshot intact
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+            if self.journal is not None and self.journal.durability != DURABILITY_OS_BUFFERED:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+    
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+
+class MemoryStorage:
+    """Storage backend that keeps nothing: state lives only as long as the process"""
+    
+    path = None
+    
+    def load(self, machine):
+        pass
+    
+    def save(self, machine):
+        pass
+    
+    def dispense(self, machine, product: Product, timestamp: int):
+        return product.quantity - 1 if product.quantity > 0 else None
+    
+    def record(self, machine, event):
+        pass
+    
+    def close(self):
+        pass
+
+
+class SqliteStorage:
+    """Storage backend keeping state in SQLite (WAL mode) so several processes can share it
+    
+    Every operation commits on its own; a purchase is a single conditional
+    UPDATE, so two workers can never sell the same last unit.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS products (
+            code TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            price REAL NOT NULL,
+            quantity INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts TEXT NOT NULL,
+            op TEXT NOT NULL,
+            code TEXT,
+            amount REAL,
+            message TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS machine (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            balance REAL NOT NULL,
+            total_sales REAL NOT NULL
+        );
+    """
+    
+    # Statements are kept as constants so each pooled connection's
+    # statement cache prepares them once and reuses them
+    SQL_DISPENSE = "UPDATE products SET quantity = quantity - 1 WHERE code = ? AND quantity > 0"
+    SQL_QUANTITY = "SELECT quantity FROM products WHERE code = ?"
+    SQL_ADD_SALE = "UPDATE machine SET total_sales = total_sales + ?, balance = ? WHERE id = 1"
+    SQL_SET_BALANCE = "UPDATE machine SET balance = ? WHERE id = 1"
+    SQL_RESTOCK = "UPDATE products SET quantity = quantity + ? WHERE code = ?"
+    SQL_INSERT_TRANSACTION = "INSERT INTO transactions (ts, op, code, amount, message) VALUES (?, ?, ?, ?, ?)"
+    SQL_UPSERT_PRODUCT = ("INSERT INTO products (code, name, price, quantity) VALUES (?, ?, ?, ?) "
+                          "ON CONFLICT(code) DO UPDATE SET name = excluded.name, "
+                          "price = excluded.price, quantity = excluded.quantity")
+    SQL_UPSERT_MACHINE = ("INSERT INTO machine (id, balance, total_sales) VALUES (1, ?, ?) "
+                          "ON CONFLICT(id) DO UPDATE SET balance = excluded.balance, "
+                          "total_sales = excluded.total_sales")
+    
+    def __init__(self, path: str = os.path.join(DATA_DIR, "vending_state.db"), pool_size: int = 4,
+                 timeout: float = 5.0):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._pool_lock = threading.Lock()
+        self._local = threading.local()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with self.connection() as conn:
+            conn.executescript(self.SCHEMA)
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                               check_same_thread=False, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection; a thread keeps the same one while it holds it"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                can_create = self._created < self.pool_size
+                if can_create:
+                    self._created += 1
+            conn = self._connect() if can_create else self._pool.get()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._pool.put(conn)
+    
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+    
+    def load(self, machine):
+        with self.connection() as conn:
+            rows = conn.execute("SELECT code, name, price, quantity FROM products ORDER BY code").fetchall()
+            totals = conn.execute("SELECT balance, total_sales FROM machine WHERE id = 1").fetchone()
+            history = conn.execute(
+                "SELECT ts, message FROM transactions ORDER BY id DESC LIMIT 100").fetchall()
+        if not rows:
+            # Fresh database: seed it with the machine's current catalog
+            self.save(machine)
+            return
+        machine.products = ProductTable.from_rows(rows)
+        if totals is not None:
+            machine.balance, machine.total_sales = Money.of(totals[0]), Money.of(totals[1])
+        machine.transactions.reset(f"{ts}: {message}" for ts, message in reversed(history))
+    
+    def save(self, machine):
+        with self.transaction() as conn:
+            conn.executemany(self.SQL_UPSERT_PRODUCT,
+                             [(p.code, p.name, float(p.price), p.quantity)
+                              for p in machine.products.values()])
+            conn.execute(self.SQL_UPSERT_MACHINE, (float(machine.balance), float(machine.total_sales)))
+    
+    def dispense(self, machine, product: Product, timestamp: int):
+        """Atomically decrement stock and record the sale
+        
+        Returns the quantity left, or None if another process sold out first
+        (the product then shows the stock the database has).
+        """
+        with self.transaction() as conn:
+            sold = conn.execute(self.SQL_DISPENSE, (product.code,)).rowcount == 1
+            if sold:
+                conn.execute(self.SQL_ADD_SALE, (float(product.price), float(machine.balance - product.price)))
+                conn.execute(self.SQL_INSERT_TRANSACTION,
+                             (format_timestamp(timestamp), 'buy', product.code, float(product.price),
+                              f"Purchased {product.name} for ${product.price:.2f}"))
+            quantity = conn.execute(self.SQL_QUANTITY, (product.code,)).fetchone()[0]
+        if not sold:
+            product.quantity = quantity
+            return None
+        return quantity
+    
+    def record(self, machine, event):
+        record = event.to_record()
+        op = record['op']
+        with self.transaction() as conn:
+            conn.execute(self.SQL_SET_BALANCE, (float(machine.balance),))
+            if op == 'restock':
+                conn.execute(self.SQL_RESTOCK, (record['count'], record['code']))
+            if op != 'buy':
+                # Purchases were already written by dispense()
+                conn.execute(self.SQL_INSERT_TRANSACTION,
+                             (format_timestamp(record['ts']), op, None, record.get('amount'),
+                              machine.transactions.record(-1).message))
+    
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
 
 
 class VendingMachine:
-    """Main vending machine business logic"""
+    """Main vending machine business logic, shared by the desktop and legacy front-ends
+    
+    balance_policy decides what a purchase does with the credit left over:
+    BALANCE_RETURN_CHANGE hands it back, BALANCE_KEEP leaves it for the
+    next purchase. catalog is the (code, name, price, quantity) rows the
+    machine starts with.
+    
+    Every change is an event (src/machine_events.py): a command checks
+    its preconditions, then emit() applies the event, hands it to the
+    storage backend and publishes it on bus, where side effects such as
+    UI refresh, metrics and alerts subscribe. Loading is the latest
+    snapshot with the journal's events after it applied again.
     
-    def __init__(self):
-        self.balance = 0.0
-        self.total_sales = 0.0
-        self.transactions = []
-        self.products = {}
+    The machine has one customer's credit in balance. Commands take an
+    optional session, carried on their events, and credit()/set_credit()
+    are the only place balances are read and written, so a front-end
+    serving many customers at once (main_web.py) overrides just those.
+    """
+    
+    def __init__(self, state_file: str = DEFAULT_STATE_FILE, journal: bool = False,
+                 compact_every: int = 500, durability: str = DURABILITY_OS_BUFFERED,
+                 group_commit_ms: int = 10, group_commit_ops: int = 64, storage=None,
+                 clock=time.time_ns, history_capacity: int = DEFAULT_HISTORY_CAPACITY,
+                 history_dir: str = None, balance_policy: str = BALANCE_RETURN_CHANGE,
+                 catalog=DEFAULT_PRODUCTS, bus: EventBus = None):
+        if balance_policy not in BALANCE_POLICIES:
+            raise ValueError(f"Unknown balance policy: {balance_policy}")
+        self.balance_policy = balance_policy
+        self.catalog = catalog
+        self.balance = Money()
+        self.total_sales = Money()
+        self.products = ProductTable()
+        if storage is None:
+            storage = JsonFileStorage(state_file, journal, compact_every, durability,
+                                      group_commit_ms, group_commit_ops)
+        self.storage = storage
+        # SQLite already keeps every transaction; next to a JSON snapshot the
+        # history beyond history_capacity goes to <state file>.history/
+        if history_dir is None and isinstance(storage, JsonFileStorage):
+            history_dir = storage.path + ".history"
+        self.transactions = TransactionLog(capacity=history_capacity, spill_dir=history_dir)
+        self.clock = clock    # returns epoch nanoseconds; replays inject their own
+        # Every event is published here once it is applied and stored
+        self.bus = bus or EventBus()
+        # get_product_grid() cache: entries in planogram order, patched as products and balance change
+        self.grid_version = 0
+        self._grid = None
+        self._grid_versions = None    # grid_version at which each entry last changed
+        self._grid_positions = None   # slot -> position in _grid
+        self._grid_table = None
+        self._grid_seen = (0, 0, 0)   # table layout_version, version and balance cents the grid reflects
+        self._grid_rebuilt = 0        # grid_version of the last full rebuild
         self.load_default_products()
     
     def load_default_products(self):
-        """Load the specific 24 products from the layout"""
-        products_data = [
-            # Row 1
-            ("A1", "Coke", 1.75, 9),
-            ("A2", "Pepsi", 1.75, 9),
-            ("A3", "Dr Pepper", 1.75, 9),
-            ("A4", "Powerade", 2.25, 10),
-            # Row 2
-            ("B1", "Water", 1.25, 9),
-            ("B2", "Sparkling", 2.00, 10),
-            ("B3", "Iced Coffee", 3.50, 10),
-            ("B4", "Energy Drk", 3.00, 10),
-            # Row 3
-            ("C1", "Classic Chips", 1.50, 9),
-            ("C2", "BBQ Chips", 1.50, 10),
-            ("C3", "Sour Cream", 1.50, 10),
-            ("C4", "Pretzels", 1.25, 10),
-            # Row 4
-            ("D1", "Mixed Nuts", 2.50, 10),
-            ("D2", "Protein Bar", 3.00, 10),
-            ("D3", "Beef Jerky", 4.50, 10),
-            ("D4", "Popcorn", 2.00, 10),
-            # Row 5
-            ("E1", "PB Cookie", 2.00, 10),
-            ("E2", "Dark Choco", 2.50, 10),
-            ("E3", "Milk Choco", 2.25, 10),
-            ("E4", "Gummy Bears", 1.75, 10),
-            # Row 6
-            ("F1", "Skittles", 1.75, 10),
-            ("F2", "Brownie", 2.50, 10),
-            ("F3", "Fruit Snacks", 1.50, 10),
-            ("F4", "Mint Gum", 0.75, 10),
-        ]
-        
-        for code, name, price, quantity in products_data:
-            self.products[code] = Product(code, name, price, quantity)
+        """Load the machine's starting catalog"""
+        for code, name, price, quantity in self.catalog:
+            self.products.add(code, name, price, quantity)
+    
+    def credit(self, session: str = None):
+        """Credit available to a customer"""
+        return self.balance
+    
+    def set_credit(self, session: str, amount: Money):
+        self.balance = amount
     
-    def insert_cash(self, amount: float):
-        if amount <= 0:
+    def insert_cash(self, amount, session: str = None):
+        amount = Money.of(amount)
+        if amount.cents <= 0:
             return "Invalid amount"
         
-        self.balance += amount
-        self.log_transaction(f"Cash inserted: ${amount:.2f}")
+        self.emit(CashInserted(self._timestamp(), amount, session))
         return f"Inserted: ${amount:.2f}"
     
-    def process_credit_card(self, amount: float, card_info: dict = None):
-        self.balance += amount
-        self.log_transaction(f"Credit card payment: ${amount:.2f}")
+    def process_credit_card(self, amount, card_info: dict = None, session: str = None):
+        amount = Money.of(amount)
+        if amount.cents <= 0:
+            return "Invalid amount"
+        
+        self.emit(CardAuthorized(self._timestamp(), amount, session))
         return f"Card payment: ${amount:.2f}"
     
-    def purchase_product(self, product_code: str):
+    def purchase_product(self, product_code: str, session: str = None):
         result = {
             'success': False,
             'message': '',
-            'change': 0.0,
+            'reason': None,    # why a purchase was refused
+            'change': Money(),
             'product': None
         }
         
         if product_code not in self.products:
             result['message'] = "Invalid product code!"
+            result['reason'] = 'invalid_code'
             return result
         
         product = self.products[product_code]
+        price = product.price
+        balance = self.credit(session)
         
         if not product.is_available():
             result['message'] = f"Sorry, {product.name} is out of stock!"
+            result['reason'] = 'out_of_stock'
             return result
         
-        if self.balance < product.price:
-            result['message'] = f"Insufficient funds! Need: ${product.price:.2f}"
+        if balance < price:
+            result['message'] = f"Insufficient funds! Need: ${price:.2f}"
+            result['reason'] = 'insufficient_funds'
             return result
         
         # Process purchase
-        product.purchase()
-        change = self.balance - product.price
-        self.total_sales += product.price
-        self.balance = 0.0
+        timestamp = self._timestamp()
+        remaining = self.storage.dispense(self, product, timestamp)
+        if remaining is None:
+            result['message'] = f"Sorry, {product.name} is out of stock!"
+            result['reason'] = 'out_of_stock'
+            return result
+        change = settle_purchase(balance, price, self.balance_policy)[1]
+        self.emit(ProductDispensed(timestamp, product_code, price, change, remaining, session))
         
         result['success'] = True
         result['message'] = f"Dispensed: {product.name}!"
         result['change'] = change
         result['product'] = product
-        
-        self.log_transaction(f"Purchased {product.name} for ${product.price:.2f}")
         return result
     
-    def cancel_transaction(self):
-        change = self.balance
-        self.balance = 0.0
-        if change > 0:
-            self.log_transaction(f"Cancelled. Returned: ${change:.2f}")
+    def cancel_transaction(self, session: str = None):
+        change = self.credit(session)
+        if change.cents > 0:
+            self.emit(ChangeReturned(self._timestamp(), change, session))
         return change
     
-    def log_transaction(self, message: str):
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.transactions.append(f"{timestamp}: {message}")
+    def restock(self, product_code: str, count: int):
+        if product_code not in self.products:
+            return "Invalid product code!"
+        if count <= 0:
+            return "Invalid count"
+        self.emit(Restocked(self._timestamp(), product_code, count))
+        product = self.products[product_code]
+        return f"Restocked {product.name}: {product.quantity} in stock"
+    
+    def emit(self, event):
+        """Apply an event to the machine, store it and publish it"""
+        event.apply(self)
+        self.storage.record(self, event)
+        self.bus.publish(event)
+    
+    def _timestamp(self):
+        """Current time in epoch nanoseconds"""
+        return self.clock()
+    
+    def log_transaction(self, kind, amount=Money(), product: Product = None, timestamp: int = None):
+        """Add an entry to the history and return its timestamp; a string kind is logged as a note"""
+        if timestamp is None:
+            timestamp = self._timestamp()
+        if isinstance(kind, str):
+            self.transactions.append_note(kind, timestamp)
+        else:
+            slot = NO_SLOT if product is None else self.transactions.slot(product.code, product.name)
+            self.transactions.append(kind, Money.of(amount).cents, slot, timestamp)
+        return timestamp
+    
+    def close(self):
+        """Finish queued event deliveries, flush history and release the storage backend"""
+        self.bus.close()
+        self.transactions.flush()
+        self.storage.close()
+    
+    def apply_record(self, record: dict):
+        """Fold a journaled event into the machine without storing it again"""
+        event = event_from_record(record)
+        if event is not None:
+            event.apply(self)
     
     def get_product_grid(self):
-        grid = []
-        # Sort by row then column
-        rows = ['A', 'B', 'C', 'D', 'E', 'F']
-        cols = ['1', '2', '3', '4']
+        """Every slot in row then column order with its availability at the current balance
         
-        for row in rows:
-            for col in cols:
-                code = f"{row}{col}"
-                if code in self.products:
-                    product = self.products[code]
-                    grid.append({
-                        'code': code,
-                        'name': product.name,
-                        'price': product.price,
-                        'quantity': product.quantity,
-                        'available': product.is_available(),
-                        'affordable': product.can_purchase(self.balance)
-                    })
+        The grid is cached and only the entries whose product changed, or
+        whose affordability the last balance change flipped, are rebuilt.
+        Entries are replaced rather than modified, so a grid returned
+        earlier never changes under its caller.
+        """
+        self._refresh_grid()
+        return list(self._grid)
+    
+    def get_product_grid_changes(self, since: int = None):
+        """Grid entries changed after grid version `since`
         
-        return grid
+        Returns the current 'version' to pass next time and the changed
+        'products'. 'full' is set, with every entry, when there is no
+        `since` or the layout changed after it; callers should then
+        replace rather than patch what they show.
+        """
+        self._refresh_grid()
+        full = since is None or since < self._grid_rebuilt
+        if full:
+            products = list(self._grid)
+        else:
+            grid = self._grid
+            products = [grid[position] for position in
+                        compress(range(len(grid)), map(gt, self._grid_versions, repeat(since)))]
+        return {'version': self.grid_version, 'full': full, 'products': products}
     
-    def save_state(self, filename: str = "../data/vending_state.json"):
-        Path("../data").mkdir(exist_ok=True)
-        state = {
-            'products': {code: prod.to_dict() for code, prod in self.products.items()},
-            'total_sales': self.total_sales,
-            'transactions': self.transactions[-100:]
+    def _grid_entry(self, slot: int, cents: int):
+        products = self.products
+        quantity = products.quantities[slot]
+        price = products.prices[slot]
+        return {
+            'code': products.codes[slot],
+            'name': products.names[slot],
+            'price': Money(price),
+            'quantity': quantity,
+            'available': quantity > 0,
+            'affordable': quantity > 0 and price <= cents
         }
-        with open(filename, 'w') as f:
-            json.dump(state, f, indent=2)
     
-    def load_state(self, filename: str = "../data/vending_state.json"):
-        try:
-            with open(filename, 'r') as f:
-                state = json.load(f)
-            self.products = {code: Product.from_dict(data) for code, data in state['products'].items()}
-            self.total_sales = state['total_sales']
-            self.transactions = state.get('transactions', [])
-        except FileNotFoundError:
-            print("No saved state found. Using defaults.")
-        except json.JSONDecodeError:
-            print("Error reading saved state. Using defaults.")
+    def _refresh_grid(self):
+        products = self.products
+        cents = self.balance.cents
+        layout_version, version, grid_cents = self._grid_seen
+        if self._grid is None or self._grid_table is not products or layout_version != products.layout_version:
+            order = products.order()
+            self.grid_version += 1
+            self._grid = [self._grid_entry(slot, cents) for slot in order]
+            self._grid_versions = array('q', [self.grid_version]) * len(order)
+            self._grid_positions = array('q', bytes(8 * len(order)))
+            for position, slot in enumerate(order):
+                self._grid_positions[slot] = position
+            self._grid_table = products
+            self._grid_rebuilt = self.grid_version
+        else:
+            changed = set()
+            if version != products.version:
+                changed.update(products.changed_since(version))
+            if cents != grid_cents:
+                # Only slots priced between the old and new balance change affordability
+                prices, slots = products.price_index()
+                low, high = min(cents, grid_cents), max(cents, grid_cents)
+                quantities = products.quantities
+                changed.update(slot for slot in slots[bisect_right(prices, low):bisect_right(prices, high)]
+                               if quantities[slot] > 0)
+            if changed:
+                self.grid_version += 1
+                for slot in changed:
+                    position = self._grid_positions[slot]
+                    self._grid[position] = self._grid_entry(slot, cents)
+                    self._grid_versions[position] = self.grid_version
+        self._grid_seen = (products.layout_version, products.version, cents)
+    
+    def save_state(self, filename: str = None):
+        if filename is None or filename == self.storage.path:
+            self.storage.save(self)
+        else:
+            JsonFileStorage(filename).save(self)
+    
+    def load_state(self, filename: str = None):
+        if filename is None or filename == self.storage.path:
+            self.storage.load(self)
+        else:
+            JsonFileStorage(filename).load(self)
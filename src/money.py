@@ -0,0 +1,130 @@
+﻿"""
+money.py - Exact money amounts as integer cents
+"""
+
+from decimal import Decimal, ROUND_HALF_UP
+from fractions import Fraction
+import operator
+
+# Largest amount Money.of() accepts, in cents: far inside the int64 cents
+# columns of the history and shared state, so totals of many such amounts
+# still fit, and inside the 28 digits of the default Decimal context
+MAX_CENTS = 10 ** 15
+_MAX_DOLLARS = Decimal(MAX_CENTS).scaleb(-2)
+
+
+class Money:
+    """An amount of money held as a whole number of cents
+
+    Sums and differences stay exact however many are added up. Floats,
+    ints (whole dollars), Decimals and '$1.75' strings are converted once
+    at the boundary with Money.of(); mixing them into arithmetic,
+    equality or ordering converts them the same way, so Money.of(0.1) ==
+    0.1. Amounts Money.of() refuses (NaN, infinities, beyond MAX_CENTS)
+    are compared exactly instead. Money only multiplies by whole counts.
+    It hashes like the Fraction of its dollar value, which matches ints,
+    Decimals and Fractions of whole cents but not most floats.
+    float(money) and format specs like f"{money:.2f}" give the dollar
+    value for display and JSON.
+    """
+
+    __slots__ = ('cents',)
+
+    def __init__(self, cents: int = 0):
+        self.cents = int(cents)
+
+    @classmethod
+    def of(cls, amount):
+        """Money from a dollar amount; ValueError unless it is finite and within MAX_CENTS"""
+        if isinstance(amount, Money):
+            return amount
+        if isinstance(amount, int):
+            if abs(amount) * 100 > MAX_CENTS:
+                raise ValueError(f"Amount out of range: {amount}")
+            return cls(amount * 100)
+        if isinstance(amount, float):
+            # The shortest repr is the decimal the float was written as, so
+            # 0.125 rounds half up like '0.125' instead of by its binary value
+            amount = repr(amount)
+        elif isinstance(amount, str):
+            amount = amount.strip().lstrip('$')
+        amount = Decimal(amount)
+        if not amount.is_finite() or abs(amount) > _MAX_DOLLARS:
+            raise ValueError(f"Amount out of range: {amount}")
+        return cls(int((amount * 100).quantize(Decimal(1), ROUND_HALF_UP)))
+
+    def __float__(self):
+        return self.cents / 100
+
+    def __int__(self):
+        return self.cents
+
+    def __format__(self, spec):
+        return format(self.cents / 100, spec) if spec else str(self)
+
+    def __str__(self):
+        sign = '-' if self.cents < 0 else ''
+        return f"{sign}${abs(self.cents) // 100}.{abs(self.cents) % 100:02d}"
+
+    def __repr__(self):
+        return f"Money({self.cents})"
+
+    def __add__(self, other):
+        if not isinstance(other, Money):
+            other = Money.of(other)
+        return Money(self.cents + other.cents)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if not isinstance(other, Money):
+            other = Money.of(other)
+        return Money(self.cents - other.cents)
+
+    def __rsub__(self, other):
+        return Money.of(other) - self
+
+    def __mul__(self, count: int):
+        if not isinstance(count, int):
+            return NotImplemented
+        return Money(self.cents * count)
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __hash__(self):
+        # Same hash as the int, float, Decimal or Fraction of equal value
+        return hash(Fraction(self.cents, 100))
+
+    def _compare(self, other, compare):
+        """compare(self, other) on cents, or on exact values if Money.of() refuses other"""
+        if isinstance(other, Money):
+            return compare(self.cents, other.cents)
+        try:
+            return compare(self.cents, Money.of(other).cents)
+        except ValueError:
+            if not isinstance(other, (int, float, Decimal, Fraction)):
+                raise
+            return compare(Fraction(self.cents, 100), other)
+
+    def __eq__(self, other):
+        if not isinstance(other, (Money, int, float, Decimal, Fraction)):
+            return NotImplemented
+        return self._compare(other, operator.eq)
+
+    def __lt__(self, other):
+        return self._compare(other, operator.lt)
+
+    def __le__(self, other):
+        return self._compare(other, operator.le)
+
+    def __gt__(self, other):
+        return self._compare(other, operator.gt)
+
+    def __ge__(self, other):
+        return self._compare(other, operator.ge)
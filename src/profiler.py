@@ -0,0 +1,111 @@
+﻿"""
+profiler.py - Low-overhead stack sampling profiler with collapsed-stack output
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+class StackSampler:
+    """Counts every thread's Python stack at a fixed interval
+
+    Sampling only reads sys._current_frames(), so the profiled threads run
+    untouched; the cost is one pass over their frames per interval on the
+    sampling thread. Overhead is bounded by a minimum interval, a stack
+    depth cap and a cap on distinct stacks (later new stacks are counted as
+    [truncated]). Output is the collapsed format flamegraph tools read:
+    one "outer;...;inner count" line per distinct stack.
+    """
+
+    MIN_INTERVAL = 0.001
+
+    def __init__(self, interval: float = 0.01, max_depth: int = 64, max_stacks: int = 5000):
+        self.interval = max(interval, self.MIN_INTERVAL)
+        self.max_depth = max_depth
+        self.max_stacks = max_stacks
+        self.counts = {}
+        self.samples = 0
+        self._labels = {}    # code object -> frame label
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = (f"{code.co_name} "
+                                          f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        return label
+
+    def sample(self):
+        """Record one stack from every thread except the calling one"""
+        me = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            labels = []
+            while frame is not None and len(labels) < self.max_depth:
+                labels.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack = ';'.join(reversed(labels))
+            if stack not in self.counts and len(self.counts) >= self.max_stacks:
+                stack = '[truncated]'
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+        self.samples += 1
+
+    def run(self, seconds: float):
+        """Sample on the calling thread for the given number of seconds"""
+        deadline = time.monotonic() + seconds
+        next_sample = time.monotonic()
+        while True:
+            self.sample()
+            next_sample += self.interval
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            # Never sleep less than the interval after a slow pass, so a
+            # large process cannot push the sampler into a busy loop
+            if next_sample < now:
+                next_sample = now + self.interval
+            time.sleep(min(next_sample, deadline) - now)
+        return self
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in
+                       sorted(self.counts.items(), key=lambda item: -item[1]))
+
+
+# Only one profile runs per process at a time
+_profile_lock = threading.Lock()
+
+
+def profile(seconds: float, interval: float = 0.01, **kwargs):
+    """Run a sampler for seconds and return it, or None if a profile is already running"""
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    try:
+        return StackSampler(interval, **kwargs).run(seconds)
+    finally:
+        _profile_lock.release()
+
+
+def profile_to_file(seconds: float, directory: str = None, interval: float = 0.01):
+    """Profile on a background thread and write the collapsed stacks to a file
+
+    Meant to be started from a signal handler, which must return quickly.
+    """
+    directory = directory or tempfile.gettempdir()
+
+    def target():
+        sampler = profile(seconds, interval)
+        if sampler is None:
+            print("Profiler already running, signal ignored")
+            return
+        path = os.path.join(directory, f"vending-profile-{os.getpid()}-{int(time.time())}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(sampler.collapsed())
+        print(f"Profile written to {path}")
+
+    thread = threading.Thread(target=target, name='stack-sampler', daemon=True)
+    thread.start()
+    return thread
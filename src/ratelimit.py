@@ -0,0 +1,74 @@
+﻿"""
+ratelimit.py - Per-client token buckets and priority-aware admission control
+"""
+
+import threading
+import time
+
+from .cache import TTLCache
+
+
+PRIORITY_CRITICAL = 0   # money and stock moving: purchase, cancel, card payments
+PRIORITY_NORMAL = 1     # browsing and adding credit
+PRIORITY_LOW = 2        # admin and analytics, shed first
+
+
+class TokenBucketLimiter:
+    """Token bucket per client, refilled at rate tokens/sec up to burst
+
+    A bucket left alone for burst / rate seconds is full again, which is
+    exactly what a brand new bucket looks like, so it is safe to forget it.
+    Buckets therefore live in a TTLCache with that idle lifetime and a hard
+    entry cap: memory tracks recently active clients, not every client ever
+    seen.
+    """
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.buckets = TTLCache(max_entries=max_clients, ttl=burst / rate, clock=clock)
+        self._lock = threading.Lock()
+
+    def acquire(self, client: str, tokens: float = 1.0):
+        """Take tokens for client; return 0 if admitted, else seconds until it would be"""
+        with self._lock:
+            now = self.clock()
+            available, updated_at = self.buckets.get(client, (self.burst, now))
+            available = min(self.burst, available + (now - updated_at) * self.rate)
+            if available >= tokens:
+                self.buckets.set(client, (available - tokens, now))
+                return 0.0
+            self.buckets.set(client, (available, now))
+            return (tokens - available) / self.rate
+
+
+class AdmissionController:
+    """Caps requests in flight and sheds lower priorities first as load rises
+
+    Each priority may only start while in-flight requests are below its
+    share of max_in_flight; critical traffic is always let in.
+    """
+
+    DEFAULT_SHED_AT = {PRIORITY_NORMAL: 0.9, PRIORITY_LOW: 0.5}
+
+    def __init__(self, max_in_flight: int = 64, shed_at: dict = None):
+        self.max_in_flight = max_in_flight
+        self.limits = {priority: int(max_in_flight * share)
+                       for priority, share in (shed_at or self.DEFAULT_SHED_AT).items()}
+        self.in_flight = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def try_enter(self, priority: int):
+        with self._lock:
+            limit = self.limits.get(priority)
+            if limit is not None and self.in_flight >= limit:
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
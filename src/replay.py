@@ -0,0 +1,208 @@
+﻿"""
+replay.py - Feed recorded sales history back into a VendingMachine
+
+    python -m src.replay data/transactions.csv [--catalog legacy] [--add-missing]
+                         [--speed 60] [--restock] [--json]
+    python -m src.replay data/vending_state.json --state data/vending_state.json
+"""
+
+import argparse
+import csv
+from datetime import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+if __package__ in (None, ''):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.models import DEFAULT_PRODUCTS, LEGACY_PRODUCTS, VendingMachine
+
+
+# Starting catalogs selectable with --catalog
+CATALOGS = {'default': DEFAULT_PRODUCTS, 'legacy': LEGACY_PRODUCTS}
+
+
+# Replay events are (when, op, product, amount) tuples. The ops are the
+# journal's ('cash', 'card', 'buy', 'cancel') plus 'sale': a purchase from
+# the sales CSV, which records no payment, so the replayer sets the slot to
+# the recorded price and pays it in cash first.
+
+def read_sales_csv(path):
+    """Stream 'Timestamp,Product,Price' rows as sale events"""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            yield (datetime.fromisoformat(row['Timestamp']), 'sale', row['Product'],
+                   float(row['Price'].lstrip('$')))
+
+
+def parse_transaction(line: str):
+    """Turn one 'YYYY-MM-DD HH:MM:SS: message' log line into an event, or None"""
+    timestamp, _, message = line.partition(': ')
+    amount = message.rpartition('$')[2]
+    when = datetime.fromisoformat(timestamp)
+    if message.startswith("Cash inserted: "):
+        return when, 'cash', None, float(amount)
+    if message.startswith("Credit card payment: "):
+        return when, 'card', None, float(amount)
+    if message.startswith("Cancelled. Returned: "):
+        return when, 'cancel', None, float(amount)
+    if message.startswith("Purchased "):
+        return when, 'buy', message[len("Purchased "):message.rfind(" for $")], float(amount)
+    return None
+
+
+def read_transaction_log(path):
+    """Stream the 'transactions' list of a vending_state.json snapshot as events"""
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        lines = json.load(f).get('transactions', [])
+    for line in lines:
+        event = parse_transaction(line)
+        if event is not None:
+            yield event
+
+
+def read_events(path):
+    return read_sales_csv(path) if path.endswith('.csv') else read_transaction_log(path)
+
+
+class ReplayClock:
+    """Clock for VendingMachine(clock=...): epoch nanoseconds of the time the replayer last set"""
+
+    def __init__(self, now: datetime = None):
+        self.now = now or datetime.now()
+
+    def __call__(self):
+        return int(self.now.timestamp()) * 1_000_000_000 + self.now.microsecond * 1000
+
+
+class Replayer:
+    """Applies events to a machine whose clock is a ReplayClock
+
+    With speed None events run back to back; otherwise the gaps between
+    their timestamps are kept, divided by speed (60 plays an hour in a
+    minute). Products are matched by name, so history recorded against a
+    different catalog still replays, and a sale at another price than the
+    slot's reprices the slot first. Unknown names are counted and skipped,
+    unless add_missing is set: then each is added to the machine on first
+    sight, at the price it sold for, with add_missing units in stock.
+    """
+
+    def __init__(self, machine: VendingMachine, speed: float = None, sleep=time.sleep,
+                 add_missing: int = None):
+        self.machine = machine
+        self.speed = speed
+        self.sleep = sleep
+        self.add_missing = add_missing
+        if not isinstance(machine.clock, ReplayClock):
+            machine.clock = ReplayClock()
+        self.clock = machine.clock
+        self.codes = {product.name: code for code, product in machine.products.items()}
+        self.stats = {'events': 0, 'succeeded': 0, 'failed': 0, 'unknown_product': 0,
+                      'added_products': 0, 'repriced': 0}
+        self.failures = {}    # failure message -> count
+
+    def run(self, events):
+        started = time.perf_counter()
+        first = None
+        for event in events:
+            if self.speed:
+                if first is None:
+                    first = event[0]
+                due = (event[0] - first).total_seconds() / self.speed
+                ahead = due - (time.perf_counter() - started)
+                if ahead > 0:
+                    self.sleep(ahead)
+            self.apply(event)
+        elapsed = time.perf_counter() - started
+        self.stats['seconds'] = round(elapsed, 6)
+        self.stats['events_per_sec'] = round(self.stats['events'] / elapsed, 1) if elapsed else 0.0
+        return self.stats
+
+    def apply(self, event):
+        when, op, product, amount = event
+        self.clock.now = when
+        self.stats['events'] += 1
+        machine = self.machine
+        if op == 'cash':
+            machine.insert_cash(amount)
+        elif op == 'card':
+            machine.process_credit_card(amount)
+        elif op == 'cancel':
+            machine.cancel_transaction()
+        else:
+            code = self.codes.get(product)
+            if code is None and self.add_missing is not None:
+                code = self.add_product(product, amount)
+            if code is None:
+                self.stats['unknown_product'] += 1
+                return
+            if op == 'sale':
+                product = machine.products[code]
+                if product.price != amount:
+                    product.price = amount
+                    self.stats['repriced'] += 1
+                machine.insert_cash(product.price)
+            result = machine.purchase_product(code)
+            if not result['success']:
+                self.stats['failed'] += 1
+                self.failures[result['message']] = self.failures.get(result['message'], 0) + 1
+                if op == 'sale':
+                    machine.cancel_transaction()
+                return
+        self.stats['succeeded'] += 1
+
+    def add_product(self, name: str, price: float):
+        """Put a product the history names but the catalog lacks in a new X slot"""
+        products = self.machine.products
+        number = 1
+        while f"X{number}" in products:
+            number += 1
+        code = f"X{number}"
+        products.add(code, name, price, self.add_missing)
+        self.codes[name] = code
+        self.stats['added_products'] += 1
+        return code
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded sales into a VendingMachine")
+    parser.add_argument('history', help="transactions .csv or a vending_state.json snapshot")
+    parser.add_argument('--speed', type=float, help="time-scale factor; default is as fast as possible")
+    parser.add_argument('--catalog', choices=sorted(CATALOGS), default='default',
+                        help="catalog to start from; legacy is the three-slot machine older history used")
+    parser.add_argument('--state', help="start from this snapshot instead of a catalog")
+    parser.add_argument('--add-missing', action='store_true',
+                        help="add products the history names but the catalog lacks, at their recorded price")
+    parser.add_argument('--restock', action='store_true', help="never run out of stock")
+    parser.add_argument('--repeat', type=int, default=1, help="replay the history this many times")
+    parser.add_argument('--json', action='store_true', help="print results as JSON")
+    args = parser.parse_args()
+
+    # The replayed machine never writes over real state
+    with tempfile.TemporaryDirectory() as directory:
+        machine = VendingMachine(state_file=os.path.join(directory, "replay.json"), clock=ReplayClock(),
+                                 catalog=CATALOGS[args.catalog])
+        if args.state:
+            machine.load_state(args.state)
+        if args.restock:
+            for product in machine.products.values():
+                product.quantity = 10 ** 9
+        stock = 10 ** 9 if args.restock else 10
+        replayer = Replayer(machine, args.speed, add_missing=stock if args.add_missing else None)
+        stats = replayer.run(event for _ in range(args.repeat) for event in read_events(args.history))
+        machine.close()
+
+    stats['total_sales'] = float(machine.total_sales)
+    stats['failures'] = replayer.failures
+    if args.json:
+        print(json.dumps(stats, indent=2))
+        return
+    for key, value in stats.items():
+        print(f"{key:>16}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,410 @@
+﻿"""
+shared_state.py - Inventory shared between worker processes through shared memory
+"""
+
+from contextlib import contextmanager
+import hashlib
+from multiprocessing import shared_memory
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process file locks, fall back to a thread lock
+    fcntl = None
+
+try:
+    from .money import Money
+except ImportError:  # imported as a top-level module from inside src/
+    from money import Money
+
+
+def attach_or_create(name: str, size: int):
+    """Attach to the named shared memory block, creating it zero-filled if it does not exist"""
+    try:
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+        shm = shared_memory.SharedMemory(name=name)
+    # The block must outlive whichever worker created it, so keep the
+    # resource tracker from unlinking it when that worker exits
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    if shm.size < size:
+        shm.close()
+        raise ValueError(f"Shared memory block '{name}' has a different layout")
+    return shm
+
+
+def unlink_block(shm):
+    """Remove a block made by attach_or_create() once no worker needs it"""
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.register(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    shm.unlink()
+
+
+class SharedInventory:
+    """Fixed-layout shared memory block with per-slot quantity/price arrays and a ledger
+
+    Layout (little endian):
+        header   magic, slot count, ledger size, session capacity, version,
+                 total sales (cents), ledger count
+        int32    quantity[slots]
+        int64    price[slots]                              (cents)
+        int64    slot_version[slots]                       (state version of each slot's last change)
+        bytes    ledger[ledger_size][LEDGER_ENTRY_SIZE]   (ring buffer of log lines)
+        session  balances[session_capacity]                (see SharedBalanceTable)
+
+    Every worker attaches to the same block by name; all access goes through
+    lock(), which is an flock() on a lock file so it works across processes
+    that were not forked from a common parent.
+    """
+
+    MAGIC = 0x56454E32  # "VEN2": money as integer cents
+    HEADER = struct.Struct('<IIIIqqq')
+    LEDGER_ENTRY_SIZE = 96
+
+    def __init__(self, name: str, prices, quantities, ledger_size: int = 256,
+                 session_capacity: int = 4096, session_ttl: float = 1800, lock_path: str = None):
+        self.name = name
+        self.slots = len(prices)
+        self.ledger_size = ledger_size
+        self.session_capacity = session_capacity
+        self.lock_path = lock_path or os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        self._thread_lock = threading.RLock()
+        self._lock_file = None
+        self._lock_pid = None
+        self._lock_depth = 0
+
+        # Keep the int64 arrays 8-byte aligned
+        self._quantity_offset = 8 * ((self.HEADER.size + 7) // 8)
+        self._price_offset = self._quantity_offset + 8 * ((4 * self.slots + 7) // 8)
+        self._slot_version_offset = self._price_offset + 8 * self.slots
+        self._ledger_offset = self._slot_version_offset + 8 * self.slots
+        self._session_offset = self._ledger_offset + ledger_size * self.LEDGER_ENTRY_SIZE
+        size = self._session_offset + session_capacity * SharedBalanceTable.ENTRY.size
+
+        with self.lock():
+            self.shm = self._attach_or_create(size)
+            buf = self.shm.buf
+            layout = struct.unpack_from('<IIII', buf, 0)
+            if layout[0] != self.MAGIC:
+                # First process to get here lays out the block
+                struct.pack_into(f'<{self.slots}i', buf, self._quantity_offset, *quantities)
+                struct.pack_into(f'<{self.slots}q', buf, self._price_offset, *prices)
+                self.HEADER.pack_into(buf, 0, self.MAGIC, self.slots, ledger_size,
+                                      session_capacity, 0, 0, 0)
+            elif layout[1:] != (self.slots, ledger_size, session_capacity):
+                raise ValueError(f"Shared inventory '{name}' has a different layout")
+        self.balances = SharedBalanceTable(self, self._session_offset, session_capacity, session_ttl)
+
+    def _attach_or_create(self, size: int):
+        return attach_or_create(self.name, size)
+
+    @contextmanager
+    def lock(self):
+        """Exclusive cross-process lock; re-entrant within a process"""
+        with self._thread_lock:
+            if self._lock_depth == 0 and fcntl is not None:
+                fcntl.flock(self._get_lock_file(), fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield self
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0 and fcntl is not None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _get_lock_file(self):
+        # flock() locks belong to the open file, which a forked worker would
+        # share with its parent, so every process opens its own
+        if self._lock_pid != os.getpid():
+            self._lock_file = open(self.lock_path, 'a')
+            self._lock_pid = os.getpid()
+        return self._lock_file
+
+    def _header(self):
+        return self.HEADER.unpack_from(self.shm.buf, 0)
+
+    @property
+    def version(self):
+        return self._header()[4]
+
+    def get_total_sales(self):
+        """Total sales in cents"""
+        return self._header()[5]
+
+    def set_total_sales(self, total_sales: int):
+        struct.pack_into('<q', self.shm.buf, 24, total_sales)
+
+    def set_version(self, version: int):
+        struct.pack_into('<q', self.shm.buf, 16, version)
+
+    def get_quantity(self, slot: int):
+        return struct.unpack_from('<i', self.shm.buf, self._quantity_offset + 4 * slot)[0]
+
+    def set_quantity(self, slot: int, quantity: int):
+        struct.pack_into('<i', self.shm.buf, self._quantity_offset + 4 * slot, quantity)
+
+    def get_slot_version(self, slot: int):
+        return struct.unpack_from('<q', self.shm.buf, self._slot_version_offset + 8 * slot)[0]
+
+    def set_slot_version(self, slot: int, version: int):
+        struct.pack_into('<q', self.shm.buf, self._slot_version_offset + 8 * slot, version)
+
+    def get_price(self, slot: int):
+        """Price in cents"""
+        return struct.unpack_from('<q', self.shm.buf, self._price_offset + 8 * slot)[0]
+
+    def quantities(self):
+        return list(struct.unpack_from(f'<{self.slots}i', self.shm.buf, self._quantity_offset))
+
+    @property
+    def ledger_count(self):
+        """Number of lines ever appended; doubles as the machine's state version"""
+        return self._header()[6]
+
+    def append_ledger(self, line: str):
+        count = self._header()[6]
+        entry = line.encode('utf-8')[:self.LEDGER_ENTRY_SIZE].ljust(self.LEDGER_ENTRY_SIZE, b'\0')
+        offset = self._ledger_offset + (count % self.ledger_size) * self.LEDGER_ENTRY_SIZE
+        self.shm.buf[offset:offset + self.LEDGER_ENTRY_SIZE] = entry
+        struct.pack_into('<q', self.shm.buf, 32, count + 1)
+
+    def ledger(self, limit: int = None):
+        """Return the most recent ledger lines, oldest first"""
+        count = self._header()[6]
+        available = min(count, self.ledger_size)
+        if limit is not None:
+            available = min(available, limit)
+        lines = []
+        for n in range(count - available, count):
+            offset = self._ledger_offset + (n % self.ledger_size) * self.LEDGER_ENTRY_SIZE
+            raw = bytes(self.shm.buf[offset:offset + self.LEDGER_ENTRY_SIZE])
+            lines.append(raw.rstrip(b'\0').decode('utf-8', errors='ignore'))
+        return lines
+
+    def close(self):
+        self.shm.close()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def unlink(self):
+        """Remove the block once no worker needs it any more"""
+        unlink_block(self.shm)
+
+
+class SharedBalanceTable:
+    """Per-session balances kept in a fixed region of a SharedInventory block
+
+    The region is a set-associative table: a session hashes to one set of
+    WAYS entries and only that set is ever scanned, so lookups are O(1) and
+    memory is fixed no matter how many shoppers come and go. An entry idle
+    for longer than ttl is free for reuse; when a set is full of live
+    entries the least recently used one is evicted. All methods must be
+    called with the owning inventory locked.
+    """
+
+    ENTRY = struct.Struct('<16sqd')   # session key digest, balance in cents, last touched
+    WAYS = 8
+
+    def __init__(self, inventory: SharedInventory, offset: int, capacity: int, ttl: float,
+                 clock=time.time):
+        if capacity % self.WAYS:
+            raise ValueError(f"Session capacity must be a multiple of {self.WAYS}")
+        self.inventory = inventory
+        self.offset = offset
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.on_evict = None
+
+    def _digest(self, key: str):
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+    def _find(self, digest: bytes, now: float):
+        """Return (index of digest or None, best index to reuse)"""
+        buf = self.inventory.shm.buf
+        first = (int.from_bytes(digest[:8], 'little') % (self.capacity // self.WAYS)) * self.WAYS
+        victim, victim_touched = first, None
+        for index in range(first, first + self.WAYS):
+            key, balance, touched = self.ENTRY.unpack_from(buf, self.offset + index * self.ENTRY.size)
+            live = touched > 0 and now - touched < self.ttl
+            if key == digest and live:
+                return index, index
+            if not live:
+                touched = 0
+            if victim_touched is None or touched < victim_touched:
+                victim, victim_touched = index, touched
+        return None, victim
+
+    def _read(self, index: int):
+        return self.ENTRY.unpack_from(self.inventory.shm.buf, self.offset + index * self.ENTRY.size)
+
+    def _write(self, index: int, digest: bytes, balance: int, touched: float):
+        self.ENTRY.pack_into(self.inventory.shm.buf, self.offset + index * self.ENTRY.size,
+                             digest, balance, touched)
+
+    def get(self, key: str, default=None):
+        now = self.clock()
+        digest = self._digest(key)
+        index, _ = self._find(digest, now)
+        if index is None:
+            return default
+        _, balance, _ = self._read(index)
+        self._write(index, digest, balance, now)
+        return balance
+
+    def set(self, key: str, balance: int):
+        now = self.clock()
+        digest = self._digest(key)
+        index, victim = self._find(digest, now)
+        if index is None:
+            old_key, old_balance, old_touched = self._read(victim)
+            if old_touched > 0 and old_balance and self.on_evict is not None:
+                self.on_evict(old_key.hex(), old_balance)
+            index = victim
+        self._write(index, digest, balance, now)
+
+    def pop(self, key: str, default=None):
+        digest = self._digest(key)
+        index, _ = self._find(digest, self.clock())
+        if index is None:
+            return default
+        _, balance, _ = self._read(index)
+        self._write(index, bytes(16), 0, 0.0)
+        return balance
+
+
+class SharedReplyCache:
+    """Replies to keyed requests shared by every worker, in a block of their own
+
+    Entries are found and replaced like SharedBalanceTable's: a key hashes
+    to one set of WAYS entries, an entry older than ttl is free, and a full
+    set gives up its oldest entry. The reply body is kept zlib-compressed
+    in a fixed BODY_SIZE; one that still does not fit is not kept. Values
+    are (fingerprint, body, status) with a 16-byte fingerprint, and all
+    methods must be called with the inventory locked.
+    """
+
+    ENTRY = struct.Struct('<16s16sHHd')   # key digest, request fingerprint, status, body length, stored at
+    BODY_SIZE = 2048
+    WAYS = 8
+
+    def __init__(self, inventory: SharedInventory, capacity: int = 1024, ttl: float = 3600,
+                 clock=time.time):
+        if capacity % self.WAYS:
+            raise ValueError(f"Reply capacity must be a multiple of {self.WAYS}")
+        self.inventory = inventory
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.stride = self.ENTRY.size + self.BODY_SIZE
+        with inventory.lock():
+            self.shm = attach_or_create(f"{inventory.name}_replies", capacity * self.stride)
+
+    def _digest(self, key: str):
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+    def _find(self, digest: bytes, now: float):
+        """Return (index of digest or None, best index to reuse)"""
+        first = (int.from_bytes(digest[:8], 'little') % (self.capacity // self.WAYS)) * self.WAYS
+        victim, victim_stored = first, None
+        for index in range(first, first + self.WAYS):
+            key, _, _, _, stored = self.ENTRY.unpack_from(self.shm.buf, index * self.stride)
+            live = stored > 0 and now - stored < self.ttl
+            if key == digest and live:
+                return index, index
+            if not live:
+                stored = 0
+            if victim_stored is None or stored < victim_stored:
+                victim, victim_stored = index, stored
+        return None, victim
+
+    def get(self, key: str, default=None):
+        index, _ = self._find(self._digest(key), self.clock())
+        if index is None:
+            return default
+        offset = index * self.stride
+        _, fingerprint, status, length, _ = self.ENTRY.unpack_from(self.shm.buf, offset)
+        start = offset + self.ENTRY.size
+        return fingerprint, zlib.decompress(self.shm.buf[start:start + length]), status
+
+    def set(self, key: str, value):
+        fingerprint, body, status = value
+        body = zlib.compress(body)
+        if len(body) > self.BODY_SIZE:
+            return
+        now = self.clock()
+        digest = self._digest(key)
+        index, victim = self._find(digest, now)
+        offset = (victim if index is None else index) * self.stride
+        start = offset + self.ENTRY.size
+        self.shm.buf[start:start + len(body)] = body
+        self.ENTRY.pack_into(self.shm.buf, offset, digest, fingerprint, status, len(body), now)
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        unlink_block(self.shm)
+
+
+class SharedMemoryStorage:
+    """Storage backend keeping a VendingMachine's stock and total sales in a SharedInventory
+
+    Every worker process runs its own machine over the same block, with
+    products in the block's slot order. Callers hold inventory.lock()
+    around a whole command and pull() at its start, so the checks see
+    what other workers sold; dispense() claims from the shared quantity
+    so two workers can never sell the same last unit.
+    """
+
+    path = None
+
+    def __init__(self, inventory: SharedInventory):
+        self.inventory = inventory
+
+    def pull(self, machine):
+        """Copy shared stock and total sales into the machine; caller holds the lock"""
+        table = machine.products
+        for slot, quantity in enumerate(self.inventory.quantities()):
+            if table.quantities[slot] != quantity:
+                table.quantities[slot] = quantity
+                table.touch(slot)
+        machine.total_sales = Money(self.inventory.get_total_sales())
+
+    def load(self, machine):
+        with self.inventory.lock():
+            self.pull(machine)
+            machine.transactions.reset(self.inventory.ledger())
+
+    def save(self, machine):
+        pass
+
+    def dispense(self, machine, product, timestamp: int):
+        with self.inventory.lock():
+            quantity = self.inventory.get_quantity(product.slot)
+        return quantity - 1 if quantity > 0 else None
+
+    def record(self, machine, event):
+        """Publish what the event changed to the other workers"""
+        with self.inventory.lock():
+            code = getattr(event, 'code', None)
+            if code is not None:
+                slot = machine.products[code].slot
+                self.inventory.set_quantity(slot, machine.products.quantities[slot])
+            self.inventory.set_total_sales(machine.total_sales.cents)
+
+    def close(self):
+        self.inventory.close()
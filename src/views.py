@@ -29,182 +29,16 @@ try:
 except ImportError:
     pass
 
-# Import business logic
+# Import business logic: the shared engine in src/models.py
 try:
+    from src.machine_events import ProductDispensed
+    from src.models import VendingMachine
+except ImportError:  # views.py run from inside src/
+    from machine_events import ProductDispensed
     from models import VendingMachine
-    print("✓ Models imported successfully")
-except ImportError:
-    print("Models import failed, creating fallback")
-    # Create simple fallback
-    from datetime import datetime
-    import json
-    from pathlib import Path
-    
-    class Product:
-        def __init__(self, code: str, name: str, price: float, quantity: int = 10):
-            self.code = code
-            self.name = name
-            self.price = price
-            self.quantity = quantity
-        
-        def to_dict(self):
-            return {
-                'code': self.code,
-                'name': self.name,
-                'price': self.price,
-                'quantity': self.quantity
-            }
-        
-        def is_available(self):
-            return self.quantity > 0
-        
-        def can_purchase(self, balance: float):
-            return self.is_available() and balance >= self.price
-        
-        def purchase(self):
-            if self.quantity > 0:
-                self.quantity -= 1
-                return True
-            return False
-    
-    class VendingMachine:
-        def __init__(self):
-            self.balance = 0.0
-            self.total_sales = 0.0
-            self.transactions = []
-            self.products = {}
-            self.load_default_products()
-        
-        def load_default_products(self):
-            products_data = [
-                ("A1", "Coke", 1.75, 9),
-                ("A2", "Pepsi", 1.75, 9),
-                ("A3", "Dr Pepper", 1.75, 9),
-                ("A4", "Powerade", 2.25, 10),
-                ("B1", "Water", 1.25, 9),
-                ("B2", "Sparkling", 2.00, 10),
-                ("B3", "Iced Coffee", 3.50, 10),
-                ("B4", "Energy Drk", 3.00, 10),
-                ("C1", "Classic Chips", 1.50, 9),
-                ("C2", "BBQ Chips", 1.50, 10),
-                ("C3", "Sour Cream", 1.50, 10),
-                ("C4", "Pretzels", 1.25, 10),
-                ("D1", "Mixed Nuts", 2.50, 10),
-                ("D2", "Protein Bar", 3.00, 10),
-                ("D3", "Beef Jerky", 4.50, 10),
-                ("D4", "Popcorn", 2.00, 10),
-                ("E1", "PB Cookie", 2.00, 10),
-                ("E2", "Dark Choco", 2.50, 10),
-                ("E3", "Milk Choco", 2.25, 10),
-                ("E4", "Gummy Bears", 1.75, 10),
-                ("F1", "Skittles", 1.75, 10),
-                ("F2", "Brownie", 2.50, 10),
-                ("F3", "Fruit Snacks", 1.50, 10),
-                ("F4", "Mint Gum", 0.75, 10),
-            ]
-            
-            for code, name, price, quantity in products_data:
-                self.products[code] = Product(code, name, price, quantity)
-        
-        def insert_cash(self, amount: float):
-            if amount <= 0:
-                return "Invalid amount"
-            self.balance += amount
-            self.log_transaction(f"Cash inserted: ${amount:.2f}")
-            return f"Inserted: ${amount:.2f}"
-        
-        def process_credit_card(self, amount: float, card_info: dict = None):
-            self.balance += amount
-            self.log_transaction(f"Credit card payment: ${amount:.2f}")
-            return f"Card payment: ${amount:.2f}"
-        
-        def purchase_product(self, product_code: str):
-            result = {
-                'success': False,
-                'message': '',
-                'change': 0.0,
-                'product': None
-            }
-            
-            if product_code not in self.products:
-                result['message'] = "Invalid product code!"
-                return result
-            
-            product = self.products[product_code]
-            
-            if not product.is_available():
-                result['message'] = f"Sorry, {product.name} is out of stock!"
-                return result
-            
-            if self.balance < product.price:
-                result['message'] = f"Insufficient funds! Need: ${product.price:.2f}"
-                return result
-            
-            product.purchase()
-            change = self.balance - product.price
-            self.total_sales += product.price
-            self.balance = 0.0
-            
-            result['success'] = True
-            result['message'] = f"Dispensed: {product.name}!"
-            result['change'] = change
-            result['product'] = product
-            
-            self.log_transaction(f"Purchased {product.name} for ${product.price:.2f}")
-            return result
-        
-        def cancel_transaction(self):
-            change = self.balance
-            self.balance = 0.0
-            if change > 0:
-                self.log_transaction(f"Cancelled. Returned: ${change:.2f}")
-            return change
-        
-        def log_transaction(self, message: str):
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            self.transactions.append(f"{timestamp}: {message}")
-        
-        def get_product_grid(self):
-            grid = []
-            rows = ['A', 'B', 'C', 'D', 'E', 'F']
-            cols = ['1', '2', '3', '4']
-            
-            for row in rows:
-                for col in cols:
-                    code = f"{row}{col}"
-                    if code in self.products:
-                        product = self.products[code]
-                        grid.append({
-                            'code': code,
-                            'name': product.name,
-                            'price': product.price,
-                            'quantity': product.quantity,
-                            'available': product.is_available(),
-                            'affordable': product.can_purchase(self.balance)
-                        })
-            return grid
-        
-        def save_state(self, filename: str = "data/vending_state.json"):
-            Path("data").mkdir(exist_ok=True)
-            state = {
-                'products': {code: prod.to_dict() for code, prod in self.products.items()},
-                'total_sales': self.total_sales,
-                'transactions': self.transactions[-100:]
-            }
-            with open(filename, 'w') as f:
-                json.dump(state, f, indent=2)
-        
-        def load_state(self, filename: str = "data/vending_state.json"):
-            try:
-                with open(filename, 'r') as f:
-                    state = json.load(f)
-                self.products = {code: Product(code=data['name'], **data) for code, data in state['products'].items()}
-                self.total_sales = state['total_sales']
-                self.transactions = state.get('transactions', [])
-            except FileNotFoundError:
-                print("No saved state found. Using defaults.")
-            except json.JSONDecodeError:
-                print("Error reading saved state. Using defaults.")
+
+# A sale that leaves this many units or fewer raises a low-stock alert
+LOW_STOCK_ALERT = 2
 
 
 # ========== CINEMATIC STYLES ==========
@@ -617,8 +451,12 @@ class CinematicMainWindow(QMainWindow):
     
     def __init__(self):
         super().__init__()
-        self.vending_machine = VendingMachine()
+        # Journaled persistence: each purchase appends one record instead of
+        # rewriting the whole state file
+        self.vending_machine = VendingMachine(journal=True)
+        self.vending_machine.load_state()
         self.product_buttons = {}
+        self._grid_version = None    # grid version the product buttons show
         
         self.setWindowTitle("Vendor Pro 2026 - Cinematic Edition")
         self.setGeometry(50, 50, 1400, 800)
@@ -626,6 +464,29 @@ class CinematicMainWindow(QMainWindow):
         
         self.setup_ui()
         self.update_display()
+        
+        # Side effects of machine events run as bus subscribers, so an
+        # action only changes the model; the redraw is coalesced and runs
+        # once the current UI event has been handled
+        self._refresh_pending = False
+        self.vending_machine.bus.subscribe(self.schedule_refresh, name="desktop-refresh")
+        self.vending_machine.bus.subscribe(self.alert_low_stock, name="desktop-low-stock")
+    
+    def schedule_refresh(self, event):
+        if not self._refresh_pending:
+            self._refresh_pending = True
+            QTimer.singleShot(0, self.refresh_display)
+    
+    def refresh_display(self):
+        self._refresh_pending = False
+        self.update_display()
+    
+    def alert_low_stock(self, event):
+        if isinstance(event, ProductDispensed) and event.remaining is not None \
+                and event.remaining <= LOW_STOCK_ALERT:
+            name = self.vending_machine.products[event.code].name
+            QTimer.singleShot(0, lambda: self.status_bar.showMessage(
+                f"⚠️ Low stock: {event.remaining} {name} left"))
     
     def setup_ui(self):
         central_widget = QWidget()
@@ -902,8 +763,11 @@ class CinematicMainWindow(QMainWindow):
             widget = self.product_grid.itemAt(i).widget()
             if widget:
                 widget.deleteLater()
+        self.product_buttons.clear()
         
-        products = self.vending_machine.get_product_grid()
+        grid = self.vending_machine.get_product_grid_changes()
+        self._grid_version = grid['version']
+        products = grid['products']
         positions = [
             (0, 0), (0, 1), (0, 2), (0, 3),
             (1, 0), (1, 1), (1, 2), (1, 3),
@@ -924,7 +788,6 @@ class CinematicMainWindow(QMainWindow):
     def add_money(self, amount: float):
         """Add money with animation"""
         self.vending_machine.insert_cash(amount)
-        self.update_display()
         self.status_bar.showMessage(f"💰 Added ${amount:.2f} - Ready to purchase!")
         
         # Animation effect
@@ -949,7 +812,6 @@ class CinematicMainWindow(QMainWindow):
     def process_credit_card(self, amount: float):
         """Process credit card payment"""
         self.vending_machine.process_credit_card(amount)
-        self.update_display()
         self.status_bar.showMessage(f"💳 Card payment: ${amount:.2f} added!")
         QMessageBox.information(self, "Payment Success", 
             f"✅ ${amount:.2f} added to balance!\n\nReady for cinematic shopping!")
@@ -975,9 +837,6 @@ class CinematicMainWindow(QMainWindow):
             QMessageBox.warning(self, "Cannot Purchase", 
                 f"⚠️ {result['message']}\n\n"
                 f"Please add more credit or select another item.")
-        
-        self.update_display()
-        self.vending_machine.save_state()
     
     def animate_purchase(self, button):
         """Animate button after purchase"""
@@ -1003,8 +862,6 @@ class CinematicMainWindow(QMainWindow):
             self.status_bar.showMessage("No money to return")
             QMessageBox.information(self, "No Change", 
                 "No money to return.\n\nAdd credit to make a purchase! 💰")
-        
-        self.update_display()
     
     def show_admin(self):
         """Show admin panel"""
@@ -1022,9 +879,14 @@ class CinematicMainWindow(QMainWindow):
         # Update credit
         self.credit_display.setText(f"${self.vending_machine.balance:.2f}")
         
-        # Update product buttons
-        products = self.vending_machine.get_product_grid()
-        for product_info in products:
+        # Update only the product buttons whose entry changed; a full answer
+        # means the layout changed, so the grid is built again
+        changes = self.vending_machine.get_product_grid_changes(self._grid_version)
+        if changes['full']:
+            self.load_product_grid()
+            return
+        self._grid_version = changes['version']
+        for product_info in changes['products']:
             if product_info['code'] in self.product_buttons:
                 button = self.product_buttons[product_info['code']]
                 button.update_info(product_info)
@@ -1032,6 +894,8 @@ class CinematicMainWindow(QMainWindow):
     def closeEvent(self, event):
         """Save state when closing"""
         self.vending_machine.save_state()
+        # Stop the event bus and flush and close the journal and history files
+        self.vending_machine.close()
         QMessageBox.information(self, "Goodbye!", 
             "Thank you for using Vendor Pro 2026!\n\n"
             "Your session has been saved. 🎬")
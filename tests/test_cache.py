@@ -0,0 +1,49 @@
+﻿"""
+test_cache.py - The bounded TTL store of src/cache.py
+"""
+
+from src.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted_when_full():
+    evicted = []
+    cache = TTLCache(max_entries=2, on_evict=lambda key, value: evicted.append((key, value)))
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert evicted == [('b', 2)]
+    assert 'a' in cache and 'c' in cache and len(cache) == 2
+
+
+def test_entries_expire_ttl_after_their_last_touch():
+    clock = FakeClock()
+    evicted = []
+    cache = TTLCache(ttl=10, clock=clock, on_evict=lambda key, value: evicted.append(key))
+    cache.set('a', 1)
+    cache.set('b', 2)
+    clock.now = 6
+    assert cache.get('a') == 1
+    clock.now = 12
+    assert cache.get('b') is None and cache.get('a') == 1
+    clock.now = 30
+    assert cache.purge_expired() == 1
+    assert evicted == ['b', 'a'] and len(cache) == 0
+
+
+def test_reads_do_not_extend_life_without_touch_on_get():
+    clock = FakeClock()
+    cache = TTLCache(ttl=10, touch_on_get=False, clock=clock)
+    cache.set('a', 1)
+    clock.now = 6
+    assert cache.get('a') == 1
+    clock.now = 11
+    assert cache.get('a') is None
@@ -0,0 +1,63 @@
+﻿"""
+test_history.py - The compact transaction history of src/history.py
+"""
+
+import random
+
+import pytest
+
+from src.history import TransactionLog, TransactionType
+from src.models import MemoryStorage, VendingMachine
+from src.money import Money
+
+from .test_models import open_machine, run_operations
+
+
+def test_append_refused_by_a_column_leaves_the_log_aligned():
+    log = TransactionLog()
+    log.append(TransactionType.CASH, 500, timestamp_ns=1_700_000_000_000_000_000)
+    with pytest.raises(OverflowError):
+        log.append(TransactionType.CASH, 2 ** 63, timestamp_ns=1_700_000_001_000_000_000)
+    assert len(log) == 1
+    assert len(log.timestamps) == len(log.kinds) == len(log.slots) == len(log.cents) == 1
+    log.append_note("after", 1_700_000_002_000_000_000)
+    assert log[-1].endswith(": after")
+
+
+def test_refused_event_leaves_the_machine_unchanged():
+    machine = VendingMachine(storage=MemoryStorage())
+    machine.insert_cash(5)
+    with pytest.raises(OverflowError):
+        machine.insert_cash(Money(2 ** 63))
+    assert machine.balance == 5
+    assert len(machine.transactions) == 1
+    machine.close()
+
+
+def test_spilled_entries_stay_queryable(tmp_path):
+    log = TransactionLog(capacity=8, spill_dir=str(tmp_path), segment_entries=4)
+    start = 1_700_000_000_000_000_000
+    for n in range(30):
+        kind = TransactionType.PURCHASE if n % 3 == 0 else TransactionType.CASH
+        log.append(kind, 100 + n, log.slot('A1', 'Coke') if n % 3 == 0 else -1,
+                   timestamp_ns=start + n * 1_000_000_000)
+    assert len(log.kinds) <= 8 and len(log) == 30
+    assert len(log.segments()) == 6
+    records = list(log.records())
+    assert [record.cents for record in records] == [100 + n for n in range(30)]
+    purchases = list(log.records(kind=TransactionType.PURCHASE, since_ns=start + 10_000_000_000))
+    assert [record.cents for record in purchases] == [112, 115, 118, 121, 124, 127]
+    assert all(record.code == 'A1' for record in purchases)
+    assert log.total() == Money(sum(100 + n for n in range(0, 30, 3)))
+
+
+def test_reloading_does_not_spill_the_history_again(tmp_path):
+    path = tmp_path / "state.json"
+    machine = open_machine(path, history_capacity=40, compact_every=50)
+    run_operations(machine, random.Random(5), 400)
+    expected = [record.line for record in machine.transactions.records()]
+    machine.close()
+    for _ in range(2):
+        reloaded = open_machine(path, history_capacity=40, compact_every=50)
+        assert [record.line for record in reloaded.transactions.records()] == expected
+        reloaded.close()
@@ -0,0 +1,191 @@
+﻿"""
+test_main_web.py - The web front-end's per-session machine and its API
+"""
+
+import sys
+import threading
+
+import main_web
+from main_web import WebVendingMachine
+from src.ratelimit import AdmissionController, PRIORITY_NORMAL
+
+
+def test_sessions_have_their_own_credit():
+    vm = WebVendingMachine()
+    vm.insert_cash(5, 'alice')
+    vm.process_credit_card(2, session='bob')
+    result = vm.purchase_product('A1', 'alice')
+    assert result['success']
+    assert result['balance'] == vm.get_balance('alice') == 3.25
+    assert vm.get_balance('bob') == 2
+    assert not vm.purchase_product('D3', 'bob')['success']
+    assert vm.cancel_transaction('bob') == 2
+    assert vm.get_balance('bob') == 0
+    assert vm.total_sales == 1.75
+    vm.close()
+
+
+def test_credit_of_evicted_and_idle_sessions_is_reclaimed():
+    vm = WebVendingMachine(max_sessions=2, session_ttl=60)
+    vm.insert_cash(5, 'alice')
+    vm.insert_cash(2, 'bob')
+    vm.insert_cash(1, 'carol')
+    # alice was the least recently used session when carol arrived
+    assert vm.get_balance('alice') == 0
+    assert vm.reclaimed_credit == 5
+    assert vm.transactions[-1].endswith("Unclaimed credit reclaimed: $5.00")
+
+    now = vm.balances.clock()
+    vm.balances.clock = lambda: now + 61
+    assert vm.get_balance('bob') == 0 and vm.get_balance('carol') == 0
+    assert vm.reclaimed_credit == 8
+    vm.close()
+
+
+def test_restocks_are_not_lost_to_concurrent_sales():
+    vm = WebVendingMachine(max_sessions=64)
+    start = vm.products['A1'].quantity
+    sold = [0] * 4
+
+    def buy(index):
+        session = f"buyer-{index}"
+        vm.insert_cash(5000, session)
+        for _ in range(1000):
+            sold[index] += vm.purchase_product('A1', session)['success']
+
+    def restock():
+        for _ in range(1000):
+            vm.restock('A1', 1)
+
+    threads = [threading.Thread(target=buy, args=(i,)) for i in range(4)]
+    threads.append(threading.Thread(target=restock))
+    # Switch threads as often as possible so a restock lands mid-sale if it can
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert vm.products['A1'].quantity == start + 1000 - sum(sold)
+    vm.close()
+
+
+def test_changes_follow_the_state_version():
+    vm = WebVendingMachine()
+    version = vm.get_changes()['version']
+    vm.insert_cash(5, 'alice')
+    vm.purchase_product('B1', 'alice')
+    changes = vm.get_changes(version, 'alice')
+    assert not changes['full']
+    assert list(changes['products']) == ['B1']
+    assert changes['products']['B1']['quantity'] == vm.products['B1'].quantity
+    assert len(changes['transactions']) == 2
+    assert vm.get_changes(changes['version']) is None
+    vm.close()
+
+
+def test_changes_from_a_version_ahead_resync():
+    vm = WebVendingMachine()
+    vm.insert_cash(5, 'alice')
+    changes = vm.get_changes(vm.current_version() + 100, 'alice')
+    assert changes['full']
+    assert changes['balance'] == 5
+    assert set(changes['products']) == set(vm.products)
+    vm.close()
+
+
+def test_events_reach_the_customer_stream():
+    vm = WebVendingMachine()
+    subscription = vm.events.subscribe('alice')
+    vm.insert_cash(5, 'alice')
+    vm.purchase_product('A1', 'alice')
+    vm.insert_cash(1, 'bob')
+    events = []
+    while True:
+        event = subscription.get(timeout=0)
+        if event is None:
+            break
+        events.append(event)
+    assert events == [
+        {'type': 'balance', 'balance': 5},
+        {'type': 'stock', 'code': 'A1', 'quantity': vm.products['A1'].quantity},
+        {'type': 'balance', 'balance': 3.25},
+    ]
+    vm.close()
+
+
+def test_purchase_route():
+    client = main_web.app.test_client()
+    assert client.post('/api/add-money', json={'amount': 'nan'}).json['success'] is False
+    assert client.post('/api/add-money', json={'amount': 5}).json['balance'] == 5
+    response = client.post('/api/purchase', json={'product_code': 'A1'}).json
+    assert response['success'] and response['product_name'] == 'Coke'
+    assert response['balance'] == 3.25
+    assert client.post('/api/cancel').json['change'] == 3.25
+
+
+def test_malformed_batch_is_refused_before_running():
+    client = main_web.app.test_client()
+    response = client.post('/api/batch', json={'operations': [
+        {'op': 'add-money', 'amount': 5}, {'op': 'purchase', 'product_code': ['A1']}]})
+    assert response.status_code == 400
+    assert client.get('/api/state').json['balance'] == 0
+
+
+def test_batch_body_must_be_an_object():
+    client = main_web.app.test_client()
+    for body in ([{'op': 'add-money', 'amount': 5}], 'add-money', 5):
+        assert client.post('/api/batch', json=body).status_code == 400
+
+
+def test_amounts_beyond_the_maximum_are_refused():
+    client = main_web.app.test_client()
+    for amount in (1e17, 1e26, '1e400'):
+        response = client.post('/api/add-money', json={'amount': amount})
+        assert response.status_code == 200 and response.json['success'] is False
+    response = client.post('/api/batch', json={'operations': [{'op': 'add-money', 'amount': 1e26}]})
+    assert response.status_code == 400
+    assert client.post('/api/add-money', json={'amount': 5}).json['balance'] == 5
+    client.post('/api/cancel')
+
+
+def test_event_streams_closed_unread_unsubscribe():
+    client = main_web.app.test_client()
+    subscribers = len(main_web.vm.events)
+    for _ in range(main_web.MAX_EVENT_STREAMS + 1):
+        response = client.head('/api/events')
+        assert response.status_code == 200
+        response.close()
+        response = client.get('/api/events')
+        response.close()
+    assert len(main_web.vm.events) == subscribers
+    assert main_web.event_streams == 0
+
+
+def test_a_full_worker_sheds_browsing_but_not_purchases(monkeypatch):
+    admission = AdmissionController(max_in_flight=main_web.WORKER_THREADS)
+    monkeypatch.setattr(main_web, 'admission', admission)
+    # Threads busy with other requests, up to the browsing share
+    while admission.try_enter(PRIORITY_NORMAL):
+        pass
+    busy = admission.in_flight
+    client = main_web.app.test_client()
+    response = client.get('/api/state')
+    assert response.status_code == 429 and 'Retry-After' in response.headers
+    assert client.post('/api/cancel').status_code == 200
+    assert admission.in_flight == busy
+
+
+def test_retried_payment_is_answered_from_the_idempotency_cache():
+    client = main_web.app.test_client()
+    headers = {'Idempotency-Key': 'pay-1'}
+    first = client.post('/api/credit-card', json={'amount': 5}, headers=headers)
+    again = client.post('/api/credit-card', json={'amount': 5}, headers=headers)
+    assert again.headers['Idempotent-Replayed'] == 'true'
+    assert again.json == first.json and again.json['balance'] == 5
+    assert client.post('/api/credit-card', json={'amount': 7}, headers=headers).status_code == 422
+    assert client.get('/api/state').json['balance'] == 5
+    client.post('/api/cancel')
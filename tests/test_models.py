@@ -0,0 +1,220 @@
+﻿"""
+test_models.py - Storage round trips and the product grid cache of src/models.py
+"""
+
+import json
+import random
+import time
+
+from src import models
+from src.models import (BALANCE_KEEP, DURABILITY_ALWAYS_FSYNC, DURABILITY_GROUP_COMMIT, Journal,
+                        SqliteStorage, VendingMachine)
+
+
+def ticking_clock():
+    """Clock returning a new epoch-nanosecond timestamp on every call"""
+    state = {'now': 1_700_000_000_000_000_000}
+
+    def clock():
+        state['now'] += 1_000_000
+        return state['now']
+    return clock
+
+
+def open_machine(path, storage=None, **kwargs):
+    machine = VendingMachine(str(path), journal=True, storage=storage, clock=ticking_clock(), **kwargs)
+    machine.load_state()
+    return machine
+
+
+def state_of(machine):
+    return {
+        'balance': machine.balance,
+        'total_sales': machine.total_sales,
+        'products': {code: product.to_dict() for code, product in machine.products.items()},
+        'transactions': list(machine.transactions),
+    }
+
+
+def run_operations(machine, rng, count):
+    codes = list(machine.products)
+    for _ in range(count):
+        choice = rng.random()
+        if choice < 0.35:
+            machine.insert_cash(rng.choice((0.25, 1, 5)))
+        elif choice < 0.4:
+            machine.process_credit_card(10)
+        elif choice < 0.8:
+            machine.purchase_product(rng.choice(codes + ['Z9']))
+        elif choice < 0.9:
+            machine.cancel_transaction()
+        else:
+            machine.restock(rng.choice(codes), rng.randint(1, 3))
+
+
+def test_journal_round_trip(tmp_path):
+    path = tmp_path / "state.json"
+    machine = open_machine(path, compact_every=25)
+    run_operations(machine, random.Random(1), 200)
+    machine.save_state()
+    expected = state_of(machine)
+    machine.close()
+
+    reloaded = open_machine(path, compact_every=25)
+    actual = state_of(reloaded)
+    # A snapshot keeps only the latest transactions; older ones are in the history files
+    history = actual.pop('transactions')
+    assert history == expected.pop('transactions')[-len(history):]
+    assert actual == expected
+    reloaded.close()
+
+
+def test_journal_round_trip_without_save(tmp_path):
+    path = tmp_path / "state.json"
+    machine = open_machine(path, balance_policy=BALANCE_KEEP)
+    run_operations(machine, random.Random(2), 150)
+    expected = state_of(machine)
+    machine.close()
+
+    reloaded = open_machine(path, balance_policy=BALANCE_KEEP)
+    assert state_of(reloaded) == expected
+    reloaded.close()
+
+
+def test_sqlite_round_trip(tmp_path):
+    path = str(tmp_path / "state.db")
+    machine = open_machine(path, storage=SqliteStorage(path))
+    run_operations(machine, random.Random(3), 150)
+    expected = state_of(machine)
+    machine.close()
+
+    reloaded = open_machine(path, storage=SqliteStorage(path))
+    actual = state_of(reloaded)
+    for key in ('balance', 'total_sales', 'products'):
+        assert actual[key] == expected[key]
+    reloaded.close()
+
+
+def count_fsyncs(monkeypatch):
+    calls = []
+    fsync = models.os.fsync
+    monkeypatch.setattr(models.os, 'fsync', lambda fd: (calls.append(fd), fsync(fd)))
+    return calls
+
+
+def journal_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_always_fsync_syncs_every_record(tmp_path, monkeypatch):
+    fsyncs = count_fsyncs(monkeypatch)
+    journal = Journal(str(tmp_path / "state.json.journal"), DURABILITY_ALWAYS_FSYNC)
+    for amount in (1, 2, 3):
+        journal.append({'op': 'cash', 'amount': amount})
+        assert len(fsyncs) == amount
+        assert [record['seq'] for record in journal_lines(journal.path)] == list(range(1, amount + 1))
+    journal.close()
+
+
+def test_group_commit_writes_batches_in_the_background(tmp_path, monkeypatch):
+    fsyncs = count_fsyncs(monkeypatch)
+    journal = Journal(str(tmp_path / "state.json.journal"), DURABILITY_GROUP_COMMIT,
+                      group_commit_ms=60_000, group_commit_ops=4)
+    for amount in range(3):
+        journal.append({'op': 'cash', 'amount': amount})
+    # Below group_commit_ops and long before group_commit_ms nothing is written
+    time.sleep(0.05)
+    assert not fsyncs and not (tmp_path / "state.json.journal").exists()
+    journal.append({'op': 'cash', 'amount': 3})
+    deadline = time.monotonic() + 5
+    while not fsyncs and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(fsyncs) == 1
+    assert [record['amount'] for record in journal_lines(journal.path)] == [0, 1, 2, 3]
+
+    # What is still buffered is written when the journal closes
+    journal.append({'op': 'cancel'})
+    journal.close()
+    assert len(fsyncs) == 2
+    assert [record['seq'] for record in journal_lines(journal.path)] == [1, 2, 3, 4, 5]
+
+
+def test_group_commit_round_trip(tmp_path):
+    path = tmp_path / "state.json"
+    machine = open_machine(path, durability=DURABILITY_GROUP_COMMIT)
+    run_operations(machine, random.Random(6), 150)
+    expected = state_of(machine)
+    machine.close()
+
+    reloaded = open_machine(path, durability=DURABILITY_GROUP_COMMIT)
+    assert state_of(reloaded) == expected
+    reloaded.close()
+
+
+def test_torn_journal_tail_is_dropped(tmp_path, capsys):
+    path = tmp_path / "state.json"
+    machine = open_machine(path)
+    machine.save_state()
+    machine.insert_cash(5)
+    machine.purchase_product("A1")
+    expected = state_of(machine)
+    machine.close()
+
+    journal = tmp_path / "state.json.journal"
+    intact = journal.read_bytes()
+    with open(journal, 'ab') as f:
+        f.write(b'{"op":"cash","amount":20.0,"ts":17')
+
+    reloaded = open_machine(path)
+    assert "torn record" in capsys.readouterr().out
+    assert state_of(reloaded) == expected
+    assert journal.read_bytes() == intact
+
+    # New records start on a clean line after the truncation
+    reloaded.insert_cash(1)
+    expected = state_of(reloaded)
+    reloaded.close()
+    again = open_machine(path)
+    assert state_of(again) == expected
+    again.close()
+
+
+def test_old_records_load(tmp_path):
+    path = tmp_path / "state.json"
+    records = [
+        {'op': 'cash', 'amount': 5.0, 'ts': '2024-01-01 10:00:00', 'seq': 1},
+        {'op': 'buy', 'code': 'A1', 'ts': '2024-01-01 10:00:01', 'seq': 2},
+        {'op': 'cash', 'amount': 2.0, 'ts': '2024-01-01 10:00:02', 'seq': 3},
+        {'op': 'cancel', 'ts': '2024-01-01 10:00:03', 'seq': 4},
+        {'op': 'restock', 'code': 'Z9', 'count': 4, 'ts': '2024-01-01 10:00:04', 'seq': 5},
+    ]
+    (tmp_path / "state.json.journal").write_text(
+        ''.join(json.dumps(record) + '\n' for record in records), encoding='utf-8')
+
+    machine = open_machine(path)
+    assert machine.balance.cents == 0
+    assert machine.total_sales == machine.products["A1"].price
+    assert machine.transactions[-1].endswith("Returned: $2.00")
+    machine.close()
+
+
+def test_grid_changes_match_a_fresh_grid(tmp_path):
+    machine = open_machine(tmp_path / "state.json")
+    rng = random.Random(4)
+    grid = machine.get_product_grid_changes()
+    assert grid['full']
+    shown = {entry['code']: entry for entry in grid['products']}
+    version = grid['version']
+    for _ in range(300):
+        run_operations(machine, rng, rng.randint(0, 3))
+        changes = machine.get_product_grid_changes(version)
+        if changes['full']:
+            shown = {}
+        shown.update((entry['code'], entry) for entry in changes['products'])
+        version = changes['version']
+
+        cents = machine.balance.cents
+        fresh = [machine._grid_entry(slot, cents) for slot in machine.products.order()]
+        assert [shown[entry['code']] for entry in fresh] == fresh
+    machine.close()
@@ -0,0 +1,40 @@
+﻿"""
+test_money.py - Conversions and bounds of src/money.py
+"""
+
+from decimal import Decimal
+from fractions import Fraction
+
+import pytest
+
+from src.money import MAX_CENTS, Money
+
+
+def test_of_rounds_written_decimals_half_up():
+    assert Money.of(0.125).cents == 13
+    assert Money.of('$1.75').cents == 175
+    assert Money.of(2).cents == 200
+
+
+def test_of_refuses_amounts_out_of_range():
+    assert Money.of(MAX_CENTS // 100).cents == MAX_CENTS
+    for amount in (MAX_CENTS // 100 + 1, 1e26, -1e26, float('inf'), float('nan'), '1e400'):
+        with pytest.raises(ValueError):
+            Money.of(amount)
+
+
+def test_comparisons_with_numbers_follow_one_rule():
+    dime = Money.of(0.1)
+    assert dime == 0.1 and dime <= 0.1 and dime >= 0.1
+    assert not (dime < 0.1 or dime > 0.1 or dime != 0.1)
+    assert dime == Decimal('0.1') == Fraction(1, 10)
+    assert Money(100) == 1 and hash(Money(100)) == hash(1)
+    assert dime < float('inf') and dime > float('-inf')
+    assert dime != float('nan') and not dime < float('nan')
+    assert dime < 1e30 and dime != 1e30
+
+
+def test_multiplying_by_anything_but_a_count_is_refused():
+    assert Money(175) * 3 == 3 * Money(175) == Money(525)
+    with pytest.raises(TypeError):
+        Money(175) * 1.5
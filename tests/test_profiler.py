@@ -0,0 +1,59 @@
+﻿"""
+test_profiler.py - The stack sampling profiler of src/profiler.py
+"""
+
+import threading
+
+import main_web
+from src import profiler
+from src.profiler import StackSampler
+
+
+def spin(stop):
+    while not stop.is_set():
+        pass
+
+
+def test_sampler_counts_the_stacks_of_busy_threads():
+    stop = threading.Event()
+    worker = threading.Thread(target=spin, args=(stop,))
+    worker.start()
+    try:
+        sampler = profiler.profile(0.1, 0.005)
+    finally:
+        stop.set()
+        worker.join()
+    assert sampler.samples >= 5
+    stacks = dict(line.rsplit(' ', 1) for line in sampler.collapsed().splitlines())
+    assert any(stack.rpartition(';')[2].startswith('spin (test_profiler.py:') for stack in stacks)
+    assert sum(map(int, stacks.values())) >= sampler.samples
+
+
+def test_distinct_stacks_are_capped():
+    stop = threading.Event()
+    worker = threading.Thread(target=spin, args=(stop,))
+    worker.start()
+    try:
+        sampler = StackSampler(max_stacks=0)
+        sampler.sample()
+    finally:
+        stop.set()
+        worker.join()
+    assert list(sampler.counts) == ['[truncated]']
+
+
+def test_only_one_profile_runs_at_a_time():
+    with profiler._profile_lock:
+        assert profiler.profile(0.01) is None
+    assert profiler.profile(0.01) is not None
+
+
+def test_profile_route(monkeypatch):
+    monkeypatch.setattr(main_web, 'ADMIN_TOKEN', 'secret')
+    client = main_web.app.test_client()
+    assert client.post('/api/admin/profile?seconds=0.05').status_code == 403
+    headers = {'X-Admin-Token': 'secret'}
+    assert client.post('/api/admin/profile?seconds=nan', headers=headers).status_code == 400
+    response = client.post('/api/admin/profile?seconds=0.05', headers=headers)
+    assert response.status_code == 200
+    assert int(response.headers['X-Profile-Samples']) > 0
@@ -0,0 +1,51 @@
+﻿"""
+test_ratelimit.py - Token buckets and admission control of src/ratelimit.py
+"""
+
+from src.ratelimit import (AdmissionController, TokenBucketLimiter,
+                           PRIORITY_CRITICAL, PRIORITY_LOW, PRIORITY_NORMAL)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_allows_a_burst_then_refills_at_the_rate():
+    clock = FakeClock()
+    limiter = TokenBucketLimiter(rate=2, burst=3, clock=clock)
+    assert [limiter.acquire('alice') for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire('alice') == 0.5
+    assert limiter.acquire('bob') == 0
+    clock.now += 0.5
+    assert limiter.acquire('alice') == 0
+
+
+def test_idle_buckets_are_forgotten_full():
+    clock = FakeClock()
+    limiter = TokenBucketLimiter(rate=1, burst=2, max_clients=2, clock=clock)
+    for client in ('a', 'b', 'c'):
+        limiter.acquire(client)
+    assert len(limiter.buckets) <= 2
+    clock.now += 10
+    assert limiter.acquire('a', 2) == 0
+
+
+def test_admission_sheds_low_priorities_first():
+    admission = AdmissionController(max_in_flight=8)
+    entered = 0
+    while admission.try_enter(PRIORITY_LOW):
+        entered += 1
+    assert entered == 4 and admission.shed == 1
+    while admission.try_enter(PRIORITY_NORMAL):
+        entered += 1
+    assert entered == 7 and admission.shed == 2
+    assert admission.try_enter(PRIORITY_CRITICAL)
+    assert admission.try_enter(PRIORITY_CRITICAL)
+    assert admission.in_flight == 9
+    for _ in range(9):
+        admission.leave()
+    assert admission.try_enter(PRIORITY_LOW)
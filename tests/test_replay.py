@@ -0,0 +1,25 @@
+﻿"""
+test_replay.py - Replaying recorded sales with src/replay.py
+"""
+
+import csv
+import os
+
+from src.models import LEGACY_PRODUCTS, MemoryStorage, VendingMachine
+from src.money import Money
+from src.replay import ReplayClock, Replayer, read_events
+
+SALES_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'data', 'transactions.csv')
+
+
+def test_legacy_sales_replay_at_their_recorded_prices():
+    machine = VendingMachine(storage=MemoryStorage(), clock=ReplayClock(), catalog=LEGACY_PRODUCTS)
+    replayer = Replayer(machine, add_missing=10)
+    stats = replayer.run(read_events(SALES_CSV))
+    with open(SALES_CSV, newline='', encoding='utf-8-sig') as f:
+        recorded = sum(float(row['Price'].lstrip('$')) for row in csv.DictReader(f))
+    assert stats['failed'] == 0 and stats['unknown_product'] == 0
+    assert stats['succeeded'] == stats['events']
+    assert machine.total_sales == Money.of(recorded)
+    assert machine.balance.cents == 0
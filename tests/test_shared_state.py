@@ -0,0 +1,95 @@
+﻿"""
+test_shared_state.py - The shared memory block that gunicorn workers share
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import uuid
+
+import pytest
+
+from main_web import WebVendingMachine
+from src.shared_state import SharedInventory, SharedReplyCache
+
+
+@pytest.fixture
+def shared_name():
+    name = f"vt{uuid.uuid4().hex[:12]}"
+    yield name
+    for block in (name, f"{name}_replies"):
+        try:
+            shm = shared_memory.SharedMemory(name=block)
+        except FileNotFoundError:
+            continue
+        shm.unlink()
+        shm.close()
+
+
+def attach(name):
+    """A worker's view of the block"""
+    return SharedInventory(name, [175, 150], [3, 5], session_capacity=64)
+
+
+def test_workers_sell_from_one_inventory(shared_name):
+    first, second = WebVendingMachine(shared_name), WebVendingMachine(shared_name)
+    stock = first.products['A1'].quantity
+    first.insert_cash(5, 'alice')
+    # Credit lives in the shared block, so any worker can spend it
+    assert second.get_balance('alice') == 5
+    assert second.purchase_product('A1', 'alice')['success']
+    assert first.get_state('alice')['products']['A1']['quantity'] == stock - 1
+    assert first.total_sales == second.total_sales == 1.75
+    changes = first.get_changes(0, 'alice')
+    assert changes['version'] == second.current_version()
+    assert changes['transactions'][-1].endswith("Purchased Coke for $1.75")
+    for machine in (first, second):
+        machine.close()
+
+
+def sell_all(name, code, results):
+    machine = WebVendingMachine(name)
+    sold = 0
+    for n in range(10):
+        session = f"{os.getpid()}-{n}"
+        machine.insert_cash(5, session)
+        sold += machine.purchase_product(code, session)['success']
+        machine.cancel_transaction(session)
+    results.put(sold)
+    machine.close()
+
+
+def test_processes_never_sell_the_same_unit_twice(shared_name):
+    machine = WebVendingMachine(shared_name)
+    stock = machine.products['A1'].quantity
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=sell_all, args=(shared_name, 'A1', results))
+               for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    sold = sum(results.get() for _ in workers)
+    machine.refresh()
+    assert sold == stock and machine.products['A1'].quantity == 0
+    assert machine.total_sales == machine.products['A1'].price * sold
+    machine.close()
+
+
+def test_replies_are_seen_by_every_worker(shared_name):
+    now = [1000.0]
+    first, second = attach(shared_name), attach(shared_name)
+    replies = SharedReplyCache(first, capacity=16, ttl=60, clock=lambda: now[0])
+    other = SharedReplyCache(second, capacity=16, ttl=60, clock=lambda: now[0])
+    with first.lock():
+        replies.set('alice /api/credit-card k1', (b'f' * 16, b'{"balance": 5.0}', 200))
+        replies.set('alice /api/credit-card big', (b'f' * 16, os.urandom(4096), 200))
+    with second.lock():
+        assert other.get('alice /api/credit-card k1') == (b'f' * 16, b'{"balance": 5.0}', 200)
+        assert other.get('alice /api/credit-card big') is None
+        assert other.get('bob /api/credit-card k1') is None
+    now[0] += 61
+    with second.lock():
+        assert other.get('alice /api/credit-card k1') is None
+    for block in (replies, other, first, second):
+        block.close()
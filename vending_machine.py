@@ -4,45 +4,17 @@ from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout,
                                QMessageBox)
 from PySide6.QtCore import Qt
 
-class VendingMachine:
-    def __init__(self):
-        self.balance = 0.0
-        self.products = {
-            "A1": {"name": "Cola", "price": 1.25, "quantity": 10},
-            "A2": {"name": "Chips", "price": 1.50, "quantity": 7},
-            "A3": {"name": "Water", "price": 1.00, "quantity": 12}
-        }
-    
-    def insert_coin(self, amount):
-        self.balance += amount
-        return f"Inserted: ${amount:.2f}\nBalance: ${self.balance:.2f}"
-    
-    def purchase(self, code):
-        if code not in self.products:
-            return {"success": False, "message": "Invalid code"}
-        
-        product = self.products[code]
-        
-        if product["quantity"] <= 0:
-            return {"success": False, "message": "Out of stock"}
-        
-        if self.balance < product["price"]:
-            return {"success": False, "message": f"Need: ${product['price']:.2f}"}
-        
-        product["quantity"] -= 1
-        change = self.balance - product["price"]
-        self.balance = 0
-        
-        return {
-            "success": True,
-            "message": f"Dispensed {product['name']}!\nChange: ${change:.2f}",
-            "change": change
-        }
+from src.models import BALANCE_RETURN_CHANGE, LEGACY_PRODUCTS, MemoryStorage, VendingMachine
+
+def create_machine():
+    """The original three-slot machine, run on the shared engine without persistence"""
+    return VendingMachine(storage=MemoryStorage(), catalog=LEGACY_PRODUCTS,
+                          balance_policy=BALANCE_RETURN_CHANGE)
 
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
-        self.vm = VendingMachine()
+        self.vm = create_machine()
         
         self.setWindowTitle("Vending Machine")
         self.setGeometry(100, 100, 400, 300)
@@ -75,7 +47,7 @@ class MainWindow(QMainWindow):
         grid = QGridLayout()
         row, col = 0, 0
         for code, product in self.vm.products.items():
-            btn = QPushButton(f"{code}\n{product['name']}\n${product['price']:.2f}")
+            btn = QPushButton(f"{code}\n{product.name}\n${product.price:.2f}")
             btn.clicked.connect(lambda checked, c=code: self.buy_product(c))
             grid.addWidget(btn, row, col)
             col += 1
@@ -85,15 +57,16 @@ class MainWindow(QMainWindow):
         layout.addLayout(grid)
     
     def insert_money(self, amount):
-        msg = self.vm.insert_coin(amount)
-        self.display.setText(msg)
+        msg = self.vm.insert_cash(amount)
+        self.display.setText(f"{msg}\nBalance: ${self.vm.balance:.2f}")
         self.balance_label.setText(f"Balance: ${self.vm.balance:.2f}")
     
     def buy_product(self, code):
-        result = self.vm.purchase(code)
+        result = self.vm.purchase_product(code)
         if result["success"]:
-            self.display.setText(result["message"])
-            QMessageBox.information(self, "Success", result["message"])
+            message = f"Dispensed {result['product'].name}!\nChange: ${result['change']:.2f}"
+            self.display.setText(message)
+            QMessageBox.information(self, "Success", message)
         else:
             self.display.setText(result["message"])
             QMessageBox.warning(self, "Failed", result["message"])